@@ -12,6 +12,34 @@ from datetime import datetime, timedelta
 from typing import Dict, List, Optional
 import random
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+
+class _RateLimiter:
+    """线程安全的令牌桶限速器，按每分钟请求数限制"""
+
+    def __init__(self, rate_per_minute: float):
+        self.capacity = max(1.0, rate_per_minute / 60.0)  # 最多允许约1秒的突发请求
+        self.rate = rate_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """阻塞直到获得一个请求令牌"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
 
 class EnhancedDataSourceManager:
     """增强型数据源管理器"""
@@ -91,7 +119,12 @@ class EnhancedDataSourceManager:
                 backoff_factor=1
             )
         
-        adapter = HTTPAdapter(max_retries=retry_strategy)
+        # 并发配置：批量请求的线程数与每个主机的最大并发连接数
+        self.max_batch_workers = 32
+        self.per_host_concurrency = 8
+        
+        # 连接池大小与单主机并发上限一致，避免并发请求丢弃连接
+        adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=self.per_host_concurrency)
         self.session.mount("http://", adapter)
         self.session.mount("https://", adapter)
         
@@ -102,6 +135,16 @@ class EnhancedDataSourceManager:
         # 缓存配置
         self.cache = {}
         self.cache_duration = 300  # 5分钟缓存
+        
+        # 按主机的限速器与并发信号量（所有请求共享，线程安全）
+        self._host_limiters = {}
+        self._host_semaphores = {}
+        self._host_lock = threading.Lock()
+        
+        # Binance全量行情快照（一次请求返回所有交易对），在短TTL内供整批标的复用
+        self.bulk_snapshot_ttl = 10  # 秒
+        self._bulk_snapshots = {}
+        self._bulk_snapshot_lock = threading.Lock()
     
     def get_latest_data(self, symbol: str, market: str, days: int = 100) -> pd.DataFrame:
         """获取最新数据，支持多数据源fallback"""
@@ -264,34 +307,40 @@ class EnhancedDataSourceManager:
             return float(data.get('price')) if 'price' in data else None
 
         prices: List[float] = []
-        # 1) 主交易对
-        try:
-            p = fetch_price_from_binance(primary_pair)
-            if p:
-                prices.append(p)
-        except Exception:
-            pass
-        # 2) 备用交易对
-        for pair in backup_pairs:
-            try:
-                p = fetch_price_from_binance(pair)
+        # 1) 优先使用全量价格快照（整批标的共享一次请求）
+        snapshot = self._get_binance_bulk_snapshot('price', 'price')
+        if snapshot is not None:
+            for pair in [primary_pair] + backup_pairs:
+                p = snapshot.get(pair)
                 if p:
                     prices.append(p)
-            except Exception:
-                continue
+        else:
+            # 快照不可用时逐个请求：主交易对与备用交易对
+            for pair in [primary_pair] + backup_pairs:
+                try:
+                    p = fetch_price_from_binance(pair)
+                    if p:
+                        prices.append(p)
+                except Exception:
+                    continue
 
-        # 3) 如果仍然不足，尝试24hr ticker获取加权均价
+        # 2) 如果仍然不足，尝试24hr ticker获取加权均价
         if not prices:
-            try:
-                url = f"{self.data_sources['crypto']['binance']['url']}/ticker/24hr"
-                resp = self._make_request_with_retry(url, params={'symbol': primary_pair})
-                data = resp.json()
-                if 'weightedAvgPrice' in data:
-                    prices.append(float(data['weightedAvgPrice']))
-            except Exception:
-                pass
+            ticker_24hr = self._get_binance_bulk_snapshot('24hr', 'weightedAvgPrice')
+            if ticker_24hr is not None:
+                if ticker_24hr.get(primary_pair):
+                    prices.append(ticker_24hr[primary_pair])
+            else:
+                try:
+                    url = f"{self.data_sources['crypto']['binance']['url']}/ticker/24hr"
+                    resp = self._make_request_with_retry(url, params={'symbol': primary_pair})
+                    data = resp.json()
+                    if 'weightedAvgPrice' in data:
+                        prices.append(float(data['weightedAvgPrice']))
+                except Exception:
+                    pass
 
-        # 4) 基于统计中值与离群值过滤校准
+        # 3) 基于统计中值与离群值过滤校准
         if not prices:
             return None
 
@@ -321,23 +370,55 @@ class EnhancedDataSourceManager:
             'timestamp': datetime.now().isoformat()
         }
 
+    def _get_binance_bulk_snapshot(self, endpoint: str, field: str) -> Optional[Dict[str, float]]:
+        """获取Binance全量ticker快照（/ticker/price 或 /ticker/24hr 不带symbol参数），
+        解析为 交易对 -> field数值 的索引，并在 bulk_snapshot_ttl 秒内复用。
+        获取失败时返回None（同样缓存一个TTL），调用方回退到逐个请求。
+        """
+        cached = self._bulk_snapshots.get(endpoint)
+        if cached and time.time() - cached['timestamp'] < self.bulk_snapshot_ttl:
+            return cached['data']
+
+        # 加锁并二次检查，并发线程只触发一次全量请求
+        with self._bulk_snapshot_lock:
+            cached = self._bulk_snapshots.get(endpoint)
+            if cached and time.time() - cached['timestamp'] < self.bulk_snapshot_ttl:
+                return cached['data']
+            try:
+                url = f"{self.data_sources['crypto']['binance']['url']}/ticker/{endpoint}"
+                resp = self._make_request_with_retry(url, params={})
+                index = {}
+                for item in resp.json():
+                    try:
+                        index[item['symbol']] = float(item[field])
+                    except (KeyError, TypeError, ValueError):
+                        continue
+            except Exception as e:
+                print(f"⚠️ Binance全量行情快照获取失败({endpoint}): {e}")
+                # 失败结果同样缓存一个TTL，避免整批标的重复请求全量接口
+                index = None
+            self._bulk_snapshots[endpoint] = {'data': index, 'timestamp': time.time()}
+            return index
+
     # 批量接口：每市场最多返回500个标的的实时价格
     def get_real_time_prices_batch(self, symbols: List[str], market: str, limit: int = 500) -> List[Dict]:
         """批量获取实时价格，最多500。
-        返回列表中每项与 get_real_time_price 的结构一致。
+        返回列表中每项与 get_real_time_price 的结构一致，顺序与输入一致。
+        使用线程池并发请求，共享 self.session；限速与单主机并发由 _make_request_with_retry 统一控制。
         """
         if not symbols:
             return []
         symbols = symbols[: min(limit, 500)]
-        results: List[Dict] = []
-        for s in symbols:
+
+        def fetch(s: str) -> Optional[Dict]:
             try:
-                data = self.get_real_time_price(s, market)
-                if isinstance(data, dict):
-                    results.append(data)
+                return self.get_real_time_price(s, market)
             except Exception:
-                continue
-        return results
+                return None
+
+        with ThreadPoolExecutor(max_workers=min(self.max_batch_workers, len(symbols))) as pool:
+            fetched = list(pool.map(fetch, symbols))
+        return [data for data in fetched if isinstance(data, dict)]
     
     def _get_mock_price_data(self, symbol: str, market: str) -> Dict:
         """获取模拟价格数据"""
@@ -737,11 +818,30 @@ class EnhancedDataSourceManager:
         print(f"✅ 成功获取Alpha Vantage数据: {symbol}")
         return df.tail(days)
     
+    def _host_throttle(self, url: str):
+        """返回该主机的(限速器, 并发信号量)；速率取 data_sources 中同主机数据源最严格的 rate_limit"""
+        host = urlparse(url).netloc
+        with self._host_lock:
+            if host not in self._host_semaphores:
+                rate_limits = [
+                    source['rate_limit']
+                    for sources in self.data_sources.values()
+                    for source in sources.values()
+                    if urlparse(source['url']).netloc == host and 'rate_limit' in source
+                ]
+                self._host_limiters[host] = _RateLimiter(min(rate_limits)) if rate_limits else None
+                self._host_semaphores[host] = threading.BoundedSemaphore(self.per_host_concurrency)
+            return self._host_limiters[host], self._host_semaphores[host]
+    
     def _make_request_with_retry(self, url: str, params: dict) -> requests.Response:
-        """带重试的HTTP请求"""
+        """带重试的HTTP请求（遵守每个数据源的限速与单主机并发上限）"""
+        limiter, semaphore = self._host_throttle(url)
         for attempt in range(self.max_retries):
             try:
-                response = self.session.get(url, params=params, timeout=15)
+                if limiter is not None:
+                    limiter.acquire()
+                with semaphore:
+                    response = self.session.get(url, params=params, timeout=15)
                 
                 if response.status_code == 429:  # 频率限制
                     wait_time = self.retry_delay * (2 ** attempt)
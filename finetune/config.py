@@ -20,11 +20,23 @@ class Config:
         self.predict_window = 10  # Number of future time steps for prediction.
         self.max_context = 512  # Maximum context length for the model.
 
+        # Sequence packing for predictor training: each symbol's series is cut into segments
+        # of up to `max_context + 1` steps, and shorter segments (including short-history
+        # symbols) are packed into shared rows with block-diagonal causal attention.
+        # Note that one sample is then a full row, so `n_train_iter`/`n_val_iter` count rows.
+        self.use_packing = False
+        self.packing_min_length = 32  # Shortest segment kept; also the preprocessing length filter.
+
         # Features to be used from the raw data.
         self.feature_list = ['open', 'high', 'low', 'close', 'vol', 'amt']
         # Time-based features to be generated.
         self.time_feature_list = ['minute', 'hour', 'weekday', 'day', 'month']
 
+        # Preprocessing parallelism. Symbols are loaded from Qlib in chunks; with more
+        # than one worker, chunks are processed in a process pool.
+        self.preprocess_num_workers = 1  # Number of worker processes (1 = in-process).
+        self.preprocess_chunk_size = 100  # Symbols per chunk; bounds the memory held by each worker.
+
         # =================================================================
         # Dataset Splitting & Paths
         # =================================================================
@@ -38,6 +50,10 @@ class Config:
         # TODO: Directory to save the processed, pickled datasets.
         import os
         self.dataset_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data", "processed_datasets"))
+        # Columnar per-symbol store of the full loaded range, used by `--incremental` preprocessing.
+        # Incremental updates stop at `dataset_end_time` (plus `predict_window`), so move it and
+        # the end of `test_time_range` forward to take in new bars.
+        self.dataset_store_path = os.path.join(self.dataset_path, "store")
 
         # =================================================================
         # Training Hyperparameters
@@ -57,21 +73,60 @@ class Config:
         self.tokenizer_learning_rate = 2e-4
         self.predictor_learning_rate = 4e-5
 
-        # Gradient accumulation to simulate a larger batch size.
+        # Gradient accumulation: each batch is split into this many micro-batches to save
+        # memory, so batch_size must be a multiple of it.
         self.accumulation_steps = 1
 
+        # Mixed precision for the predictor: autocast in bf16 on CPU, and fp16 (with
+        # GradScaler) or bf16 on CUDA.
+        self.use_amp = False
+        self.amp_dtype = 'bf16'  # 'bf16' or 'fp16'
+
+        # Activation checkpointing: recompute each transformer block's activations in the
+        # backward pass instead of storing them, trading compute for memory.
+        self.gradient_checkpointing = False
+
+        # Tokenizer training: decode the s1-only and full-codebook inputs in one batched decoder
+        # pass instead of two. Same losses, fewer and larger kernels.
+        self.tokenizer_fused_decoder = False
+
+        # Validation. The fixed validation batches are prepared once (and, for the predictor,
+        # tokenized) and cached for later epochs.
+        self.val_every_n_epochs = 1  # Validate every N epochs; the last epoch always validates.
+        self.val_subsample = None  # If set, validate on this many fixed windows instead of `n_val_iter`.
+        self.val_cache = True
+        self.val_cache_on_device = True  # Set to False to hold the cache in host memory instead.
+        self.val_cache_dir = None  # If set, the cache is also written here and shared by runs with the same data settings.
+        self.prepare_val_cache = False  # Only build (and save) the validation cache, then exit. Used by sweep.py.
+
+        # Step-time instrumentation: per-step data wait, forward, backward, optimizer and
+        # gradient all-reduce times, throughput and peak memory are appended to
+        # `<save_dir>/step_stats_rank<rank>.jsonl`. Timing synchronizes CUDA, so it costs a little speed.
+        self.profile_steps = False
+        self.torch_profiler_steps = 0  # If > 0 (and profile_steps), trace this many steps into `<save_dir>/profiler`.
+
         # AdamW optimizer parameters.
         self.adam_beta1 = 0.9
         self.adam_beta2 = 0.95
         self.adam_weight_decay = 0.1
 
+        # Device for training: 'cuda', 'cpu', or 'auto' (CUDA if available, else CPU).
+        # CPU training runs single-process, or multi-process DDP over gloo via `torchrun`.
+        self.train_device = 'auto'
+        # Intra-op threads per CPU rank; None splits the node's cores evenly across its ranks.
+        self.cpu_threads_per_rank = None
+
         # Miscellaneous
         self.seed = 100  # Global random seed for reproducibility.
 
         # =================================================================
         # Experiment Logging & Saving
         # =================================================================
-        self.use_comet = True # Set to False if you don't want to use Comet ML
+        # Metrics are buffered and written from a background thread. Local backends ('jsonl',
+        # 'csv', 'tensorboard') write to `<save_dir>/logs` and work offline.
+        self.logger_backends = ['jsonl']
+        self.logger_flush_interval = 10.0  # Seconds between background flushes.
+        self.use_comet = False  # Also log to Comet ML (needs `comet_ml` and network access).
         self.comet_config = {
             # It is highly recommended to load secrets from environment variables
             # for security purposes. Example: os.getenv("COMET_API_KEY")
@@ -82,6 +137,12 @@ class Config:
         self.comet_tag = 'finetune_demo'
         self.comet_name = 'finetune_demo'
 
+        # Full training checkpoints (model, optimizer, scheduler, RNG) are written every
+        # epoch from a background thread; the last N plus the best one are kept.
+        self.keep_last_checkpoints = 3
+        self.async_checkpointing = True
+        self.resume = None  # Set by `--resume`: 'latest' or a checkpoint file path.
+
         # Base directory for saving model checkpoints and results.
         # Using a general 'outputs' directory is a common practice.
         self.save_path = "./outputs/models"
@@ -119,9 +180,67 @@ class Config:
         self.inference_top_p = 0.9
         self.inference_top_k = 0
         self.inference_sample_count = 5
-        self.backtest_batch_size = 1000
+        self.backtest_batch_size = 1000  # Largest inference batch in samples (windows x sample_count).
+        self.backtest_grow_after = 20  # Successful batches before inference tries a larger batch again after an OOM.
         self.backtest_benchmark = self._set_benchmark(self.instrument)
 
+        # Signal-quality readout computed while inference runs: daily IC, RankIC, hit rate
+        # and top-minus-bottom quantile spread against the realized forward return.
+        self.signal_eval_horizon = 1  # Bars of forward return, entered on the bar after the signal (also walk_forward.py).
+        self.signal_eval_quantile = 0.2  # Share of the cross-section in each spread bucket.
+        self.signal_eval_abort_after_days = 0  # Stop inference early if RankIC is poor after N days (0 = never).
+        self.signal_eval_min_rank_ic = 0.0  # Minimum running RankIC of the 'mean' signal for that check.
+
+        # =================================================================
+        # Walk-forward Evaluation (walk_forward.py)
+        # =================================================================
+        # Folds of train/val/test months are stepped through this range. Without
+        # `--finetune` every fold uses the fine-tuned models above, so predictions
+        # are cached and each fold only predicts the days no earlier fold covered;
+        # folds whose test months overlap `train_time_range`..`val_time_range` (the
+        # data those models were trained and selected on) are skipped.
+        self.walk_forward_range = ["2019-01-01", "2025-06-05"]
+        self.walk_forward_train_months = 48
+        self.walk_forward_val_months = 6
+        self.walk_forward_test_months = 6
+        self.walk_forward_step_months = 6
+        self.walk_forward_expanding = False  # Keep the train start fixed instead of rolling it.
+
+    def update(self, overrides: dict):
+        """
+        Overrides existing attributes, e.g. for a sweep trial.
+
+        Derived attributes (`n_train_iter`/`n_val_iter`, the fine-tuned model
+        paths and the benchmark) are recomputed when an attribute they depend
+        on changes, unless they are overridden as well. Sweeping `batch_size`
+        thus keeps the number of steps per epoch fixed.
+
+        Args:
+            overrides (dict): Mapping from attribute name to new value.
+
+        Raises:
+            KeyError: If an override names an attribute that does not exist.
+        """
+        unknown = [key for key in overrides if not hasattr(self, key)]
+        if unknown:
+            raise KeyError(f"Unknown config attributes: {unknown}")
+        derived = self._derived_attributes()
+        for key, value in overrides.items():
+            setattr(self, key, value)
+        for key, value in self._derived_attributes().items():
+            if key not in overrides and value != derived[key]:
+                setattr(self, key, value)
+
+    def _derived_attributes(self) -> dict:
+        """Returns the attributes `__init__` derives from others, computed from the current values."""
+        return {
+            'n_train_iter': 2000 * self.batch_size,
+            'n_val_iter': 400 * self.batch_size,
+            'finetuned_tokenizer_path': f"{self.save_path}/{self.tokenizer_save_folder_name}/checkpoints/best_model",
+            'finetuned_predictor_path': f"{self.save_path}/{self.predictor_save_folder_name}/checkpoints/best_model",
+            'backtest_benchmark': self._set_benchmark(self.instrument),
+        }
+
     def _set_benchmark(self, instrument):
         dt_benchmark = {
             'csi800': "SH000906",
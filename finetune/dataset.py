@@ -1,18 +1,43 @@
+import math
 import pickle
-import random
 
 from config import Config
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
+
+from model.window_stats import normalize_window
+
+
+def build_window_index(lengths, window: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Builds the flat (symbol_id, start) index of every valid sliding window.
+
+    Args:
+        lengths (array-like): Series length of each symbol, in symbol order.
+        window (int): Number of time steps in one window.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Two int32 arrays of equal length:
+            - symbol_ids: Position of the window's symbol in `lengths`.
+            - starts: Start offset of the window within its symbol's series.
+    """
+    counts = np.maximum(np.asarray(lengths, dtype=np.int64) - window + 1, 0)
+    total = int(counts.sum())
+    symbol_ids = np.repeat(np.arange(len(counts), dtype=np.int32), counts)
+    # Offset of each symbol's first window in the flat index, broadcast per window.
+    first_window = np.repeat(np.cumsum(counts) - counts, counts)
+    starts = (np.arange(total, dtype=np.int64) - first_window).astype(np.int32)
+    return symbol_ids, starts
 
 
 class QlibDataset(Dataset):
     """
     A PyTorch Dataset for handling Qlib financial time series data.
 
-    This dataset pre-computes all possible start indices for sliding windows
-    and then randomly samples from them during training/validation.
+    This dataset pre-computes all possible start indices for sliding windows.
+    The index passed to `__getitem__` selects one of those windows; which
+    windows are visited in an epoch is decided by a `WindowSampler`.
 
     Args:
         data_type (str): The type of dataset to load, either 'train' or 'val'.
@@ -27,10 +52,6 @@ class QlibDataset(Dataset):
             raise ValueError("data_type must be 'train' or 'val'")
         self.data_type = data_type
 
-        # Use a dedicated random number generator for sampling to avoid
-        # interfering with other random processes (e.g., in model initialization).
-        self.py_rng = random.Random(self.config.seed)
-
         # Set paths and number of samples based on the data type.
         # 使用绝对路径
         import os
@@ -42,52 +63,58 @@ class QlibDataset(Dataset):
             self.n_samples = self.config.n_val_iter
 
         with open(self.data_path, 'rb') as f:
-            self.data = pickle.load(f)
+            raw_data = pickle.load(f)
 
         self.window = self.config.lookback_window + self.config.predict_window + 1
 
-        self.symbols = list(self.data.keys())
         self.feature_list = self.config.feature_list
         self.time_feature_list = self.config.time_feature_list
 
-        # Pre-compute all possible (symbol, start_index) pairs.
-        self.indices = []
+        # Keep only symbols long enough to yield at least one sample.
+        min_length = self._min_series_length()
+        self.symbols = [symbol for symbol, df in raw_data.items() if len(df) >= min_length]
+        features, time_features = [], []
         print(f"[{data_type.upper()}] Pre-computing sample indices...")
         for symbol in self.symbols:
-            df = self.data[symbol].reset_index()
-            series_len = len(df)
-            num_samples = series_len - self.window + 1
-
-            if num_samples > 0:
-                # Generate time features from the datetime column (reset_index creates 'timestamps' column)
-                datetime_col = 'timestamps' if 'timestamps' in df.columns else df.columns[0]
-                df['minute'] = df[datetime_col].dt.minute
-                df['hour'] = df[datetime_col].dt.hour
-                df['weekday'] = df[datetime_col].dt.weekday
-                df['day'] = df[datetime_col].dt.day
-                df['month'] = df[datetime_col].dt.month
-                # Keep only necessary columns to save memory.
-                self.data[symbol] = df[self.feature_list + self.time_feature_list]
-
-                # Add all valid starting indices for this symbol to the global list.
-                for i in range(num_samples):
-                    self.indices.append((symbol, i))
+            df = raw_data[symbol].reset_index()
+            # Generate time features from the datetime column (reset_index creates 'timestamps' column)
+            datetime_col = 'timestamps' if 'timestamps' in df.columns else df.columns[0]
+            df['minute'] = df[datetime_col].dt.minute
+            df['hour'] = df[datetime_col].dt.hour
+            df['weekday'] = df[datetime_col].dt.weekday
+            df['day'] = df[datetime_col].dt.day
+            df['month'] = df[datetime_col].dt.month
+            # Convert once to float32 so windows can be sliced without pandas overhead.
+            features.append(df[self.feature_list].values.astype(np.float32))
+            time_features.append(df[self.time_feature_list].values.astype(np.float32))
+        del raw_data
+
+        # All symbols are concatenated into two flat arrays; `self.offsets` holds the
+        # row at which each symbol's series begins.
+        lengths = np.array([len(f) for f in features], dtype=np.int64)
+        self.lengths = lengths
+        self.offsets = np.cumsum(lengths) - lengths
+        self.features = np.concatenate(features) if features else np.empty((0, len(self.feature_list)), dtype=np.float32)
+        self.time_features = np.concatenate(time_features) if time_features else np.empty((0, len(self.time_feature_list)), dtype=np.float32)
+        del features, time_features
+        self._window_range = np.arange(self.window, dtype=np.int64)
+
+        # All valid (symbol_id, start_index) pairs, stored as two flat int32 arrays.
+        self.symbol_ids, self.starts = build_window_index(lengths, self.window)
 
         # The effective dataset size is the minimum of the configured iterations
         # and the total number of available samples.
-        self.n_samples = min(self.n_samples, len(self.indices))
-        print(f"[{data_type.upper()}] Found {len(self.indices)} possible samples. Using {self.n_samples} per epoch.")
+        self.n_samples = min(self.n_samples, len(self.starts))
+        print(f"[{data_type.upper()}] Found {len(self.starts)} possible samples. Using {self.n_samples} per epoch.")
 
-    def set_epoch_seed(self, epoch: int):
-        """
-        Sets a new seed for the random sampler for each epoch. This is crucial
-        for reproducibility in distributed training.
+    def _min_series_length(self) -> int:
+        """Returns the shortest symbol series that is kept."""
+        return self.window
 
-        Args:
-            epoch (int): The current epoch number.
-        """
-        epoch_seed = self.config.seed + epoch
-        self.py_rng.seed(epoch_seed)
+    @property
+    def num_windows(self) -> int:
+        """Returns the total number of windows available for sampling."""
+        return len(self.starts)
 
     def __len__(self) -> int:
         """Returns the number of samples per epoch."""
@@ -95,43 +122,277 @@ class QlibDataset(Dataset):
 
     def __getitem__(self, idx: int) -> tuple[torch.Tensor, torch.Tensor]:
         """
-        Retrieves a random sample from the dataset.
-
-        Note: The `idx` argument is ignored. Instead, a random index is drawn
-        from the pre-computed `self.indices` list using `self.py_rng`. This
-        ensures random sampling over the entire dataset for each call.
+        Retrieves the window at position `idx` of the pre-computed index arrays.
 
         Args:
-            idx (int): Ignored.
+            idx (int): Window index in `[0, self.num_windows)`, usually drawn by
+                a `WindowSampler`.
 
         Returns:
             tuple[torch.Tensor, torch.Tensor]: A tuple containing:
                 - x_tensor (torch.Tensor): The normalized feature tensor.
                 - x_stamp_tensor (torch.Tensor): The time feature tensor.
         """
-        # Select a random sample from the entire pool of indices.
-        random_idx = self.py_rng.randint(0, len(self.indices) - 1)
-        symbol, start_idx = self.indices[random_idx]
+        symbol_id = self.symbol_ids[idx]
+        row = self.offsets[symbol_id] + self.starts[idx]
+
+        # Slice the window directly from the pre-converted float32 arrays.
+        x = self._normalize(self.features[row:row + self.window])
+        x_stamp = self.time_features[row:row + self.window]
+
+        return torch.from_numpy(x), torch.from_numpy(x_stamp)
+
+    def __getitems__(self, indices: list[int]) -> list[tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Retrieves a whole batch of windows at once.
+
+        The DataLoader calls this instead of `__getitem__` when it is defined,
+        so windows are gathered with a single fancy-indexing op and normalized
+        in one vectorized pass over the batch.
+
+        Args:
+            indices (list[int]): Window indices in `[0, self.num_windows)`.
+
+        Returns:
+            list[tuple[torch.Tensor, torch.Tensor]]: One (x, x_stamp) pair per
+                sample, as views into the batched tensors so the default collate
+                function can stack them.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        symbol_ids = self.symbol_ids[indices]
+        starts = self.offsets[symbol_ids] + self.starts[indices]
+        rows = starts[:, None] + self._window_range
+
+        x = torch.from_numpy(self._normalize(self.features[rows]))
+        x_stamp = torch.from_numpy(self.time_features[rows])
+        return list(zip(x.unbind(0), x_stamp.unbind(0)))
+
+    def _normalize(self, x: np.ndarray) -> np.ndarray:
+        """
+        Instance-level normalization over the time axis, then clipping.
+
+        `x` holds one window or a batch of windows. Training windows are drawn
+        at random, so their statistics are computed on the gathered batch
+        rather than looked up from per-row prefix sums, which would cost far
+        more memory than the features themselves in every DataLoader worker.
+        """
+        x_mean, x_std = x.mean(axis=-2, keepdims=True), x.std(axis=-2, keepdims=True)
+        return normalize_window(x, x_mean, x_std, self.config.clip)
+
+
+class PackedQlibDataset(QlibDataset):
+    """
+    A `QlibDataset` variant that packs variable-length windows into fixed rows.
+
+    Each symbol's series is cut into consecutive segments of up to
+    `max_context + 1` time steps. Segments shorter than that (series tails and
+    short-history symbols) are kept as long as they have at least
+    `packing_min_length` steps, and are packed together into shared rows with
+    first-fit decreasing. Every row comes with per-step segment ids (0 marks
+    padding), which the model uses for block-diagonal causal attention and the
+    training loop uses to mask the loss at padding and segment boundaries.
+
+    The index passed to `__getitem__` selects a packed row, so a `WindowSampler`
+    can be used unchanged.
+
+    Args:
+        data_type (str): The type of dataset to load, either 'train' or 'val'.
+    """
+
+    def __init__(self, data_type: str = 'train'):
+        super().__init__(data_type)
+        self.row_length = self.config.max_context + 1
+
+        # Cut every series into consecutive segments of at most `row_length` steps.
+        n_segments = -(-self.lengths // self.row_length)
+        segment_symbols = np.repeat(np.arange(len(self.lengths), dtype=np.int64), n_segments)
+        first_segment = np.repeat(np.cumsum(n_segments) - n_segments, n_segments)
+        segment_starts = (np.arange(int(n_segments.sum()), dtype=np.int64) - first_segment) * self.row_length
+        segment_lengths = np.minimum(self.row_length, self.lengths[segment_symbols] - segment_starts)
+
+        keep = segment_lengths >= self.config.packing_min_length
+        self.segment_rows = self.offsets[segment_symbols[keep]] + segment_starts[keep]
+        self.segment_lengths = segment_lengths[keep]
+
+        # Packed rows as a CSR-style index: row i holds segments
+        # `row_segments[row_ptr[i]:row_ptr[i + 1]]`.
+        rows = self._pack(self.segment_lengths, self.row_length)
+        self.row_ptr = np.cumsum([0] + [len(row) for row in rows], dtype=np.int64)
+        self.row_segments = np.array([s for row in rows for s in row], dtype=np.int64)
+
+        n_iter = self.config.n_train_iter if data_type == 'train' else self.config.n_val_iter
+        self.n_samples = min(n_iter, len(rows))
+        n_tokens = int(self.segment_lengths.sum())
+        print(f"[{data_type.upper()}] Packed {len(self.segment_lengths)} segments ({n_tokens} steps) into "
+              f"{len(rows)} rows of {self.row_length} ({n_tokens / max(len(rows) * self.row_length, 1):.1%} filled). "
+              f"Using {self.n_samples} per epoch.")
+
+    def _min_series_length(self) -> int:
+        """Short-history symbols are kept down to `packing_min_length` steps."""
+        return min(self.window, self.config.packing_min_length)
+
+    @staticmethod
+    def _pack(segment_lengths: np.ndarray, capacity: int) -> list[list[int]]:
+        """
+        Packs segments into rows of `capacity` steps with first-fit decreasing.
+
+        Full-length segments fill a row on their own; only the (at most one per
+        symbol) shorter segments go through the first-fit search.
+
+        Args:
+            segment_lengths (np.ndarray): Length of every segment.
+            capacity (int): Number of steps in one row.
+
+        Returns:
+            list[list[int]]: Segment ids of every row.
+        """
+        full = np.flatnonzero(segment_lengths >= capacity)
+        rows = [[int(s)] for s in full]
+
+        partial = np.flatnonzero(segment_lengths < capacity)
+        partial = partial[np.argsort(-segment_lengths[partial], kind='stable')]
+        open_rows, free = [], []
+        for s in partial:
+            length = segment_lengths[s]
+            for i, space in enumerate(free):
+                if space >= length:
+                    open_rows[i].append(int(s))
+                    free[i] -= length
+                    break
+            else:
+                open_rows.append([int(s)])
+                free.append(capacity - length)
+        return rows + open_rows
+
+    @property
+    def num_windows(self) -> int:
+        """Returns the total number of packed rows available for sampling."""
+        return len(self.row_ptr) - 1
+
+    def __getitem__(self, idx: int) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Assembles packed row `idx`.
+
+        Args:
+            idx (int): Row index in `[0, self.num_windows)`.
+
+        Returns:
+            tuple[torch.Tensor, torch.Tensor, torch.Tensor]: A tuple containing:
+                - x_tensor (torch.Tensor): The features of `max_context + 1` steps,
+                  normalized per segment. Padding steps are zero.
+                - x_stamp_tensor (torch.Tensor): The time features.
+                - segment_ids (torch.Tensor): int64 segment id of every step,
+                  1-based within the row, 0 for padding.
+        """
+        x = np.zeros((self.row_length, len(self.feature_list)), dtype=np.float32)
+        x_stamp = np.zeros((self.row_length, len(self.time_feature_list)), dtype=np.float32)
+        segment_ids = np.zeros(self.row_length, dtype=np.int64)
+
+        pos = 0
+        for segment_id, s in enumerate(self.row_segments[self.row_ptr[idx]:self.row_ptr[idx + 1]], start=1):
+            row, length = self.segment_rows[s], self.segment_lengths[s]
+            x[pos:pos + length] = self._normalize(self.features[row:row + length])
+            x_stamp[pos:pos + length] = self.time_features[row:row + length]
+            segment_ids[pos:pos + length] = segment_id
+            pos += length
+
+        return torch.from_numpy(x), torch.from_numpy(x_stamp), torch.from_numpy(segment_ids)
+
+    def __getitems__(self, indices: list[int]) -> list[tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+        """Rows hold a varying number of segments, so they are assembled one by one."""
+        return [self[idx] for idx in indices]
+
+
+def packed_loss_mask(segment_ids: torch.Tensor) -> torch.Tensor:
+    """
+    Builds the loss padding mask for next-step targets of packed rows.
+
+    The input at step t predicts the token at step t + 1, which is only a valid
+    target if both steps belong to the same (non-padding) segment.
+
+    Args:
+        segment_ids (torch.Tensor): Segment ids of the full rows. Shape: [batch, seq_len + 1]
+
+    Returns:
+        torch.Tensor: Boolean mask of shape [batch, seq_len], True where the
+            target must be ignored. Pass it as `padding_mask` to `compute_loss`.
+    """
+    inputs, targets = segment_ids[:, :-1], segment_ids[:, 1:]
+    return (inputs != targets) | (inputs == 0)
+
+
+class WindowSampler(Sampler[int]):
+    """
+    Epoch-level permutation sampler over the windows of a `QlibDataset`
+    (or the packed rows of a `PackedQlibDataset`).
+
+    Every epoch draws `len(dataset)` distinct windows from a seeded permutation
+    of all `dataset.num_windows` windows and gives each rank a disjoint,
+    strided shard of them. The DataLoader hands disjoint batches of these
+    indices to its workers, so no window is repeated across ranks or workers
+    within an epoch.
+
+    Args:
+        dataset (QlibDataset): The dataset to sample from.
+        num_replicas (int): Number of distributed ranks.
+        rank (int): Rank of the current process.
+        shuffle (bool): If True, a new permutation is drawn every epoch (see
+            `set_epoch`). If False, the same windows are used every epoch,
+            which keeps validation losses comparable.
+        seed (int): Base seed shared by all ranks.
+        drop_last (bool): If True, drop the tail so that every rank gets the
+            same number of samples without padding. Otherwise the tail is
+            padded by wrapping around.
+    """
+
+    def __init__(self, dataset: QlibDataset, num_replicas: int = 1, rank: int = 0,
+                 shuffle: bool = True, seed: int = 0, drop_last: bool = False):
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"Invalid rank {rank}, rank should be in the interval [0, {num_replicas - 1}]")
+        self.num_windows = dataset.num_windows
+        self.n_samples = len(dataset)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        if self.drop_last:
+            self.num_samples = self.n_samples // self.num_replicas
+        else:
+            self.num_samples = math.ceil(self.n_samples / self.num_replicas)
+        self.total_size = self.num_samples * self.num_replicas
+
+    def set_epoch(self, epoch: int):
+        """
+        Sets the epoch used to seed the next permutation.
 
-        # Extract the sliding window from the dataframe.
-        df = self.data[symbol]
-        end_idx = start_idx + self.window
-        win_df = df.iloc[start_idx:end_idx]
+        Args:
+            epoch (int): The current epoch number.
+        """
+        self.epoch = epoch
 
-        # Separate main features and time features.
-        x = win_df[self.feature_list].values.astype(np.float32)
-        x_stamp = win_df[self.time_feature_list].values.astype(np.float32)
+    def __iter__(self):
+        if self.n_samples == self.num_windows and not self.shuffle:
+            indices = np.arange(self.num_windows, dtype=np.int64)
+        else:
+            epoch_seed = self.seed + self.epoch if self.shuffle else self.seed
+            rng = np.random.default_rng(epoch_seed)
+            indices = rng.permutation(self.num_windows)[:self.n_samples]
+            if not self.shuffle:
+                # Visit the fixed subset in storage order for better locality.
+                indices.sort()
 
-        # Perform instance-level normalization.
-        x_mean, x_std = np.mean(x, axis=0), np.std(x, axis=0)
-        x = (x - x_mean) / (x_std + 1e-5)
-        x = np.clip(x, -self.config.clip, self.config.clip)
+        if self.drop_last:
+            indices = indices[:self.total_size]
+        elif len(indices) < self.total_size:
+            indices = np.resize(indices, self.total_size)
 
-        # Convert to PyTorch tensors.
-        x_tensor = torch.from_numpy(x)
-        x_stamp_tensor = torch.from_numpy(x_stamp)
+        return iter(indices[self.rank:self.total_size:self.num_replicas].tolist())
 
-        return x_tensor, x_stamp_tensor
+    def __len__(self) -> int:
+        return self.num_samples
 
 
 if __name__ == '__main__':
@@ -142,7 +403,7 @@ if __name__ == '__main__':
     print(f"Dataset length: {len(train_dataset)}")
 
     if len(train_dataset) > 0:
-        try_x, try_x_stamp = train_dataset[100]  # Index 100 is ignored.
+        try_x, try_x_stamp = train_dataset[next(iter(WindowSampler(train_dataset)))]
         print(f"Sample feature shape: {try_x.shape}")
         print(f"Sample time feature shape: {try_x_stamp.shape}")
     else:
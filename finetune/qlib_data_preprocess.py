@@ -1,16 +1,78 @@
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import os
 import pickle
 
 from config import Config
 import numpy as np
 import pandas as pd
-from tqdm import trange
+from tqdm import tqdm, trange
 
 import qlib
 from qlib.config import REG_CN
 from qlib.data import D
 from qlib.data.dataset.loader import QlibDataLoader
 
+from utils.columnar_store import SymbolStore
+
+
+def _init_qlib_worker(provider_uri: str):
+    """Initializes Qlib inside a preprocessing worker process."""
+    # Each worker already owns one symbol chunk, so Qlib's own parallelism is disabled
+    # to avoid oversubscribing the cores.
+    qlib.init(provider_uri=provider_uri, region=REG_CN, freq='day', kernels=1)
+
+
+def _in_spans(index: pd.DatetimeIndex, spans: list) -> np.ndarray:
+    """Returns a mask of the dates in `index` that fall inside any of the `(start, end)` spans."""
+    mask = np.zeros(len(index), dtype=bool)
+    for start, end in spans:
+        mask |= (index >= pd.Timestamp(start)) & (index <= pd.Timestamp(end))
+    return mask
+
+
+def _process_symbol_frame(data_df: pd.DataFrame, data_fields: list, feature_list: list, min_length: int,
+                          spans: dict) -> dict:
+    """
+    Converts a raw Qlib frame into per-symbol feature DataFrames.
+
+    Args:
+        data_df (pd.DataFrame): Frame indexed by (datetime, instrument) with one
+            `$field` column per entry of `data_fields`.
+        data_fields (list): Raw Qlib field names, without the `$` prefix.
+        feature_list (list): Final feature columns to keep.
+        min_length (int): Symbols with fewer valid rows than this are dropped.
+        spans (dict): Mapping from symbol to the `(start, end)` spans it was part of
+            the market. Rows outside them are dropped, as Qlib does when loading by
+            market name.
+
+    Returns:
+        dict: A mapping from symbol to its DataFrame indexed by datetime.
+    """
+    # Derive the features for the whole chunk at once instead of per symbol.
+    data_df = data_df.rename(columns={f'${field}': field for field in data_fields})
+    data_df['vol'] = data_df['volume']
+    data_df['amt'] = (data_df['open'] + data_df['high'] + data_df['low'] + data_df['close']) / 4 * data_df['vol']
+    data_df = data_df[feature_list].dropna()
+
+    symbol_data = {}
+    for symbol, symbol_df in data_df.groupby(level='instrument'):
+        symbol_df = symbol_df.droplevel('instrument').sort_index()
+        symbol_df = symbol_df[_in_spans(symbol_df.index, spans.get(symbol, []))]
+        # Filter out symbols with insufficient data.
+        if len(symbol_df) < min_length:
+            continue
+        symbol_data[symbol] = symbol_df
+    return symbol_data
+
+
+def _load_symbol_chunk(spans: dict, data_fields: list, feature_list: list, min_length: int,
+                       start_time, end_time) -> dict:
+    """Loads one chunk of symbols from Qlib and processes it (see `_process_symbol_frame`)."""
+    data_df = QlibDataLoader(config=['$' + f for f in data_fields]).load(list(spans), start_time, end_time)
+    return _process_symbol_frame(data_df, data_fields, feature_list, min_length, spans)
+
 
 class QlibDataPreprocessor:
     """
@@ -27,28 +89,19 @@ class QlibDataPreprocessor:
         """Initializes the Qlib environment."""
         print("Initializing Qlib...")
         # 确保使用绝对路径 - 从 finetune 目录回到项目根目录
-        import os
-        abs_data_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", self.config.qlib_data_path))
-        print(f"Using data path: {abs_data_path}")
+        self.abs_data_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", self.config.qlib_data_path))
+        print(f"Using data path: {self.abs_data_path}")
 
         # 初始化 qlib 并指定频率
         qlib.init(
-            provider_uri=abs_data_path,
+            provider_uri=self.abs_data_path,
             region=REG_CN,
             freq='day',  # 明确指定频率
-            # 减少并行处理以避免内存问题
-            joblib_backend='threading',  # 使用线程而不是进程
-            n_jobs=1  # 限制并行作业数量
+            kernels=self.config.preprocess_num_workers,
         )
 
-    def load_qlib_data(self):
-        """
-        Loads raw data from Qlib, processes it symbol by symbol, and stores
-        it in the `self.data` attribute.
-        """
-        print("Loading and processing data from Qlib...")
-        data_fields_qlib = ['$' + f for f in self.data_fields]
-
+    def load_calendar(self) -> np.ndarray:
+        """Loads the daily trading calendar from Qlib."""
         try:
             # 尝试获取日历数据
             cal: np.ndarray = D.calendar()
@@ -62,7 +115,33 @@ class QlibDataPreprocessor:
             except Exception as e2:
                 print(f"Failed to load calendar even with explicit frequency: {e2}")
                 raise e2
+        return cal
+
+    def load_qlib_data(self):
+        """
+        Loads raw data from Qlib in chunks of symbols, processes each chunk with
+        vectorized DataFrame ops, and stores the result in the `self.data` attribute.
+
+        With `preprocess_num_workers > 1`, chunks are loaded and processed in a
+        process pool; each worker only holds one chunk of
+        `preprocess_chunk_size` symbols at a time.
+        """
+        print("Loading and processing data from Qlib...")
+        real_start_time, real_end_time = self.load_time_range(self.load_calendar())
+
+        print(f"Loading data from {real_start_time} to {real_end_time}")
+        print(f"Using instrument: {self.config.instrument}")
 
+        spans = self.list_symbol_spans(real_start_time, real_end_time)
+        min_length = self.min_symbol_length()
+        self.data.update(self.load_symbols(spans, real_start_time, real_end_time, min_length))
+        print(f"Loaded {len(self.data)} of {len(spans)} symbols with sufficient data.")
+
+    def load_time_range(self, cal: np.ndarray) -> tuple:
+        """
+        Returns the first and last calendar day to load: `dataset_begin_time` to
+        `dataset_end_time`, widened by the lookback and predict windows.
+        """
         # Determine the actual start and end times to load, including buffer for lookback and predict windows.
         start_index = cal.searchsorted(pd.Timestamp(self.config.dataset_begin_time))
         end_index = cal.searchsorted(pd.Timestamp(self.config.dataset_end_time))
@@ -80,82 +159,232 @@ class QlibDataPreprocessor:
         # Check if end_index+predictw_window will exceed the range of the array
         adjusted_end_index = min(end_index + self.config.predict_window, len(cal) - 1)
         real_end_time = cal[adjusted_end_index]
+        return real_start_time, real_end_time
 
-        # Load data using Qlib's data loader with reduced memory usage
-        print(f"Loading data from {real_start_time} to {real_end_time}")
-        print(f"Using instrument: {self.config.instrument}")
-
-        # 分批加载数据以减少内存使用
-        data_df = QlibDataLoader(config=data_fields_qlib).load(
-            self.config.instrument, real_start_time, real_end_time
+    def list_symbol_spans(self, start_time, end_time) -> dict:
+        """
+        Returns a mapping from every symbol of `config.instrument` between
+        `start_time` and `end_time` to the `(start, end)` spans during which it was in that market.
+        """
+        return D.list_instruments(
+            D.instruments(self.config.instrument), start_time=start_time, end_time=end_time, as_list=False
         )
-        data_df = data_df.stack().unstack(level=1)  # Reshape for easier access.
 
-        symbol_list = list(data_df.columns)
-        for i in trange(len(symbol_list), desc="Processing Symbols"):
-            symbol = symbol_list[i]
-            symbol_df = data_df[symbol]
+    def min_symbol_length(self) -> int:
+        """
+        Returns the shortest symbol history kept by preprocessing.
+
+        That is one full sliding window, or one packed segment when sequence
+        packing is enabled, so short-history symbols stay available for it.
+        """
+        window = self.config.lookback_window + self.config.predict_window + 1
+        if self.config.use_packing:
+            return min(window, self.config.packing_min_length)
+        return window
 
-            # Pivot the table to have features as columns and datetime as index.
-            symbol_df = symbol_df.reset_index().rename(columns={'level_1': 'field'})
-            symbol_df = pd.pivot(symbol_df, index='datetime', columns='field', values=symbol)
-            symbol_df = symbol_df.rename(columns={f'${field}': field for field in self.data_fields})
+    def load_symbols(self, spans: dict, start_time, end_time, min_length: int) -> dict:
+        """
+        Loads and processes the given symbols between `start_time` and `end_time`.
+
+        Loading an explicit symbol list returns each symbol's full history, so
+        every symbol is masked to its own market spans afterwards; the result
+        matches loading `config.instrument` by name.
+
+        Args:
+            spans (dict): Symbols to load, mapped to their market spans
+                (see `list_symbol_spans`).
+            start_time: First bar to load (inclusive).
+            end_time: Last bar to load (inclusive).
+            min_length (int): Symbols with fewer valid bars are dropped.
+
+        Returns:
+            dict: A mapping from symbol to its DataFrame indexed by datetime.
+        """
+        symbol_list = list(spans)
+        chunk_size = self.config.preprocess_chunk_size
+        chunks = [{symbol: spans[symbol] for symbol in symbol_list[i:i + chunk_size]}
+                  for i in range(0, len(symbol_list), chunk_size)]
+        chunk_args = (self.data_fields, self.config.feature_list, min_length, start_time, end_time)
+
+        data = {}
+        num_workers = min(self.config.preprocess_num_workers, len(chunks))
+        if num_workers > 1:
+            print(f"Processing {len(symbol_list)} symbols in {len(chunks)} chunks with {num_workers} worker processes")
+            with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_qlib_worker,
+                                     initargs=(self.abs_data_path,)) as pool:
+                futures = [pool.submit(_load_symbol_chunk, chunk, *chunk_args) for chunk in chunks]
+                for future in tqdm(futures, desc="Processing Symbol Chunks"):
+                    data.update(future.result())
+        else:
+            for chunk in tqdm(chunks, desc="Processing Symbol Chunks"):
+                data.update(_load_symbol_chunk(chunk, *chunk_args))
+        return data
 
-            # Calculate amount and select final features.
-            symbol_df['vol'] = symbol_df['volume']
-            symbol_df['amt'] = (symbol_df['open'] + symbol_df['high'] + symbol_df['low'] + symbol_df['close']) / 4 * symbol_df['vol']
-            symbol_df = symbol_df[self.config.feature_list]
+    def save_store(self):
+        """Writes the loaded data to the columnar symbol store used by incremental updates."""
+        store = SymbolStore(self.config.dataset_store_path, self.config.feature_list)
+        for symbol, symbol_df in tqdm(self.data.items(), desc="Writing Symbol Store"):
+            store.write(symbol, symbol_df)
+        store.save_manifest()
+        print(f"Symbol store with {len(store.symbols)} symbols saved to {store.root}")
+
+    def update_incremental(self):
+        """
+        Appends only the bars that are newer than each symbol's last stored bar.
 
-            # Filter out symbols with insufficient data.
-            symbol_df = symbol_df.dropna()
-            if len(symbol_df) < self.config.lookback_window + self.config.predict_window + 1:
+        New bars are loaded from Qlib up to `dataset_end_time` plus the predict
+        window, the same range a full build covers, and appended to the
+        columnar store; only the symbols that receive new bars are read
+        back and checked against their manifest checksum. Symbols that joined
+        the universe (or whose store file fails its checksum) are loaded with
+        their full history. Symbols still shorter than `min_symbol_length` are
+        recorded in the manifest and only reloaded once enough trading days
+        have passed for them to reach it. Only the train/val/test splits whose
+        time range overlaps the new bars are rebuilt. Falls back to a full
+        build if no store exists yet.
+
+        For a rolling daily refresh, move `dataset_end_time` and the end of
+        `test_time_range` forward in `Config`; bars past `dataset_end_time`
+        belong to no split and are not loaded.
+        """
+        store = SymbolStore(self.config.dataset_store_path, self.config.feature_list)
+        if not store.exists():
+            print("No symbol store found, running a full build...")
+            self.load_qlib_data()
+            self.save_store()
+            self.prepare_dataset()
+            return
+
+        cal = self.load_calendar()
+        begin_time, end_time = self.load_time_range(cal)
+        cal = cal[:cal.searchsorted(end_time, side='right')]
+        last_dates = store.last_dates()
+        # Symbols still in the market since the oldest stored bar, with their spans over the whole range.
+        symbol_list = list(self.list_symbol_spans(min(last_dates.values(), default=begin_time), end_time))
+        spans = self.list_symbol_spans(begin_time, end_time)
+        min_length = self.min_symbol_length()
+
+        # Group existing symbols by last stored bar so each group is loaded from its own start date.
+        groups, new_symbols = defaultdict(list), []
+        skipped = store.skipped_symbols()
+        for symbol in symbol_list:
+            if symbol in last_dates:
+                groups[last_dates[symbol]].append(symbol)
+            elif symbol in skipped:
+                # A short symbol gains at most one bar per trading day, so skip it until it can be long enough.
+                entry = skipped[symbol]
+                new_days = len(cal) - cal.searchsorted(pd.Timestamp(entry['checked']), side='right')
+                if entry['rows'] + new_days >= min_length:
+                    new_symbols.append(symbol)
+            else:
+                new_symbols.append(symbol)
+
+        # Date range of the bars added for each updated symbol.
+        changed_ranges = []
+        for last_date, symbols in groups.items():
+            next_index = cal.searchsorted(last_date, side='right')
+            if next_index >= len(cal):
                 continue
+            group_spans = {symbol: spans[symbol] for symbol in symbols}
+            for symbol, new_df in self.load_symbols(group_spans, cal[next_index], end_time, min_length=1).items():
+                try:
+                    appended = store.append(symbol, new_df)
+                except (OSError, ValueError) as e:
+                    print(f"Reloading {symbol} with full history: {e}")
+                    new_symbols.append(symbol)
+                    continue
+                if appended > 0:
+                    changed_ranges.append((new_df.index[0], new_df.index[-1]))
+
+        if new_symbols:
+            print(f"Loading full history for {len(new_symbols)} new symbols...")
+            # Load without the length filter so short symbols can be recorded with their row count.
+            loaded = self.load_symbols({symbol: spans[symbol] for symbol in new_symbols}, begin_time, end_time,
+                                       min_length=1)
+            num_skipped = 0
+            for symbol in new_symbols:
+                symbol_df = loaded.get(symbol)
+                rows = 0 if symbol_df is None else len(symbol_df)
+                if rows < min_length:
+                    store.mark_skipped(symbol, end_time, rows)
+                    num_skipped += 1
+                    continue
+                store.write(symbol, symbol_df)
+                changed_ranges.append((symbol_df.index[0], symbol_df.index[-1]))
+            if num_skipped:
+                print(f"Skipped {num_skipped} symbols with fewer than {min_length} bars.")
+        store.save_manifest()
+
+        if not changed_ranges:
+            print(f"Symbol store is already up to date with dataset_end_time {self.config.dataset_end_time}.")
+            return
+        print(f"Updated {len(changed_ranges)} symbols up to {end_time}.")
+
+        # Only rebuild splits whose time range overlaps the new bars.
+        affected_splits = [
+            name for name, (split_start, split_end) in self.split_ranges().items()
+            if any(first <= pd.Timestamp(split_end) and last >= pd.Timestamp(split_start) for first, last in changed_ranges)
+        ]
+        if not affected_splits:
+            print("New bars fall outside all configured split ranges; datasets left unchanged.")
+            return
 
-            self.data[symbol] = symbol_df
+        self.data = store.read_all()
+        self.prepare_dataset(splits=affected_splits)
 
-    def prepare_dataset(self):
+    def split_ranges(self) -> dict:
+        """Returns the configured [start, end] time range of each dataset split."""
+        return {
+            'train': self.config.train_time_range,
+            'val': self.config.val_time_range,
+            'test': self.config.test_time_range,
+        }
+
+    def prepare_dataset(self, splits: list = None):
         """
         Splits the loaded data into train, validation, and test sets and saves them to disk.
+
+        Args:
+            splits (list, optional): Names of the splits to write, any of 'train',
+                'val' and 'test'. Defaults to all three.
         """
         print("Splitting data into train, validation, and test sets...")
-        train_data, val_data, test_data = {}, {}, {}
+        split_ranges = self.split_ranges()
+        if splits is None:
+            splits = list(split_ranges)
+        split_data = {name: {} for name in splits}
 
         symbol_list = list(self.data.keys())
         for i in trange(len(symbol_list), desc="Preparing Datasets"):
             symbol = symbol_list[i]
             symbol_df = self.data[symbol]
 
-            # Define time ranges from config.
-            train_start, train_end = self.config.train_time_range
-            val_start, val_end = self.config.val_time_range
-            test_start, test_end = self.config.test_time_range
-
-            # Create boolean masks for each dataset split.
-            train_mask = (symbol_df.index >= train_start) & (symbol_df.index <= train_end)
-            val_mask = (symbol_df.index >= val_start) & (symbol_df.index <= val_end)
-            test_mask = (symbol_df.index >= test_start) & (symbol_df.index <= test_end)
-
-            # Apply masks to create the final datasets.
-            train_data[symbol] = symbol_df[train_mask]
-            val_data[symbol] = symbol_df[val_mask]
-            test_data[symbol] = symbol_df[test_mask]
+            # Create a boolean mask for each dataset split and apply it.
+            for name in splits:
+                split_start, split_end = split_ranges[name]
+                split_mask = (symbol_df.index >= split_start) & (symbol_df.index <= split_end)
+                split_data[name][symbol] = symbol_df[split_mask]
 
         # Save the datasets using pickle.
         os.makedirs(self.config.dataset_path, exist_ok=True)
-        with open(f"{self.config.dataset_path}/train_data.pkl", 'wb') as f:
-            pickle.dump(train_data, f)
-        with open(f"{self.config.dataset_path}/val_data.pkl", 'wb') as f:
-            pickle.dump(val_data, f)
-        with open(f"{self.config.dataset_path}/test_data.pkl", 'wb') as f:
-            pickle.dump(test_data, f)
-
-        print("Datasets prepared and saved successfully.")
+        for name in splits:
+            with open(f"{self.config.dataset_path}/{name}_data.pkl", 'wb') as f:
+                pickle.dump(split_data[name], f)
 
+        print(f"Datasets prepared and saved successfully: {', '.join(splits)}.")
 
 if __name__ == '__main__':
     # This block allows the script to be run directly to perform data preprocessing.
+    parser = argparse.ArgumentParser(description="Preprocess Qlib data into train/val/test datasets")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Append only new bars to the symbol store and rebuild the affected splits")
+    args = parser.parse_args()
+
     preprocessor = QlibDataPreprocessor()
     preprocessor.initialize_qlib()
-    preprocessor.load_qlib_data()
-    preprocessor.prepare_dataset()
-
+    if args.incremental:
+        preprocessor.update_incremental()
+    else:
+        preprocessor.load_qlib_data()
+        preprocessor.save_store()
+        preprocessor.prepare_dataset()
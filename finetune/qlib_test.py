@@ -1,8 +1,11 @@
 import argparse
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import gc
+import json
+import multiprocessing as mp
 import os
 import pickle
+import shutil
 import sys
 import warnings
 
@@ -18,10 +21,11 @@ except ImportError:
     print("⚠ 未找到gymnasium，建议安装: pip install gymnasium[classic_control]")
 
 from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
 import numpy as np
 import pandas as pd
 import torch
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import Dataset
 from tqdm import tqdm
 
 import qlib
@@ -38,13 +42,20 @@ sys.path.insert(0, project_root)
 sys.path.insert(0, current_dir)
 
 from config import Config
+from dataset import build_window_index
 from model.kronos import Kronos, KronosTokenizer, auto_regressive_inference
+from model.window_stats import RollingWindowStats, normalize_window
+from utils.columnar_store import load_signals, save_signals, signals_to_frames
+from utils.signal_metrics import PoorSignalError, StreamingSignalEvaluator, forward_returns
 
 # 内存优化设置
 torch.backends.cudnn.benchmark = False  # 减少内存使用
 if torch.cuda.is_available():
     torch.cuda.empty_cache()  # 清理GPU内存
 
+# Signal types derived from the predicted close prices, see `predict_signals`.
+SIGNAL_TYPES = ('last', 'mean', 'max', 'min')
+
 # =================================================================================
 # 1. Data Loading and Processing for Inference
 # =================================================================================
@@ -65,43 +76,60 @@ class QlibTestDataset(Dataset):
         self.symbols = list(self.data.keys())
         self.feature_list = config.feature_list
         self.time_feature_list = config.time_feature_list
-        self.indices = []
 
         print("Preprocessing and building indices for test dataset...")
-        
-        # 分批处理数据以减少内存使用
-        batch_size = min(10, len(self.symbols))  # 每次处理最多10个股票
-        
-        for i in range(0, len(self.symbols), batch_size):
-            batch_symbols = self.symbols[i:i+batch_size]
-            
-            for symbol in batch_symbols:
-                df = self.data[symbol].reset_index()
-                # Generate time features on-the-fly
-                df['minute'] = df['datetime'].dt.minute
-                df['hour'] = df['datetime'].dt.hour
-                df['weekday'] = df['datetime'].dt.weekday
-                df['day'] = df['datetime'].dt.day
-                df['month'] = df['datetime'].dt.month
-                self.data[symbol] = df  # Store preprocessed dataframe
-
-                num_samples = len(df) - self.window_size + 1
-                if num_samples > 0:
-                    for j in range(num_samples):
-                        timestamp = df.iloc[j + self.config.lookback_window - 1]['datetime']
-                        self.indices.append((symbol, j, timestamp))
-            
-            # 强制垃圾回收
-            gc.collect()
-            
-            if i + batch_size < len(self.symbols):
-                print(f"已处理 {i+batch_size}/{len(self.symbols)} 个股票")
+        for symbol in self.symbols:
+            df = self.data[symbol].reset_index()
+            # Generate time features on-the-fly
+            df['minute'] = df['datetime'].dt.minute
+            df['hour'] = df['datetime'].dt.hour
+            df['weekday'] = df['datetime'].dt.weekday
+            df['day'] = df['datetime'].dt.day
+            df['month'] = df['datetime'].dt.month
+            self.data[symbol] = df  # Store preprocessed dataframe
+
+        # All valid (symbol_id, start_index) pairs, stored as two flat int32 arrays.
+        lengths = [len(self.data[symbol]) for symbol in self.symbols]
+        self.symbol_ids, self.starts = build_window_index(lengths, self.window_size)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.offsets = np.cumsum(self.lengths) - self.lengths
+        # Normalization statistics of every lookback context, looked up in O(1) per window.
+        self.window_stats = RollingWindowStats(
+            np.concatenate([self.data[symbol][self.feature_list].values for symbol in self.symbols])
+            if self.symbols else np.empty((0, len(self.feature_list))),
+            self.lengths,
+            block_size=self.config.lookback_window,
+        )
+
+        # The prediction timestamp of each window is the last bar of its lookback context,
+        # gathered in one vectorized lookup over the concatenated datetime columns.
+        all_datetimes = np.concatenate(
+            [self.data[symbol]['datetime'].values for symbol in self.symbols]
+        ) if self.symbols else np.array([], dtype='datetime64[ns]')
+        self.timestamps = all_datetimes[self.offsets[self.symbol_ids] + self.starts + self.config.lookback_window - 1]
+        # Row axis of the wide signal matrices: the sorted prediction dates, and each window's row.
+        self.dates, self.date_ids = np.unique(self.timestamps, return_inverse=True)
+        print(f"Found {len(self.starts)} windows across {len(self.symbols)} symbols.")
 
     def __len__(self) -> int:
-        return len(self.indices)
+        return len(self.starts)
+
+    def forward_returns(self, horizon: int = 1) -> np.ndarray:
+        """
+        Realized return of every window's signal (see `utils.signal_metrics.forward_returns`),
+        the label of the signal-quality metrics.
+        """
+        if not self.symbols:
+            return np.array([], dtype=np.float64)
+        labels = np.concatenate([forward_returns(self.data[symbol]['close'].values, horizon)
+                                 for symbol in self.symbols])
+        return labels[self.offsets[self.symbol_ids] + self.starts + self.config.lookback_window - 1]
 
     def __getitem__(self, idx: int):
-        symbol, start_idx, timestamp = self.indices[idx]
+        symbol_id = self.symbol_ids[idx]
+        symbol = self.symbols[symbol_id]
+        start_idx = int(self.starts[idx])
+        timestamp = pd.Timestamp(self.timestamps[idx])
         df = self.data[symbol]
 
         context_end = start_idx + self.config.lookback_window
@@ -115,9 +143,9 @@ class QlibTestDataset(Dataset):
         y_stamp = predict_df[self.time_feature_list].values.astype(np.float32)
 
         # Instance-level normalization, consistent with training
-        x_mean, x_std = np.mean(x, axis=0), np.std(x, axis=0)
-        x = (x - x_mean) / (x_std + 1e-5)
-        x = np.clip(x, -self.config.clip, self.config.clip)
+        x_mean, x_std = self.window_stats.mean_std(symbol_id, self.offsets[symbol_id] + start_idx,
+                                                   self.config.lookback_window)
+        x = normalize_window(x, x_mean, x_std, self.config.clip)
 
         return torch.from_numpy(x), torch.from_numpy(x_stamp), torch.from_numpy(y_stamp), symbol, timestamp
 
@@ -140,7 +168,7 @@ class QlibBacktest:
         print("Initializing Qlib for backtesting...")
         qlib.init(provider_uri=self.config.qlib_data_path, region=REG_CN)
 
-    def run_single_backtest(self, signal_series: pd.Series) -> pd.DataFrame:
+    def run_single_backtest(self, signal_series: pd.Series) -> dict:
         """
         Runs a single backtest for a given prediction signal.
 
@@ -148,7 +176,8 @@ class QlibBacktest:
             signal_series (pd.Series): A pandas Series with a MultiIndex
                                        (instrument, datetime) and prediction scores.
         Returns:
-            pd.DataFrame: A DataFrame containing the performance report.
+            dict: 'report', a DataFrame with the cumulative benchmark, return and excess
+                return curves, and 'analysis', the risk analysis of the excess returns.
         """
         strategy = TopkDropoutStrategy(
             topk=self.config.backtest_n_symbol_hold,
@@ -192,34 +221,61 @@ class QlibBacktest:
             "cum_return_w_cost": (report["return"] - report["cost"]).cumsum(),
             "cum_ex_return_w_cost": (report["return"] - report["bench"] - report["cost"]).cumsum(),
         })
-        return report_df
-
-    def run_and_plot_results(self, signals: dict[str, pd.DataFrame]):
+        return {"report": report_df, "analysis": analysis}
+
+    def backtest_signal(self, signal_name: str, pred_df: pd.DataFrame) -> dict:
+        """Backtests one wide prediction DataFrame (datetime index, symbol columns)."""
+        print(f"\nBacktesting signal: {signal_name}...")
+        pred_series = pred_df.stack()
+        pred_series.index.names = ['datetime', 'instrument']
+        pred_series = pred_series.swaplevel().sort_index()
+        return self.run_single_backtest(pred_series)
+
+    def run_and_plot_results(self, signals: dict[str, pd.DataFrame], num_workers: int = None,
+                             plot_path: str = None, show: bool = False) -> dict[str, dict]:
         """
         Runs backtests for multiple signals and plots the cumulative return curves.
 
+        The signals are backtested concurrently, one process per signal (up to
+        `num_workers`), each with its own Qlib instance.
+
         Args:
             signals (dict[str, pd.DataFrame]): A dictionary where keys are signal names
                                                and values are prediction DataFrames.
+            num_workers (int, optional): Number of backtest processes. Defaults to one per signal;
+                1 runs the backtests in this process.
+            plot_path (str, optional): Where to save the comparison plot. No plot is drawn if None.
+            show (bool): Also open the plot in a window (needs a display).
+
+        Returns:
+            dict[str, dict]: The `run_single_backtest` result of every signal.
         """
-        return_df, ex_return_df, bench_df = pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
-
-        for signal_name, pred_df in signals.items():
-            print(f"\nBacktesting signal: {signal_name}...")
-            pred_series = pred_df.stack()
-            pred_series.index.names = ['datetime', 'instrument']
-            pred_series = pred_series.swaplevel().sort_index()
-            report_df = self.run_single_backtest(pred_series)
-
-            return_df[signal_name] = report_df['cum_return_w_cost']
-            ex_return_df[signal_name] = report_df['cum_ex_return_w_cost']
-            if 'return' not in bench_df:
-                bench_df['return'] = report_df['cum_bench']
-
-        # Plotting results
-        fig, axes = plt.subplots(2, 1, figsize=(12, 8), sharex=True)
+        num_workers = min(num_workers or len(signals), len(signals))
+        if num_workers <= 1:
+            results = {name: self.backtest_signal(name, pred_df) for name, pred_df in signals.items()}
+        else:
+            print(f"Backtesting {len(signals)} signals in {num_workers} processes...")
+            ctx = mp.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=num_workers, mp_context=ctx,
+                                     initializer=_init_backtest_worker, initargs=(self.config,)) as pool:
+                futures = {name: pool.submit(_backtest_worker, name, pred_df) for name, pred_df in signals.items()}
+                results = {name: future.result() for name, future in futures.items()}
+
+        if plot_path is not None or show:
+            self.plot_results(results, plot_path, show)
+        return results
+
+    def plot_results(self, results: dict[str, dict], plot_path: str = None, show: bool = False):
+        """Plots the cumulative (excess) returns with cost of every signal against the benchmark."""
+        return_df = pd.DataFrame({name: result['report']['cum_return_w_cost'] for name, result in results.items()})
+        ex_return_df = pd.DataFrame({name: result['report']['cum_ex_return_w_cost'] for name, result in results.items()})
+        bench = next(iter(results.values()))['report']['cum_bench']
+
+        # Without `show`, draw on a bare Figure so no GUI backend is needed.
+        fig = plt.figure(figsize=(12, 8)) if show else Figure(figsize=(12, 8))
+        axes = fig.subplots(2, 1, sharex=True)
         return_df.plot(ax=axes[0], title='Cumulative Return with Cost', grid=True)
-        axes[0].plot(bench_df['return'], label=self.config.instrument.upper(), color='black', linestyle='--')
+        axes[0].plot(bench, label=self.config.instrument.upper(), color='black', linestyle='--')
         axes[0].legend()
         axes[0].set_ylabel("Cumulative Return")
 
@@ -228,9 +284,26 @@ class QlibBacktest:
         axes[1].set_xlabel("Date")
         axes[1].set_ylabel("Cumulative Excess Return")
 
-        plt.tight_layout()
-        plt.savefig("../figures/backtest_result_example.png", dpi=200)
-        plt.show()
+        fig.tight_layout()
+        if plot_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(plot_path)), exist_ok=True)
+            fig.savefig(plot_path, dpi=200)
+            print(f"Saved backtest plot to {plot_path}")
+        if show:
+            plt.show()
+
+
+_worker_backtester = None
+
+
+def _init_backtest_worker(config: Config):
+    """Initializes Qlib inside a backtest worker process."""
+    global _worker_backtester
+    _worker_backtester = QlibBacktest(config)
+
+
+def _backtest_worker(signal_name: str, pred_df: pd.DataFrame) -> dict:
+    return _worker_backtester.backtest_signal(signal_name, pred_df)
 
 
 # =================================================================================
@@ -355,45 +428,119 @@ def collate_fn_for_inference(batch):
     return x_batch, x_stamp_batch, y_stamp_batch, list(symbols), list(timestamps)
 
 
-def generate_predictions(config: dict, test_data: dict) -> dict[str, pd.DataFrame]:
+def is_out_of_memory(error: BaseException) -> bool:
+    """Returns True if `error` is a CUDA or host out-of-memory error raised by torch."""
+    message = str(error)
+    return "out of memory" in message or "can't allocate memory" in message
+
+
+class AdaptiveBatcher:
     """
-    Runs inference on the test dataset to generate prediction signals.
+    Picks the inference batch size, adapting it to the available memory.
+
+    The batch starts at `max_size`. An out-of-memory error records the failing
+    size as a ceiling and falls back to the last size that fitted (halving if
+    none is known). After `grow_after` consecutive successful batches the batch
+    grows again, doubling but staying below the ceiling (a binary search for
+    the largest batch that fits). Once the search cannot get any closer, the
+    ceiling itself is retried, so a transient OOM (fragmentation, another
+    process on the GPU) does not cap the batch for the rest of the run; every
+    retry that fails again doubles the wait before the next one.
 
     Args:
-        config (dict): A dictionary containing inference parameters.
-        test_data (dict): The raw test data loaded from a pickle file.
+        max_size (int): Initial and largest batch size.
+        grow_after (int): Number of consecutive successes before growing.
+    """
 
-    Returns:
-        A dictionary where keys are signal types (e.g., 'mean', 'last') and
-        values are DataFrames of predictions (datetime index, symbol columns).
+    def __init__(self, max_size: int, grow_after: int = 20):
+        self.max_size = max_size
+        self.grow_after = grow_after
+        self.size = max_size
+        self._ceiling = None
+        self._last_fit = None
+        self._successes = 0
+        self._retry_after = grow_after
+        self._retrying = False
+
+    def on_oom(self):
+        if self._retrying:
+            self._retry_after *= 2
+            self._retrying = False
+        self._ceiling = self.size
+        if self._last_fit is not None and self._last_fit < self.size:
+            self.size = self._last_fit
+        else:
+            self.size = max(1, self.size // 2)
+        self._successes = 0
+
+    def on_success(self):
+        self._last_fit = self.size
+        if self._retrying:
+            self._retry_after = self.grow_after
+            self._retrying = False
+        self._successes += 1
+        if self.size >= self.max_size:
+            return
+        stuck = self._ceiling is not None and (self.size + self._ceiling) // 2 <= self.size
+        if self._successes < (self._retry_after if stuck else self.grow_after):
+            return
+        self._successes = 0
+        if self._ceiling is None:
+            self.size = min(self.size * 2, self.max_size)
+        elif not stuck:
+            self.size = (self.size + self._ceiling) // 2
+        else:
+            self.size, self._ceiling, self._retrying = self._ceiling, None, True
+
+
+def predict_signals(config: dict, tokenizer: KronosTokenizer, model: Kronos, dataset: QlibTestDataset,
+                    indices: list = None, evaluator: StreamingSignalEvaluator = None,
+                    labels: np.ndarray = None) -> dict[str, np.ndarray]:
     """
-    tokenizer, model = load_models(config)
-    device = torch.device(config['device'])
+    Runs inference over the test dataset (or a subset of its windows).
 
-    # Use the Dataset and DataLoader for efficient batching and processing (Memory Optimized)
-    dataset = QlibTestDataset(data=test_data, config=Config())
-    
-    # 内存优化的DataLoader设置
-    optimized_batch_size = min(config['batch_size'] // config['sample_count'], 8)  # 限制最大batch size
-    loader = DataLoader(
-        dataset,
-        batch_size=optimized_batch_size,
-        shuffle=False,
-        num_workers=0,  # 不使用多进程以避免内存问题
-        pin_memory=False,  # 不使用pin_memory以减少内存使用
-        collate_fn=collate_fn_for_inference
-    )
-    
-    print(f"✓ 使用优化的DataLoader设置，batch_size={optimized_batch_size}, num_workers=0")
+    Batches are sized by an `AdaptiveBatcher`: a batch that runs out of memory
+    is retried with a smaller batch size, so no window is ever dropped.
 
-    results = defaultdict(list)
+    Args:
+        config (dict): A dictionary containing inference parameters.
+        tokenizer (KronosTokenizer): The loaded tokenizer.
+        model (Kronos): The loaded predictor, on the inference device.
+        dataset (QlibTestDataset): The test windows.
+        indices (list, optional): Window indices to predict. Defaults to all windows.
+        evaluator (StreamingSignalEvaluator, optional): Fed with every batch; the windows are
+            then predicted in date order so that each day's cross-section completes early.
+        labels (np.ndarray, optional): Forward return of every window of `dataset`, required
+            with `evaluator` (see `QlibTestDataset.forward_returns`).
+
+    Returns:
+        A dictionary where keys are signal types (e.g., 'mean', 'last') and values
+        are float32 arrays of shape (len(dataset.dates), len(dataset.symbols)).
+        Entries of windows that were not predicted are NaN.
+    """
+    device = next(model.parameters()).device
+    indices = np.arange(len(dataset)) if indices is None else np.asarray(indices)
+    if evaluator is not None:
+        indices = indices[np.lexsort((dataset.symbol_ids[indices], dataset.date_ids[indices]))]
+
+    # Windows per batch start at the configured maximum and adapt to the available memory.
+    batcher = AdaptiveBatcher(max(1, config['batch_size'] // config['sample_count']),
+                              grow_after=config.get('grow_after', 20))
+    print(f"✓ 使用自适应batch size，初始/最大 batch_size={batcher.max_size}")
+
+    # Both axes are known up front, so every window writes straight into its (date, symbol) cell.
+    shape = (len(dataset.dates), len(dataset.symbols))
+    results = {sig_type: np.full(shape, np.nan, dtype=np.float32) for sig_type in SIGNAL_TYPES}
     batch_count = 0
     
     # 设置内存优化参数
     os.environ['PYTORCH_CUDA_ALLOC_CONF'] = 'max_split_size_mb:128'
     
-    with torch.no_grad():
-        for x, x_stamp, y_stamp, symbols, timestamps in tqdm(loader, desc="Inference"):
+    pos = 0
+    with torch.no_grad(), tqdm(total=len(indices), desc="Inference") as progress:
+        while pos < len(indices):
+            batch_indices = indices[pos:pos + batcher.size]
+            x, x_stamp, y_stamp, _, _ = collate_fn_for_inference([dataset[i] for i in batch_indices])
             try:
                 # 使用混合精度推理以减少内存使用
                 with torch.cuda.amp.autocast(enabled=device.type=="cuda"):
@@ -402,63 +549,195 @@ def generate_predictions(config: dict, test_data: dict) -> dict[str, pd.DataFram
                         max_context=config['max_context'], pred_len=config['pred_len'], clip=config['clip'],
                         T=config['T'], top_k=config['top_k'], top_p=config['top_p'], sample_count=config['sample_count']
                     )
-
-                # The 'close' price is at index 3 in `feature_list`
-                last_day_close = x[:, -1, 3].numpy()
-                signals = {
-                    'last': preds[:, -1, 3] - last_day_close,
-                    'mean': np.mean(preds[:, :, 3], axis=1) - last_day_close,
-                    'max': np.max(preds[:, :, 3], axis=1) - last_day_close,
-                    'min': np.min(preds[:, :, 3], axis=1) - last_day_close,
-                }
-
-                for i in range(len(symbols)):
-                    for sig_type, sig_values in signals.items():
-                        results[sig_type].append((timestamps[i], symbols[i], sig_values[i]))
-                
-                batch_count += 1
-                
-                # 定期清理内存
-                if batch_count % 10 == 0:
-                    if device.type == "cuda":
-                        torch.cuda.empty_cache()
-                    gc.collect()
-                    
             except RuntimeError as e:
-                if "out of memory" in str(e):
-                    print(f"⚠ GPU内存不足，跳过batch {batch_count}")
-                    if device.type == "cuda":
-                        torch.cuda.empty_cache()
-                    continue
-                else:
-                    raise e
+                if not is_out_of_memory(e) or batcher.size == 1:
+                    raise
+                # Retry the same windows with a smaller batch instead of dropping them.
+                del e
+                if device.type == "cuda":
+                    torch.cuda.empty_cache()
+                gc.collect()
+                batcher.on_oom()
+                print(f"⚠ 内存不足，batch_size 减小到 {batcher.size} 后重试")
+                continue
+
+            batcher.on_success()
+            pos += len(batch_indices)
+            progress.update(len(batch_indices))
+
+            # The 'close' price is at index 3 in `feature_list`
+            last_day_close = x[:, -1, 3].numpy()
+            signals = {
+                'last': preds[:, -1, 3] - last_day_close,
+                'mean': np.mean(preds[:, :, 3], axis=1) - last_day_close,
+                'max': np.max(preds[:, :, 3], axis=1) - last_day_close,
+                'min': np.min(preds[:, :, 3], axis=1) - last_day_close,
+            }
+
+            rows, cols = dataset.date_ids[batch_indices], dataset.symbol_ids[batch_indices]
+            for sig_type, sig_values in signals.items():
+                results[sig_type][rows, cols] = sig_values
+            if evaluator is not None:
+                evaluator.update(rows, signals, labels[batch_indices])
+                progress.set_postfix_str(evaluator.format_summary(), refresh=False)
+            
+            batch_count += 1
+            
+            # 定期清理内存
+            if batch_count % 10 == 0:
+                if device.type == "cuda":
+                    torch.cuda.empty_cache()
+                gc.collect()
+
+    if evaluator is not None:
+        evaluator.finish()
+    return results
 
+
+def evaluate_signal_matrices(evaluator: StreamingSignalEvaluator, signals: dict[str, np.ndarray],
+                             labels: np.ndarray):
+    """Feeds (date, symbol) signal and label matrices to `evaluator` one date at a time."""
+    for date_id in range(labels.shape[0]):
+        date_ids = np.full(labels.shape[1], date_id)
+        evaluator.update(date_ids, {sig_type: values[date_id] for sig_type, values in signals.items()},
+                         labels[date_id])
+    evaluator.finish()
+
+
+def generate_predictions(config: dict, test_data: dict,
+                         evaluator: StreamingSignalEvaluator = None) -> dict[str, pd.DataFrame]:
+    """
+    Runs inference on the test dataset to generate prediction signals.
+
+    Args:
+        config (dict): A dictionary containing inference parameters.
+        test_data (dict): The raw test data loaded from a pickle file.
+        evaluator (StreamingSignalEvaluator, optional): Scores the signals against the
+            realized forward returns while inference runs.
+
+    Returns:
+        A dictionary where keys are signal types (e.g., 'mean', 'last') and
+        values are DataFrames of predictions (datetime index, symbol columns).
+    """
+    tokenizer, model = load_models(config)
+
+    # Use the Dataset for efficient batching and processing (Memory Optimized)
+    dataset = QlibTestDataset(data=test_data, config=Config())
+    labels = dataset.forward_returns(config['eval_horizon']) if evaluator is not None else None
+    signals = predict_signals(config, tokenizer, model, dataset, evaluator=evaluator, labels=labels)
     print("Post-processing predictions into DataFrames...")
-    prediction_dfs = {}
-    for sig_type, records in results.items():
-        df = pd.DataFrame(records, columns=['datetime', 'instrument', 'score'])
-        pivot_df = df.pivot_table(index='datetime', columns='instrument', values='score')
-        prediction_dfs[sig_type] = pivot_df.sort_index()
+    return signals_to_frames(dataset.dates, dataset.symbols, signals)
+
+
+def _inference_worker(worker_id: int, num_workers: int, config: dict, test_data_path: str, shard_dir: str,
+                      num_threads: int = None, cores: set = None):
+    """
+    Predicts one contiguous shard of the test windows and writes it to `shard_dir`.
+
+    Runs in a spawned process. The device is taken from `config['device']`; on CPU
+    the process is pinned to `cores` (where supported) and limited to `num_threads`.
+    """
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    with open(test_data_path, 'rb') as f:
+        test_data = pickle.load(f)
+    dataset = QlibTestDataset(data=test_data, config=Config())
+    del test_data
+    # Contiguous shards keep each worker's windows grouped by symbol.
+    indices = np.array_split(np.arange(len(dataset)), num_workers)[worker_id]
+    print(f"[Worker {worker_id}] Predicting {len(indices)} of {len(dataset)} windows on {config['device']}")
 
-    return prediction_dfs
+    tokenizer, model = load_models(config)
+    signals = predict_signals(config, tokenizer, model, dataset, indices)
+    # The labels of the predicted windows are merged like a signal, for the signal-quality evaluation.
+    signals['label'] = np.full_like(signals[SIGNAL_TYPES[0]], np.nan)
+    labels = dataset.forward_returns(config['eval_horizon'])
+    signals['label'][dataset.date_ids[indices], dataset.symbol_ids[indices]] = labels[indices]
+
+    # Every worker builds the same dataset, so all parts share the full (date, symbol) axes.
+    part_path = os.path.join(shard_dir, f"part_{worker_id:03d}.npz")
+    save_signals(part_path, signals_to_frames(dataset.dates, dataset.symbols, signals, drop_empty=False))
+
+
+def generate_predictions_sharded(config: dict, test_data_path: str, num_workers: int, devices: list[str],
+                                 shard_dir: str, threads_per_worker: int = None,
+                                 evaluator: StreamingSignalEvaluator = None) -> dict[str, pd.DataFrame]:
+    """
+    Runs inference in `num_workers` processes, each on one shard of the test windows.
+
+    Workers are assigned to `devices` round-robin. CPU workers get a disjoint core
+    set and their own thread budget. Each worker writes a partial signal file to
+    `shard_dir`; once all have finished, the parts are merged into the same
+    output as `generate_predictions`.
+
+    Args:
+        config (dict): A dictionary containing inference parameters.
+        test_data_path (str): Path of the test data pickle; every worker loads it itself.
+        num_workers (int): Number of inference processes.
+        devices (list[str]): Devices to spread the workers over, e.g. ['cuda:0', 'cuda:1'] or ['cpu'].
+        shard_dir (str): Directory for the partial signal files. It is cleared first.
+        threads_per_worker (int, optional): Threads per CPU worker. Defaults to an even
+            split of the machine's cores.
+        evaluator (StreamingSignalEvaluator, optional): Scores the merged signals. A worker
+            only sees part of each day's cross-section, so this runs after the merge.
+
+    Raises:
+        RuntimeError: If any worker fails.
+    """
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    os.makedirs(shard_dir)
+
+    n_cpus = os.cpu_count() or 1
+    threads = threads_per_worker or max(1, n_cpus // num_workers)
+    ctx = mp.get_context('spawn')
+    processes = []
+    for worker_id in range(num_workers):
+        device = devices[worker_id % len(devices)]
+        cores = None
+        if torch.device(device).type == 'cpu':
+            cores = set(range(worker_id * threads, min((worker_id + 1) * threads, n_cpus))) or None
+        process = ctx.Process(
+            target=_inference_worker,
+            args=(worker_id, num_workers, {**config, 'device': device}, test_data_path, shard_dir, threads, cores),
+        )
+        process.start()
+        processes.append(process)
+
+    for process in processes:
+        process.join()
+    failed = [worker_id for worker_id, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Inference workers {failed} failed; partial results are in {shard_dir}")
+
+    print(f"Merging {num_workers} partial signal files from {shard_dir}...")
+    merged = {}
+    for worker_id in range(num_workers):
+        part = load_signals(os.path.join(shard_dir, f"part_{worker_id:03d}.npz"), drop_empty=False)
+        for sig_type, df in part.items():
+            values = df.to_numpy()
+            if sig_type not in merged:
+                dates, symbols = df.index.values, df.columns.tolist()
+                merged[sig_type] = values.copy()
+            else:
+                # Shards are disjoint: take every cell this worker predicted.
+                np.copyto(merged[sig_type], values, where=~np.isnan(values))
+    labels = merged.pop('label')
+    if evaluator is not None:
+        evaluate_signal_matrices(evaluator, merged, labels)
+    return signals_to_frames(dates, symbols, merged)
 
 
 # =================================================================================
 # 4. Main Execution
 # =================================================================================
 
-def main():
-    """Main function to set up config, run inference, and execute backtesting."""
-    parser = argparse.ArgumentParser(description="Run Kronos Inference and Backtesting")
-    parser.add_argument("--device", type=str, default="cuda:1", help="Device for inference (e.g., 'cuda:0', 'cpu')")
-    args = parser.parse_args()
-
-    # --- 1. Configuration Setup ---
-    base_config = Config()
-
-    # Create a dedicated dictionary for this run's configuration
-    run_config = {
-        'device': args.device,
+def build_run_config(base_config: Config, device: str) -> dict:
+    """Collects the inference and output settings of a backtest run from `base_config`."""
+    return {
+        'device': device,
         'data_path': base_config.dataset_path,
         'result_save_path': base_config.backtest_result_path,
         'result_name': base_config.backtest_save_folder_name,
@@ -472,8 +751,34 @@ def main():
         'top_p': base_config.inference_top_p,
         'sample_count': base_config.inference_sample_count,
         'batch_size': base_config.backtest_batch_size,
+        'grow_after': base_config.backtest_grow_after,
+        'eval_horizon': base_config.signal_eval_horizon,
     }
 
+
+def main():
+    """Main function to set up config, run inference, and execute backtesting."""
+    parser = argparse.ArgumentParser(description="Run Kronos Inference and Backtesting")
+    parser.add_argument("--device", type=str, default="cuda:1", help="Device for inference (e.g., 'cuda:0', 'cpu')")
+    parser.add_argument("--num-workers", type=int, default=1,
+                        help="Number of inference processes, each predicting one shard of the test windows")
+    parser.add_argument("--devices", type=str, default=None,
+                        help="Comma-separated devices for the workers (e.g., 'cuda:0,cuda:1'). Defaults to --device")
+    parser.add_argument("--threads-per-worker", type=int, default=None, help="Threads per CPU inference worker")
+    parser.add_argument("--backtest-workers", type=int, default=None,
+                        help="Number of processes for the signal backtests (default: one per signal)")
+    parser.add_argument("--plot-path", type=str, default=None,
+                        help="Where to save the backtest plot (default: backtest_result.png in the result folder)")
+    parser.add_argument("--no-plot", action="store_true", help="Skip plotting the backtest results")
+    parser.add_argument("--show-plot", action="store_true", help="Also open the backtest plot in a window")
+    args = parser.parse_args()
+
+    # --- 1. Configuration Setup ---
+    base_config = Config()
+
+    # Create a dedicated dictionary for this run's configuration
+    run_config = build_run_config(base_config, args.device)
+
     print("--- Running with Configuration ---")
     for key, val in run_config.items():
         print(f"{key:>20}: {val}")
@@ -481,27 +786,60 @@ def main():
 
     # --- 2. Load Data ---
     test_data_path = os.path.join(run_config['data_path'], "test_data.pkl")
-    print(f"Loading test data from {test_data_path}...")
-    with open(test_data_path, 'rb') as f:
-        test_data = pickle.load(f)
-    print(test_data)
+    save_dir = os.path.join(run_config['result_save_path'], run_config['result_name'])
+    os.makedirs(save_dir, exist_ok=True)
+
     # --- 3. Generate Predictions ---
-    model_preds = generate_predictions(run_config, test_data)
+    evaluator = StreamingSignalEvaluator(
+        SIGNAL_TYPES, quantile=base_config.signal_eval_quantile,
+        abort_after_days=base_config.signal_eval_abort_after_days, min_rank_ic=base_config.signal_eval_min_rank_ic,
+    )
+    quality_file = os.path.join(save_dir, "signal_quality.json")
+    try:
+        if args.num_workers > 1:
+            devices = args.devices.split(',') if args.devices else [args.device]
+            model_preds = generate_predictions_sharded(
+                run_config, test_data_path, args.num_workers, devices,
+                shard_dir=os.path.join(save_dir, "prediction_shards"), threads_per_worker=args.threads_per_worker,
+                evaluator=evaluator,
+            )
+        else:
+            print(f"Loading test data from {test_data_path}...")
+            with open(test_data_path, 'rb') as f:
+                test_data = pickle.load(f)
+            print(test_data)
+            model_preds = generate_predictions(run_config, test_data, evaluator=evaluator)
+    except PoorSignalError as e:
+        print(f"⚠ 信号质量过低，停止回测: {e}")
+        with open(quality_file, 'w') as f:
+            json.dump(evaluator.summary(), f, indent=4)
+        return
+
+    print("\n--- Signal Quality ---")
+    print(pd.DataFrame(evaluator.summary()))
+    with open(quality_file, 'w') as f:
+        json.dump(evaluator.summary(), f, indent=4)
 
     # --- 4. Save Predictions ---
-    save_dir = os.path.join(run_config['result_save_path'], run_config['result_name'])
-    os.makedirs(save_dir, exist_ok=True)
-    predictions_file = os.path.join(save_dir, "predictions.pkl")
+    predictions_file = os.path.join(save_dir, "predictions.npz")
     print(f"Saving prediction signals to {predictions_file}...")
-    with open(predictions_file, 'wb') as f:
-        pickle.dump(model_preds, f)
+    save_signals(predictions_file, model_preds)
 
     # --- 5. Run Backtesting ---
-    with open(predictions_file, 'rb') as f:
-        model_preds = pickle.load(f)
+    model_preds = load_signals(predictions_file)
 
     backtester = QlibBacktest(base_config)
-    backtester.run_and_plot_results(model_preds)
+    plot_path = None if args.no_plot else (args.plot_path or os.path.join(save_dir, "backtest_result.png"))
+    results = backtester.run_and_plot_results(
+        model_preds, num_workers=args.backtest_workers, plot_path=plot_path, show=args.show_plot,
+    )
+
+    summary = pd.DataFrame({
+        name: result['analysis']['excess_return_with_cost']['risk'] for name, result in results.items()
+    })
+    print("\n--- Excess Return (w/ cost) by Signal ---")
+    print(summary)
+    summary.to_csv(os.path.join(save_dir, "backtest_summary.csv"))
 
 
 if __name__ == '__main__':
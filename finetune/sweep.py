@@ -0,0 +1,396 @@
+"""
+Hyperparameter sweep runner for the fine-tuning scripts.
+
+Trials are generated from a JSON spec (grid or random search over `Config`
+attributes) and run as separate `train_tokenizer.py` / `train_predictor.py`
+processes, one per device or CPU slot. Before any trial starts, every
+distinct validation cache the trials need is built once (a trainer run with
+`prepare_val_cache`), so concurrent trials load it instead of each preparing
+it. Training batches are still loaded and tokenized by every trial. Trials
+that fall behind are stopped early with the median stopping rule, and a
+results table is written to `<save_path>/sweeps/<name>/results.csv`.
+
+Sweeping `batch_size` rescales `n_train_iter`/`n_val_iter` (see
+`Config.update`), so every trial runs the same number of steps per epoch.
+
+Usage (from the finetune directory):
+    python sweep.py --spec sweep.json --gpus 0,1,2,3
+    python sweep.py --spec sweep.json --cpu-slots 4 --threads-per-slot 8
+    # Multi-node: put `save_path` on a shared filesystem and run once per node.
+    python sweep.py --spec sweep.json --gpus 0,1 --num-nodes 2 --node-rank 0
+
+Example spec:
+    {
+        "name": "predictor_lr",
+        "target": "predictor",
+        "method": "random",
+        "n_trials": 12,
+        "seed": 0,
+        "params": {
+            "predictor_learning_rate": {"low": 1e-5, "high": 1e-4, "log": true},
+            "batch_size": [32, 50, 64]
+        },
+        "overrides": {"epochs": 5},
+        "early_stopping": {"min_epochs": 2, "min_trials": 3}
+    }
+
+A list of values is searched exhaustively with "grid" and sampled uniformly
+with "random"; a {"low", "high"} range (optionally "log" and "int") is only
+supported by random search.
+"""
+import argparse
+from collections import deque
+import csv
+import itertools
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+from config import Config
+
+SCRIPTS = {'tokenizer': 'train_tokenizer.py', 'predictor': 'train_predictor.py'}
+FOLDER_KEYS = {'tokenizer': 'tokenizer_save_folder_name', 'predictor': 'predictor_save_folder_name'}
+VAL_METRICS = {'tokenizer': 'val_tokenizer_loss_epoch', 'predictor': 'val_predictor_loss_epoch'}
+# Launcher variables that must not leak into the (single-process) trial runs.
+DDP_ENV_VARS = ['WORLD_SIZE', 'RANK', 'LOCAL_RANK', 'LOCAL_WORLD_SIZE', 'MASTER_ADDR', 'MASTER_PORT']
+FINETUNE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def generate_trials(spec: dict) -> list[dict]:
+    """
+    Expands the search space of a sweep spec into a list of parameter sets.
+
+    Args:
+        spec (dict): The sweep spec, see the module docstring.
+
+    Returns:
+        list[dict]: One mapping from Config attribute to value per trial. The
+            order is deterministic, so every node derives the same trials.
+    """
+    params = spec['params']
+    method = spec.get('method', 'grid')
+    if method == 'grid':
+        for name, values in params.items():
+            if not isinstance(values, list):
+                raise ValueError(f"Grid search needs a list of values for '{name}'")
+        names = list(params)
+        return [dict(zip(names, combo)) for combo in itertools.product(*(params[name] for name in names))]
+    if method != 'random':
+        raise ValueError(f"Unknown sweep method: {method}")
+
+    rng = random.Random(spec.get('seed', 0))
+    trials = []
+    for _ in range(spec['n_trials']):
+        trial = {}
+        for name, space in params.items():
+            if isinstance(space, list):
+                trial[name] = rng.choice(space)
+            elif space.get('log'):
+                trial[name] = math.exp(rng.uniform(math.log(space['low']), math.log(space['high'])))
+            else:
+                trial[name] = rng.uniform(space['low'], space['high'])
+            if isinstance(space, dict) and space.get('int'):
+                trial[name] = int(round(trial[name]))
+        trials.append(trial)
+    return trials
+
+
+def build_slots(gpus: str = None, cpu_slots: int = None, threads_per_slot: int = None) -> list[dict]:
+    """
+    Builds the execution slots trials are scheduled on.
+
+    Each slot is a dict with a display `name`, extra environment variables,
+    Config overrides (device and thread budget) and an optional CPU core set
+    the trial process is pinned to.
+
+    Args:
+        gpus (str, optional): Comma-separated CUDA device ids, one slot per device.
+        cpu_slots (int, optional): Number of CPU slots. Cores are split evenly
+            between them unless `threads_per_slot` is given.
+        threads_per_slot (int, optional): Threads (and pinned cores) per CPU slot.
+
+    Returns:
+        list[dict]: The slots. Without `gpus` or `cpu_slots`, one slot per visible
+            GPU, or a single CPU slot using all cores.
+    """
+    if gpus:
+        return [{'name': f"cuda:{gpu}", 'env': {'CUDA_VISIBLE_DEVICES': gpu.strip()},
+                 'overrides': {'train_device': 'cuda'}, 'cores': None}
+                for gpu in gpus.split(',')]
+
+    n_cpus = os.cpu_count() or 1
+    if not cpu_slots:
+        import torch
+        if torch.cuda.is_available():
+            return build_slots(gpus=','.join(str(i) for i in range(torch.cuda.device_count())))
+        cpu_slots = 1
+
+    threads = threads_per_slot or max(1, n_cpus // cpu_slots)
+    slots = []
+    for i in range(cpu_slots):
+        cores = set(range(i * threads, min((i + 1) * threads, n_cpus)))
+        slots.append({
+            'name': f"cpu{i}",
+            'env': {'CUDA_VISIBLE_DEVICES': '', 'OMP_NUM_THREADS': str(threads)},
+            'overrides': {'train_device': 'cpu', 'cpu_threads_per_rank': threads},
+            'cores': cores or None,
+        })
+    return slots
+
+
+def read_val_losses(trial_dir: str, metric: str) -> dict:
+    """Returns {epoch: validation loss} logged so far by a trial."""
+    path = os.path.join(trial_dir, 'logs', 'metrics.jsonl')
+    losses = {}
+    if not os.path.exists(path):
+        return losses
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # A line that is still being written.
+            if record.get('name') == metric:
+                losses[record['epoch']] = record['value']
+    return losses
+
+
+def should_stop(trial_id: str, curves: dict, min_epochs: int = 1, min_trials: int = 3) -> bool:
+    """
+    Median stopping rule.
+
+    A trial is stopped if its best validation loss so far is worse than the
+    median of the best losses other trials had reached by the same epoch.
+
+    Args:
+        trial_id (str): The trial to decide on.
+        curves (dict): {trial_id: {epoch: val_loss}} of all trials in the sweep.
+        min_epochs (int): Never stop a trial before it completed this many epochs.
+        min_trials (int): Number of other trials that must have reached the epoch.
+    """
+    curve = curves.get(trial_id)
+    if not curve:
+        return False
+    epoch = max(curve)
+    if epoch + 1 < min_epochs:
+        return False
+
+    peers = [
+        min(loss for e, loss in other.items() if e <= epoch)
+        for other_id, other in curves.items()
+        if other_id != trial_id and other and max(other) >= epoch
+    ]
+    if len(peers) < min_trials:
+        return False
+    return min(curve.values()) > statistics.median(peers)
+
+
+class SweepRunner:
+    """
+    Schedules the trials of a sweep spec on the given slots.
+
+    Args:
+        spec (dict): The sweep spec, see the module docstring.
+        slots (list[dict]): Execution slots from `build_slots`.
+        node_rank (int): Index of this node; it runs trials `node_rank::num_nodes`.
+        num_nodes (int): Number of nodes running the same sweep.
+        poll_interval (float): Seconds between progress checks.
+    """
+
+    def __init__(self, spec: dict, slots: list, node_rank: int = 0, num_nodes: int = 1, poll_interval: float = 30.0):
+        if spec['target'] not in SCRIPTS:
+            raise ValueError(f"Unknown sweep target: {spec['target']}")
+        self.spec = spec
+        self.slots = slots
+        self.node_rank = node_rank
+        self.num_nodes = num_nodes
+        self.poll_interval = poll_interval
+        self.target = spec['target']
+        self.metric = VAL_METRICS[self.target]
+
+        save_path = spec.get('overrides', {}).get('save_path', Config().save_path)
+        self.folder_name = os.path.join('sweeps', spec['name'])
+        self.sweep_dir = os.path.join(FINETUNE_DIR, save_path, self.folder_name)
+        self.trials = [{'id': f"trial_{i:03d}", 'params': params} for i, params in enumerate(generate_trials(spec))]
+
+    def trial_dir(self, trial_id: str) -> str:
+        return os.path.join(self.sweep_dir, trial_id)
+
+    def _overrides(self, trial: dict, slot: dict) -> dict:
+        return {
+            # Trials share the on-disk validation cache, so the data is only prepared once.
+            'val_cache_dir': os.path.join(self.sweep_dir, 'val_cache'),
+            **self.spec.get('overrides', {}),
+            **trial['params'],
+            **slot['overrides'],
+            FOLDER_KEYS[self.target]: os.path.join(self.folder_name, trial['id']),
+            # Early stopping reads the validation losses from the local JSONL log.
+            'logger_backends': ['jsonl'],
+            'use_comet': False,
+        }
+
+    def _start(self, run_dir: str, overrides: dict, slot: dict, log_name: str):
+        """Starts the target trainer in `run_dir` with `overrides` on `slot`."""
+        os.makedirs(run_dir, exist_ok=True)
+        overrides_path = os.path.join(run_dir, 'overrides.json')
+        with open(overrides_path, 'w') as f:
+            json.dump(overrides, f, indent=4)
+
+        env = {k: v for k, v in os.environ.items() if k not in DDP_ENV_VARS}
+        env.update(slot['env'])
+        preexec_fn = None
+        if slot['cores'] and hasattr(os, 'sched_setaffinity'):
+            cores = slot['cores']
+            preexec_fn = lambda: os.sched_setaffinity(0, cores)
+
+        log_file = open(os.path.join(run_dir, log_name), 'w')
+        process = subprocess.Popen(
+            [sys.executable, SCRIPTS[self.target], '--overrides', overrides_path],
+            cwd=FINETUNE_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT, preexec_fn=preexec_fn,
+        )
+        return process, log_file
+
+    def _launch(self, trial: dict, slot: dict):
+        process, log_file = self._start(self.trial_dir(trial['id']), self._overrides(trial, slot), slot, 'train.log')
+        print(f"[Sweep] Started {trial['id']} on {slot['name']}: {trial['params']}")
+        return process, log_file
+
+    def prepare_val_caches(self, trials: list):
+        """
+        Builds every distinct validation cache needed by `trials` before they are launched.
+
+        Trials whose data settings match share one cache file (see
+        `shared_cache_path`); for each missing file, one trainer run with
+        `prepare_val_cache` builds it on the first slot. If that run fails, the
+        trials build the cache themselves.
+        """
+        from utils.validation import shared_cache_path
+
+        slot = self.slots[0]
+        prepared = set()
+        for trial in trials:
+            overrides = {**self._overrides(trial, slot), 'prepare_val_cache': True,
+                         FOLDER_KEYS[self.target]: os.path.join(self.folder_name, 'val_cache', 'runs', trial['id'])}
+            config = Config()
+            config.update(overrides)
+            cache_path = shared_cache_path(config.__dict__, self.target, rank=0, world_size=1)
+            if cache_path in prepared or os.path.exists(cache_path):
+                continue
+            prepared.add(cache_path)
+
+            print(f"[Sweep] Preparing validation cache {os.path.basename(cache_path)} on {slot['name']}")
+            run_dir = os.path.join(self.sweep_dir, 'val_cache', 'runs', trial['id'])
+            process, log_file = self._start(run_dir, overrides, slot, 'prepare.log')
+            return_code = process.wait()
+            log_file.close()
+            if return_code != 0:
+                print(f"[Sweep] Preparing the validation cache failed ({return_code}), see {run_dir}/prepare.log")
+
+    def _finish(self, trial: dict, slot: dict, status: str, start_time: float):
+        losses = read_val_losses(self.trial_dir(trial['id']), self.metric)
+        result = {
+            'trial': trial['id'],
+            'status': status,
+            'best_val_loss': min(losses.values()) if losses else None,
+            'epochs': max(losses) + 1 if losses else 0,
+            'wall_time_s': round(time.time() - start_time, 1),
+            'slot': slot['name'],
+            'params': trial['params'],
+        }
+        with open(os.path.join(self.trial_dir(trial['id']), 'result.json'), 'w') as f:
+            json.dump(result, f, indent=4)
+        print(f"[Sweep] {trial['id']} {status}, best {self.metric}: {result['best_val_loss']}")
+
+    def run(self):
+        """Runs this node's trials to completion, then writes the results table."""
+        early_stopping = self.spec.get('early_stopping')
+        # Trials with a result from an earlier invocation are not run again.
+        pending = deque(
+            trial for trial in self.trials[self.node_rank::self.num_nodes]
+            if not os.path.exists(os.path.join(self.trial_dir(trial['id']), 'result.json'))
+        )
+        free_slots = list(self.slots)
+        running = {}
+        print(f"[Sweep] {len(pending)} trials to run on {len(free_slots)} slots, results in {self.sweep_dir}")
+        self.prepare_val_caches(pending)
+
+        while pending or running:
+            while pending and free_slots:
+                trial, slot = pending.popleft(), free_slots.pop(0)
+                process, log_file = self._launch(trial, slot)
+                running[trial['id']] = (trial, slot, process, log_file, time.time())
+
+            time.sleep(self.poll_interval)
+            # Curves of every trial on disk, including those run by other nodes.
+            curves = {t['id']: read_val_losses(self.trial_dir(t['id']), self.metric) for t in self.trials}
+
+            for trial_id, (trial, slot, process, log_file, start_time) in list(running.items()):
+                return_code = process.poll()
+                if return_code is None:
+                    if not early_stopping or not should_stop(trial_id, curves, **early_stopping):
+                        continue
+                    process.terminate()
+                    process.wait()
+                    status = 'stopped'
+                else:
+                    status = 'completed' if return_code == 0 else f"failed ({return_code})"
+                log_file.close()
+                self._finish(trial, slot, status, start_time)
+                free_slots.append(slot)
+                del running[trial_id]
+
+        self.write_results()
+
+    def write_results(self) -> list:
+        """Collects every finished trial's result into `results.csv`, best first."""
+        results = []
+        for trial in self.trials:
+            path = os.path.join(self.trial_dir(trial['id']), 'result.json')
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    results.append(json.load(f))
+        results.sort(key=lambda r: (r['best_val_loss'] is None, r['best_val_loss'] or 0.0))
+
+        param_names = list(self.spec['params'])
+        columns = ['trial', 'status', 'best_val_loss', 'epochs', 'wall_time_s', 'slot'] + param_names
+        os.makedirs(self.sweep_dir, exist_ok=True)
+        with open(os.path.join(self.sweep_dir, 'results.csv'), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            for result in results:
+                writer.writerow({**{k: result[k] for k in columns[:6]}, **result['params']})
+
+        print(f"\n[Sweep] {len(results)}/{len(self.trials)} trials finished. Best first:")
+        for result in results[:10]:
+            print(f"  {result['trial']}  {result['status']:<12} {result['best_val_loss']}  {result['params']}")
+        return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a hyperparameter sweep over Config fields")
+    parser.add_argument("--spec", required=True, help="JSON sweep spec, see the module docstring")
+    parser.add_argument("--gpus", default=None, help="Comma-separated CUDA device ids, one trial per device")
+    parser.add_argument("--cpu-slots", type=int, default=None, help="Number of concurrent CPU trials")
+    parser.add_argument("--threads-per-slot", type=int, default=None, help="Threads (and pinned cores) per CPU trial")
+    parser.add_argument("--num-nodes", type=int, default=1, help="Number of nodes running this sweep")
+    parser.add_argument("--node-rank", type=int, default=0, help="Index of this node")
+    parser.add_argument("--poll-interval", type=float, default=30.0, help="Seconds between progress checks")
+    parser.add_argument("--report", action="store_true", help="Only rebuild the results table")
+    args = parser.parse_args()
+
+    with open(args.spec, 'r') as f:
+        sweep_spec = json.load(f)
+
+    runner = SweepRunner(
+        sweep_spec, build_slots(args.gpus, args.cpu_slots, args.threads_per_slot),
+        node_rank=args.node_rank, num_nodes=args.num_nodes, poll_interval=args.poll_interval,
+    )
+    if args.report:
+        runner.write_results()
+    else:
+        runner.run()
@@ -1,34 +1,42 @@
+import argparse
+import contextlib
 import json
 import os
 import sys
 import time
 from time import gmtime, strftime
 
-import comet_ml
 import torch
 import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data import DataLoader
-from torch.utils.data.distributed import DistributedSampler
 
 # Ensure project root is in path
 sys.path.append('../')
 from config import Config
-from dataset import QlibDataset
+from dataset import PackedQlibDataset, QlibDataset, WindowSampler, packed_loss_mask
 
 # Import shared utilities
+from utils.checkpoint_manager import CheckpointManager, get_rng_state, set_rng_state
+from utils.experiment_logger import create_logger
 from utils.training_utils import (
     cleanup_ddp,
     format_time,
+    get_device,
     get_model_size,
+    resolve_amp_dtype,
+    resolve_device_type,
+    set_cpu_threads,
     set_seed,
     setup_ddp,
 )
+from utils.step_profiler import StepProfiler
+from utils.validation import ValidationEngine, shared_cache_path
 
 from model.kronos import Kronos, KronosTokenizer
 
 
-def create_dataloaders(config: dict, rank: int, world_size: int):
+def create_dataloaders(config: dict, rank: int, world_size: int, pin_memory: bool = True):
     """
     Creates and returns distributed dataloaders for training and validation.
 
@@ -36,39 +44,75 @@ def create_dataloaders(config: dict, rank: int, world_size: int):
         config (dict): A dictionary of configuration parameters.
         rank (int): The global rank of the current process.
         world_size (int): The total number of processes.
+        pin_memory (bool): Whether to pin host memory (only useful for CUDA).
 
     Returns:
         tuple: (train_loader, val_loader, train_dataset, valid_dataset).
     """
     print(f"[Rank {rank}] Creating distributed dataloaders...")
-    train_dataset = QlibDataset('train')
-    valid_dataset = QlibDataset('val')
+    dataset_cls = PackedQlibDataset if config['use_packing'] else QlibDataset
+    train_dataset = dataset_cls('train')
+    valid_dataset = dataset_cls('val')
+    if config['val_subsample']:
+        # Validate on a smaller fixed subset; the unshuffled sampler picks the same one every epoch.
+        valid_dataset.n_samples = min(valid_dataset.n_samples, config['val_subsample'])
     print(f"[Rank {rank}] Train dataset size: {len(train_dataset)}, Validation dataset size: {len(valid_dataset)}")
 
-    train_sampler = DistributedSampler(train_dataset, num_replicas=world_size, rank=rank, shuffle=True)
-    val_sampler = DistributedSampler(valid_dataset, num_replicas=world_size, rank=rank, shuffle=False)
+    train_sampler = WindowSampler(train_dataset, num_replicas=world_size, rank=rank, shuffle=True, seed=config['seed'])
+    val_sampler = WindowSampler(valid_dataset, num_replicas=world_size, rank=rank, shuffle=False, seed=config['seed'])
 
     train_loader = DataLoader(
         train_dataset, batch_size=config['batch_size'], sampler=train_sampler,
-        num_workers=config.get('num_workers', 2), pin_memory=True, drop_last=True
+        num_workers=config.get('num_workers', 2), pin_memory=pin_memory, drop_last=True
     )
     val_loader = DataLoader(
         valid_dataset, batch_size=config['batch_size'], sampler=val_sampler,
-        num_workers=config.get('num_workers', 2), pin_memory=True, drop_last=False
+        num_workers=config.get('num_workers', 2), pin_memory=pin_memory, drop_last=False
     )
     return train_loader, val_loader, train_dataset, valid_dataset
 
 
-def train_model(model, tokenizer, device, config, save_dir, logger, rank, world_size):
+def unpack_batch(batch, device):
+    """
+    Moves a (x, x_stamp) or packed (x, x_stamp, segment_ids) batch to `device`.
+
+    Returns:
+        tuple: (batch_x, batch_x_stamp, segment_ids), where segment_ids is None
+            for unpacked batches.
+    """
+    tensors = [t.squeeze(0).to(device, non_blocking=True) for t in batch]
+    if len(tensors) == 2:
+        tensors.append(None)
+    return tuple(tensors)
+
+
+def train_model(model, tokenizer, device, config, save_dir, logger, rank, world_size, export_model=None):
     """
     The main training and validation loop for the predictor.
+
+    A full checkpoint (model, optimizer, scheduler, grad scaler, counters and
+    RNG state) is written asynchronously by rank 0 after every epoch. If
+    `config['resume']` is set, training continues from that checkpoint.
     """
     start_time = time.time()
+    accumulation_steps = config['accumulation_steps']
+    # Accumulation splits each loaded batch into equal micro-batches (the train loader drops
+    # the last partial batch), so it adds no samples to an optimizer step.
+    if accumulation_steps < 1 or config['batch_size'] % accumulation_steps != 0:
+        raise ValueError(
+            f"batch_size ({config['batch_size']}) must be a multiple of accumulation_steps ({accumulation_steps})"
+        )
     if rank == 0:
         effective_bs = config['batch_size'] * world_size
-        print(f"Effective BATCHSIZE per GPU: {config['batch_size']}, Total: {effective_bs}")
+        print(f"Effective BATCHSIZE per rank: {config['batch_size']} "
+              f"({accumulation_steps} micro-batches of {config['batch_size'] // accumulation_steps}), "
+              f"Total: {effective_bs}")
 
-    train_loader, val_loader, train_dataset, valid_dataset = create_dataloaders(config, rank, world_size)
+    train_loader, val_loader, train_dataset, valid_dataset = create_dataloaders(
+        config, rank, world_size, pin_memory=device.type == 'cuda'
+    )
+    # The underlying model, whether or not it is wrapped in DDP.
+    model_ref = model.module if world_size > 1 else model
 
     optimizer = torch.optim.AdamW(
         model.parameters(),
@@ -82,40 +126,131 @@ def train_model(model, tokenizer, device, config, save_dir, logger, rank, world_
         pct_start=0.03, div_factor=10
     )
 
+    # Mixed precision: fp16 needs loss scaling, bf16 has enough range without it.
+    amp_dtype = resolve_amp_dtype(device.type, config['amp_dtype'])
+    use_amp = config['use_amp']
+    scaler = torch.amp.GradScaler('cuda', enabled=use_amp and amp_dtype == torch.float16)
+
+    # Validation batches are tokenized once by the frozen tokenizer and cached across epochs.
+    def prepare_val_batch(batch):
+        batch_x, batch_x_stamp, segment_ids = unpack_batch(batch, device)
+        token_seq_0, token_seq_1 = tokenizer.encode(batch_x, half=True, segment_ids=segment_ids)
+        return token_seq_0, token_seq_1, batch_x_stamp, segment_ids
+
+    def evaluate_val_batch(batch):
+        token_seq_0, token_seq_1, batch_x_stamp, segment_ids = batch
+        token_in = [token_seq_0[:, :-1], token_seq_1[:, :-1]]
+        token_out = [token_seq_0[:, 1:], token_seq_1[:, 1:]]
+        segment_in = segment_ids[:, :-1] if segment_ids is not None else None
+        loss_mask = packed_loss_mask(segment_ids) if segment_ids is not None else None
+
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+            logits = model(token_in[0], token_in[1], batch_x_stamp[:, :-1, :], segment_ids=segment_in)
+            val_loss, _, _ = model_ref.head.compute_loss(
+                logits[0], logits[1], token_out[0], token_out[1], padding_mask=loss_mask
+            )
+        # The reported loss is the mean of the per-batch losses.
+        return val_loss, 1
+
+    validator = ValidationEngine(
+        val_loader, prepare_val_batch, evaluate_val_batch, device, world_size,
+        every_n_epochs=config['val_every_n_epochs'], cache=config['val_cache'],
+        cache_on_device=config['val_cache_on_device'],
+        cache_path=shared_cache_path(config, 'predictor', rank, world_size),
+    )
+    if config['prepare_val_cache']:
+        validator.prepare()
+        return {}
+
     best_val_loss = float('inf')
     dt_result = {}
     batch_idx_global = 0
+    start_epoch = 0
+
+    checkpoint_manager = CheckpointManager(
+        os.path.join(save_dir, 'checkpoints'), keep_last=config['keep_last_checkpoints'],
+        async_save=config['async_checkpointing'], export_model=export_model,
+    )
+    if config['resume']:
+        state = checkpoint_manager.load(None if config['resume'] == 'latest' else config['resume'])
+        model_ref.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        scheduler.load_state_dict(state['scheduler'])
+        scaler.load_state_dict(state['scaler'])
+        start_epoch = state['epoch'] + 1
+        batch_idx_global = state['batch_idx_global']
+        best_val_loss = state['best_val_loss']
+        # Only rank 0's RNG state is saved; other ranks reseed deterministically.
+        if rank == 0:
+            set_rng_state(state['rng'])
+        else:
+            set_seed(config['seed'] + start_epoch, rank)
+        del state
+
+    # Per-step timings and memory, written to step_stats_rank<rank>.jsonl when enabled.
+    profiler = StepProfiler(
+        os.path.join(save_dir, f"step_stats_rank{rank}.jsonl"), device, enabled=config['profile_steps'],
+        trace_steps=config['torch_profiler_steps'], trace_dir=os.path.join(save_dir, 'profiler', f"rank{rank}"),
+    )
+    if world_size > 1:
+        profiler.attach_comm_timer(model)
 
-    for epoch_idx in range(config['epochs']):
+    for epoch_idx in range(start_epoch, config['epochs']):
         epoch_start_time = time.time()
         model.train()
         train_loader.sampler.set_epoch(epoch_idx)
 
-        train_dataset.set_epoch_seed(epoch_idx * 10000 + rank)
-        valid_dataset.set_epoch_seed(0)
-
-        for i, (batch_x, batch_x_stamp) in enumerate(train_loader):
-            batch_x = batch_x.squeeze(0).to(device, non_blocking=True)
-            batch_x_stamp = batch_x_stamp.squeeze(0).to(device, non_blocking=True)
+        for i, batch in enumerate(profiler.iter_loader(train_loader)):
+            batch_x, batch_x_stamp, segment_ids = unpack_batch(batch, device)
 
             # Tokenize input data on-the-fly
-            with torch.no_grad():
-                token_seq_0, token_seq_1 = tokenizer.encode(batch_x, half=True)
+            with profiler.phase('tokenize'), torch.no_grad():
+                token_seq_0, token_seq_1 = tokenizer.encode(batch_x, half=True, segment_ids=segment_ids)
 
             # Prepare inputs and targets for the language model
             token_in = [token_seq_0[:, :-1], token_seq_1[:, :-1]]
             token_out = [token_seq_0[:, 1:], token_seq_1[:, 1:]]
-
-            # Forward pass and loss calculation
-            logits = model(token_in[0], token_in[1], batch_x_stamp[:, :-1, :])
-            loss, s1_loss, s2_loss = model.module.head.compute_loss(logits[0], logits[1], token_out[0], token_out[1])
-
-            # Backward pass and optimization
-            optimizer.zero_grad()
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=3.0)
-            optimizer.step()
-            scheduler.step()
+            # Packed rows: attention stays within each segment, and targets that cross a
+            # segment boundary or fall in padding are left out of the loss.
+            segment_in = segment_ids[:, :-1] if segment_ids is not None else None
+            loss_mask = packed_loss_mask(segment_ids) if segment_ids is not None else None
+
+            # --- Gradient Accumulation Loop ---
+            micro_batch_size = batch_x.shape[0] // accumulation_steps
+            loss, s1_loss, s2_loss = 0.0, 0.0, 0.0
+            for j in range(accumulation_steps):
+                micro = slice(j * micro_batch_size, (j + 1) * micro_batch_size)
+                micro_segments = segment_in[micro] if segment_in is not None else None
+                micro_mask = loss_mask[micro] if loss_mask is not None else None
+
+                # Skip the DDP gradient all-reduce on all but the last micro-step.
+                is_last_step = j == accumulation_steps - 1
+                sync_context = model.no_sync() if world_size > 1 and not is_last_step else contextlib.nullcontext()
+                with sync_context:
+                    # Forward pass and loss calculation
+                    autocast = torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp)
+                    with profiler.phase('forward'), autocast:
+                        logits = model(token_in[0][micro], token_in[1][micro], batch_x_stamp[micro, :-1, :],
+                                       segment_ids=micro_segments)
+                        micro_loss, micro_s1_loss, micro_s2_loss = model_ref.head.compute_loss(
+                            logits[0], logits[1], token_out[0][micro], token_out[1][micro], padding_mask=micro_mask
+                        )
+                    with profiler.phase('backward'):
+                        scaler.scale(micro_loss / accumulation_steps).backward()
+
+                loss += micro_loss.detach() / accumulation_steps
+                s1_loss += micro_s1_loss.detach() / accumulation_steps
+                s2_loss += micro_s2_loss.detach() / accumulation_steps
+
+            # --- Optimizer Step after Accumulation ---
+            with profiler.phase('optimizer'):
+                scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=3.0)
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+                scheduler.step()
+            profiler.end_step(samples=batch_x.shape[0], tokens=batch_x.shape[0] * batch_x.shape[1])
 
             # Logging (Master Process Only)
             if rank == 0 and (batch_idx_global + 1) % config['log_interval'] == 0:
@@ -125,72 +260,75 @@ def train_model(model, tokenizer, device, config, save_dir, logger, rank, world_
                     f"LR {lr:.6f}, Loss: {loss.item():.4f}"
                 )
             if rank == 0 and logger:
+                # Detached tensors; the logger converts them on its background thread.
                 lr = optimizer.param_groups[0]['lr']
-                logger.log_metric('train_predictor_loss_batch', loss.item(), step=batch_idx_global)
-                logger.log_metric('train_S1_loss_each_batch', s1_loss.item(), step=batch_idx_global)
-                logger.log_metric('train_S2_loss_each_batch', s2_loss.item(), step=batch_idx_global)
+                logger.log_metric('train_predictor_loss_batch', loss, step=batch_idx_global)
+                logger.log_metric('train_S1_loss_each_batch', s1_loss, step=batch_idx_global)
+                logger.log_metric('train_S2_loss_each_batch', s2_loss, step=batch_idx_global)
                 logger.log_metric('predictor_learning_rate', lr, step=batch_idx_global)
 
             batch_idx_global += 1
 
-        # --- Validation Loop ---
-        model.eval()
-        tot_val_loss_sum_rank = 0.0
-        val_batches_processed_rank = 0
-        with torch.no_grad():
-            for batch_x, batch_x_stamp in val_loader:
-                batch_x = batch_x.squeeze(0).to(device, non_blocking=True)
-                batch_x_stamp = batch_x_stamp.squeeze(0).to(device, non_blocking=True)
-
-                token_seq_0, token_seq_1 = tokenizer.encode(batch_x, half=True)
-                token_in = [token_seq_0[:, :-1], token_seq_1[:, :-1]]
-                token_out = [token_seq_0[:, 1:], token_seq_1[:, 1:]]
-
-                logits = model(token_in[0], token_in[1], batch_x_stamp[:, :-1, :])
-                val_loss, _, _ = model.module.head.compute_loss(logits[0], logits[1], token_out[0], token_out[1])
-
-                tot_val_loss_sum_rank += val_loss.item()
-                val_batches_processed_rank += 1
-
-        # Reduce validation metrics
-        val_loss_sum_tensor = torch.tensor(tot_val_loss_sum_rank, device=device)
-        val_batches_tensor = torch.tensor(val_batches_processed_rank, device=device)
-        dist.all_reduce(val_loss_sum_tensor, op=dist.ReduceOp.SUM)
-        dist.all_reduce(val_batches_tensor, op=dist.ReduceOp.SUM)
-
-        avg_val_loss = val_loss_sum_tensor.item() / val_batches_tensor.item() if val_batches_tensor.item() > 0 else 0
+        # --- Validation ---
+        avg_val_loss = None
+        if validator.should_run(epoch_idx, config['epochs']):
+            model.eval()
+            avg_val_loss = validator.run()
 
         # --- End of Epoch Summary & Checkpointing (Master Process Only) ---
         if rank == 0:
             print(f"\n--- Epoch {epoch_idx + 1}/{config['epochs']} Summary ---")
-            print(f"Validation Loss: {avg_val_loss:.4f}")
+            if avg_val_loss is not None:
+                print(f"Validation Loss: {avg_val_loss:.4f}")
+            else:
+                print(f"Validation skipped (every {config['val_every_n_epochs']} epochs)")
+            if config['profile_steps']:
+                print(f"Throughput (rank 0): {StepProfiler.format_summary(profiler.summary())}")
             print(f"Time This Epoch: {format_time(time.time() - epoch_start_time)}")
             print(f"Total Time Elapsed: {format_time(time.time() - start_time)}\n")
-            if logger:
+            if logger and avg_val_loss is not None:
                 logger.log_metric('val_predictor_loss_epoch', avg_val_loss, epoch=epoch_idx)
 
-            if avg_val_loss < best_val_loss:
+            is_best = avg_val_loss is not None and avg_val_loss < best_val_loss
+            if is_best:
                 best_val_loss = avg_val_loss
-                save_path = f"{save_dir}/checkpoints/best_model"
-                model.module.save_pretrained(save_path)
-                print(f"Best model saved to {save_path} (Val Loss: {best_val_loss:.4f})")
-
-        dist.barrier()
-
+            # Only the copy to host memory blocks here; the write happens in the background.
+            checkpoint_manager.save({
+                'model': model_ref.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict(),
+                'scaler': scaler.state_dict(),
+                'epoch': epoch_idx,
+                'batch_idx_global': batch_idx_global,
+                'best_val_loss': best_val_loss,
+                'rng': get_rng_state(),
+            }, epoch=epoch_idx, is_best=is_best)
+            if is_best:
+                print(f"Best model will be saved to {checkpoint_manager.best_model_dir} (Val Loss: {best_val_loss:.4f})")
+
+        if world_size > 1:
+            dist.barrier()
+
+    profiler.close()
+    checkpoint_manager.close()
     dt_result['best_val_loss'] = best_val_loss
     return dt_result
 
 
 def main(config: dict):
     """Main function to orchestrate the DDP training process."""
-    rank, world_size, local_rank = setup_ddp()
-    device = torch.device(f"cuda:{local_rank}")
+    device_type = resolve_device_type(config['train_device'])
+    rank, world_size, local_rank = setup_ddp(device_type)
+    device = get_device(device_type, local_rank)
+    if device_type == 'cpu':
+        num_threads = set_cpu_threads(config['cpu_threads_per_rank'])
+        print(f"[Rank {rank}] Using {num_threads} CPU threads")
     set_seed(config['seed'], rank)
 
     save_dir = os.path.join(config['save_path'], config['predictor_save_folder_name'])
 
     # Logger and summary setup (master process only)
-    comet_logger, master_summary = None, {}
+    logger, master_summary = None, {}
     if rank == 0:
         os.makedirs(os.path.join(save_dir, 'checkpoints'), exist_ok=True)
         master_summary = {
@@ -198,18 +336,12 @@ def main(config: dict):
             'save_directory': save_dir,
             'world_size': world_size,
         }
-        if config['use_comet']:
-            comet_logger = comet_ml.Experiment(
-                api_key=config['comet_config']['api_key'],
-                project_name=config['comet_config']['project_name'],
-                workspace=config['comet_config']['workspace'],
-            )
-            comet_logger.add_tag(config['comet_tag'])
-            comet_logger.set_name(config['comet_name'])
-            comet_logger.log_parameters(config)
-            print("Comet Logger Initialized.")
+        logger = create_logger(config, os.path.join(save_dir, 'logs'))
+        if logger:
+            logger.log_parameters(config)
 
-    dist.barrier()
+    if world_size > 1:
+        dist.barrier()
 
     # Model Initialization
     tokenizer = KronosTokenizer.from_pretrained(config['finetuned_tokenizer_path'])
@@ -217,14 +349,22 @@ def main(config: dict):
 
     model = Kronos.from_pretrained(config['pretrained_predictor_path'])
     model.to(device)
-    model = DDP(model, device_ids=[local_rank], find_unused_parameters=False)
-
+    if config['gradient_checkpointing']:
+        model.set_gradient_checkpointing(True)
+    model_ref = model
+    if world_size > 1:
+        device_ids = [local_rank] if device_type == 'cuda' else None
+        model = DDP(model, device_ids=device_ids, find_unused_parameters=False)
+
+    # CPU copy used by rank 0's checkpoint manager to export the best model in the background.
+    export_model = None
     if rank == 0:
-        print(f"Predictor Model Size: {get_model_size(model.module)}")
+        print(f"Predictor Model Size: {get_model_size(model_ref)}")
+        export_model = Kronos.from_pretrained(config['pretrained_predictor_path'])
 
     # Start Training
     dt_result = train_model(
-        model, tokenizer, device, config, save_dir, comet_logger, rank, world_size
+        model, tokenizer, device, config, save_dir, logger, rank, world_size, export_model=export_model
     )
 
     if rank == 0:
@@ -232,15 +372,30 @@ def main(config: dict):
         with open(os.path.join(save_dir, 'summary.json'), 'w') as f:
             json.dump(master_summary, f, indent=4)
         print('Training finished. Summary file saved.')
-        if comet_logger: comet_logger.end()
+        if logger:
+            logger.end()
 
     cleanup_ddp()
 
 
 if __name__ == '__main__':
     # Usage: torchrun --standalone --nproc_per_node=NUM_GPUS train_predictor.py
+    # CPU DDP: set `train_device = 'cpu'` and launch with torchrun (gloo backend), e.g.
+    #   torchrun --nnodes=2 --nproc_per_node=NUM_SOCKETS ... train_predictor.py
+    # Single process: python train_predictor.py
+    parser = argparse.ArgumentParser(description="Fine-tune the Kronos predictor")
+    parser.add_argument("--resume", nargs="?", const="latest", default=None,
+                        help="Resume from the latest checkpoint, or from the given checkpoint file")
+    parser.add_argument("--overrides", default=None,
+                        help="JSON file of Config attribute overrides (used by sweep.py)")
+    args = parser.parse_args()
+
     if "WORLD_SIZE" not in os.environ:
-        raise RuntimeError("This script must be launched with `torchrun`.")
+        print("未检测到 torchrun 环境，将以单进程模式运行")
 
     config_instance = Config()
+    if args.overrides:
+        with open(args.overrides, 'r') as f:
+            config_instance.update(json.load(f))
+    config_instance.resume = args.resume
     main(config_instance.__dict__)
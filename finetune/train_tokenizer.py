@@ -1,34 +1,40 @@
+import argparse
 import json
 import os
 import sys
 import time
 from time import gmtime, strftime
 
-import comet_ml
 import torch
 import torch.distributed as dist
 import torch.nn.functional as F
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data import DataLoader
-from torch.utils.data.distributed import DistributedSampler
 
 # Ensure project root is in path
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from finetune.config import Config
-from finetune.dataset import QlibDataset
+from finetune.dataset import QlibDataset, WindowSampler
 
 # Import shared utilities
+from finetune.utils.checkpoint_manager import CheckpointManager, get_rng_state, set_rng_state
+from finetune.utils.experiment_logger import create_logger
 from finetune.utils.training_utils import (
     cleanup_ddp,
     format_time,
+    get_device,
     get_model_size,
+    resolve_device_type,
+    set_cpu_threads,
     set_seed,
     setup_ddp,
 )
+from finetune.utils.step_profiler import StepProfiler
+from finetune.utils.validation import ValidationEngine, shared_cache_path
 from model.kronos import KronosTokenizer
 
 
-def create_dataloaders(config: dict, rank: int, world_size: int):
+def create_dataloaders(config: dict, rank: int, world_size: int, pin_memory: bool = True):
     """
     Creates and returns distributed dataloaders for training and validation.
 
@@ -36,6 +42,7 @@ def create_dataloaders(config: dict, rank: int, world_size: int):
         config (dict): A dictionary of configuration parameters.
         rank (int): The global rank of the current process.
         world_size (int): The total number of processes.
+        pin_memory (bool): Whether to pin host memory (only useful for CUDA).
 
     Returns:
         tuple: A tuple containing (train_loader, val_loader, train_dataset, valid_dataset).
@@ -43,52 +50,53 @@ def create_dataloaders(config: dict, rank: int, world_size: int):
     print(f"[Rank {rank}] Creating distributed dataloaders...")
     train_dataset = QlibDataset('train')
     valid_dataset = QlibDataset('val')
+    if config['val_subsample']:
+        # Validate on a smaller fixed subset; the unshuffled sampler picks the same one every epoch.
+        valid_dataset.n_samples = min(valid_dataset.n_samples, config['val_subsample'])
     print(f"[Rank {rank}] Train dataset size: {len(train_dataset)}, Validation dataset size: {len(valid_dataset)}")
 
-    # 根据是否为分布式模式选择不同的采样器
-    if world_size > 1:
-        train_sampler = DistributedSampler(train_dataset, num_replicas=world_size, rank=rank, shuffle=True)
-        val_sampler = DistributedSampler(valid_dataset, num_replicas=world_size, rank=rank, shuffle=False)
-        shuffle_train = False  # Shuffle is handled by the sampler
-    else:
-        train_sampler = None
-        val_sampler = None
-        shuffle_train = True
+    # The sampler shards each epoch's window permutation across ranks (world_size=1 in single-process mode).
+    train_sampler = WindowSampler(train_dataset, num_replicas=world_size, rank=rank, shuffle=True, seed=config['seed'])
+    val_sampler = WindowSampler(valid_dataset, num_replicas=world_size, rank=rank, shuffle=False, seed=config['seed'])
 
     train_loader = DataLoader(
         train_dataset,
         batch_size=config['batch_size'],
         sampler=train_sampler,
-        shuffle=shuffle_train,
         num_workers=config.get('num_workers', 2),
-        pin_memory=True,
+        pin_memory=pin_memory,
         drop_last=True
     )
     val_loader = DataLoader(
         valid_dataset,
         batch_size=config['batch_size'],
         sampler=val_sampler,
-        shuffle=False,
         num_workers=config.get('num_workers', 2),
-        pin_memory=True,
+        pin_memory=pin_memory,
         drop_last=False
     )
     print(f"[Rank {rank}] Dataloaders created. Train steps/epoch: {len(train_loader)}, Val steps: {len(val_loader)}")
     return train_loader, val_loader, train_dataset, valid_dataset
 
 
-def train_model(model, device, config, save_dir, logger, rank, world_size):
+def train_model(model, device, config, save_dir, logger, rank, world_size, export_model=None):
     """
     The main training and validation loop for the tokenizer.
 
+    A full checkpoint (model, optimizer, scheduler, counters and RNG state) is
+    written asynchronously by rank 0 after every epoch. If `config['resume']`
+    is set, training continues from that checkpoint.
+
     Args:
         model (DDP): The DDP-wrapped model to train.
         device (torch.device): The device for the current process.
         config (dict): Configuration dictionary.
         save_dir (str): Directory to save checkpoints.
-        logger (comet_ml.Experiment): Comet logger instance.
+        logger (ExperimentLogger): Experiment logger, or None.
         rank (int): Global rank of the process.
         world_size (int): Total number of processes.
+        export_model (KronosTokenizer, optional): CPU model used by rank 0 to export
+            the best weights with `save_pretrained`.
 
     Returns:
         tuple: A tuple containing the trained model and a dictionary of results.
@@ -96,10 +104,12 @@ def train_model(model, device, config, save_dir, logger, rank, world_size):
     start_time = time.time()
     if rank == 0:
         effective_bs = config['batch_size'] * world_size * config['accumulation_steps']
-        print(f"[Rank {rank}] BATCHSIZE (per GPU): {config['batch_size']}")
+        print(f"[Rank {rank}] BATCHSIZE (per rank): {config['batch_size']}")
         print(f"[Rank {rank}] Effective total batch size: {effective_bs}")
 
-    train_loader, val_loader, train_dataset, valid_dataset = create_dataloaders(config, rank, world_size)
+    train_loader, val_loader, train_dataset, valid_dataset = create_dataloaders(
+        config, rank, world_size, pin_memory=device.type == 'cuda'
+    )
 
     optimizer = torch.optim.AdamW(
         model.parameters(),
@@ -119,20 +129,62 @@ def train_model(model, device, config, save_dir, logger, rank, world_size):
     best_val_loss = float('inf')
     dt_result = {}
     batch_idx_global_train = 0
+    start_epoch = 0
+    # 根据是否为 DDP 模式选择正确的模型引用
+    model_ref = model.module if world_size > 1 else model
+
+    # Validation windows are fixed, so they are loaded and normalized once and cached across epochs.
+    def evaluate_val_batch(batch):
+        (ori_batch_x,) = batch
+        zs, _, _, _ = model(ori_batch_x)
+        _, z = zs
+        return F.mse_loss(z, ori_batch_x) * ori_batch_x.size(0), ori_batch_x.size(0)
+
+    validator = ValidationEngine(
+        val_loader, lambda batch: (batch[0].squeeze(0).to(device, non_blocking=True),), evaluate_val_batch,
+        device, world_size, every_n_epochs=config['val_every_n_epochs'], cache=config['val_cache'],
+        cache_on_device=config['val_cache_on_device'],
+        cache_path=shared_cache_path(config, 'tokenizer', rank, world_size),
+    )
+    if config['prepare_val_cache']:
+        validator.prepare()
+        return model, dt_result
+
+    checkpoint_manager = CheckpointManager(
+        os.path.join(save_dir, 'checkpoints'), keep_last=config['keep_last_checkpoints'],
+        async_save=config['async_checkpointing'], export_model=export_model,
+    )
+    if config['resume']:
+        state = checkpoint_manager.load(None if config['resume'] == 'latest' else config['resume'])
+        model_ref.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        scheduler.load_state_dict(state['scheduler'])
+        start_epoch = state['epoch'] + 1
+        batch_idx_global_train = state['batch_idx_global']
+        best_val_loss = state['best_val_loss']
+        # Only rank 0's RNG state is saved; other ranks reseed deterministically.
+        if rank == 0:
+            set_rng_state(state['rng'])
+        else:
+            set_seed(config['seed'] + start_epoch, rank)
+        del state
+
+    # Per-step timings and memory, written to step_stats_rank<rank>.jsonl when enabled.
+    profiler = StepProfiler(
+        os.path.join(save_dir, f"step_stats_rank{rank}.jsonl"), device, enabled=config['profile_steps'],
+        trace_steps=config['torch_profiler_steps'], trace_dir=os.path.join(save_dir, 'profiler', f"rank{rank}"),
+    )
+    if world_size > 1:
+        profiler.attach_comm_timer(model)
 
-    for epoch_idx in range(config['epochs']):
+    for epoch_idx in range(start_epoch, config['epochs']):
         epoch_start_time = time.time()
         model.train()
 
-        # 只有分布式模式才设置 epoch
-        if world_size > 1 and hasattr(train_loader.sampler, 'set_epoch'):
-            train_loader.sampler.set_epoch(epoch_idx)
+        # Draw a fresh window permutation for this epoch
+        train_loader.sampler.set_epoch(epoch_idx)
 
-        # Set dataset seeds for reproducible sampling
-        train_dataset.set_epoch_seed(epoch_idx * 10000 + rank)
-        valid_dataset.set_epoch_seed(0)  # Keep validation sampling consistent
-
-        for i, (ori_batch_x, _) in enumerate(train_loader):
+        for i, (ori_batch_x, _) in enumerate(profiler.iter_loader(train_loader)):
             ori_batch_x = ori_batch_x.squeeze(0).to(device, non_blocking=True)
 
             # --- Gradient Accumulation Loop ---
@@ -142,25 +194,29 @@ def train_model(model, device, config, save_dir, logger, rank, world_size):
                 end_idx = (j + 1) * (ori_batch_x.shape[0] // config['accumulation_steps'])
                 batch_x = ori_batch_x[start_idx:end_idx]
 
-                # Forward pass
-                zs, bsq_loss, _, _ = model(batch_x)
-                z_pre, z = zs
+                with profiler.phase('forward'):
+                    # Forward pass
+                    zs, bsq_loss, _, _ = model(batch_x)
+                    z_pre, z = zs
 
-                # Loss calculation
-                recon_loss_pre = F.mse_loss(z_pre, batch_x)
-                recon_loss_all = F.mse_loss(z, batch_x)
-                recon_loss = recon_loss_pre + recon_loss_all
-                loss = (recon_loss + bsq_loss) / 2  # Assuming w_1=w_2=1
+                    # Loss calculation
+                    recon_loss_pre = F.mse_loss(z_pre, batch_x)
+                    recon_loss_all = F.mse_loss(z, batch_x)
+                    recon_loss = recon_loss_pre + recon_loss_all
+                    loss = (recon_loss + bsq_loss) / 2  # Assuming w_1=w_2=1
 
                 loss_scaled = loss / config['accumulation_steps']
                 current_batch_total_loss += loss.item()
-                loss_scaled.backward()
+                with profiler.phase('backward'):
+                    loss_scaled.backward()
 
             # --- Optimizer Step after Accumulation ---
-            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=2.0)
-            optimizer.step()
-            scheduler.step()
-            optimizer.zero_grad()
+            with profiler.phase('optimizer'):
+                torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=2.0)
+                optimizer.step()
+                scheduler.step()
+                optimizer.zero_grad()
+            profiler.end_step(samples=ori_batch_x.shape[0], tokens=ori_batch_x.shape[0] * ori_batch_x.shape[1])
 
             # --- Logging (Master Process Only) ---
             if rank == 0 and (batch_idx_global_train + 1) % config['log_interval'] == 0:
@@ -172,61 +228,58 @@ def train_model(model, device, config, save_dir, logger, rank, world_size):
             if rank == 0 and logger:
                 avg_loss = current_batch_total_loss / config['accumulation_steps']
                 logger.log_metric('train_tokenizer_loss_batch', avg_loss, step=batch_idx_global_train)
-                logger.log_metric('train_vqvae_vq_loss_each_batch', bsq_loss.item(), step=batch_idx_global_train)
-                logger.log_metric('train_recon_loss_pre_each_batch', recon_loss_pre.item(), step=batch_idx_global_train)
-                logger.log_metric('train_recon_loss_each_batch', recon_loss_all.item(), step=batch_idx_global_train)
+                logger.log_metric('train_vqvae_vq_loss_each_batch', bsq_loss.detach(), step=batch_idx_global_train)
+                logger.log_metric('train_recon_loss_pre_each_batch', recon_loss_pre.detach(), step=batch_idx_global_train)
+                logger.log_metric('train_recon_loss_each_batch', recon_loss_all.detach(), step=batch_idx_global_train)
                 logger.log_metric('tokenizer_learning_rate', optimizer.param_groups[0]["lr"], step=batch_idx_global_train)
 
             batch_idx_global_train += 1
 
-        # --- Validation Loop ---
-        model.eval()
-        tot_val_loss_sum_rank = 0.0
-        val_sample_count_rank = 0
-        with torch.no_grad():
-            for ori_batch_x, _ in val_loader:
-                ori_batch_x = ori_batch_x.squeeze(0).to(device, non_blocking=True)
-                zs, _, _, _ = model(ori_batch_x)
-                _, z = zs
-                val_loss_item = F.mse_loss(z, ori_batch_x)
-
-                tot_val_loss_sum_rank += val_loss_item.item() * ori_batch_x.size(0)
-                val_sample_count_rank += ori_batch_x.size(0)
-
-        # Reduce validation losses from all processes
-        if world_size > 1:
-            val_loss_sum_tensor = torch.tensor(tot_val_loss_sum_rank, device=device)
-            val_count_tensor = torch.tensor(val_sample_count_rank, device=device)
-            dist.all_reduce(val_loss_sum_tensor, op=dist.ReduceOp.SUM)
-            dist.all_reduce(val_count_tensor, op=dist.ReduceOp.SUM)
-            avg_val_loss = val_loss_sum_tensor.item() / val_count_tensor.item() if val_count_tensor.item() > 0 else 0
-        else:
-            # 单进程模式直接计算平均值
-            avg_val_loss = tot_val_loss_sum_rank / val_sample_count_rank if val_sample_count_rank > 0 else 0
+        # --- Validation ---
+        avg_val_loss = None
+        if validator.should_run(epoch_idx, config['epochs']):
+            model.eval()
+            avg_val_loss = validator.run()
 
         # --- End of Epoch Summary & Checkpointing (Master Process Only) ---
         if rank == 0:
             print(f"\n--- Epoch {epoch_idx + 1}/{config['epochs']} Summary ---")
-            print(f"Validation Loss: {avg_val_loss:.4f}")
+            if avg_val_loss is not None:
+                print(f"Validation Loss: {avg_val_loss:.4f}")
+            else:
+                print(f"Validation skipped (every {config['val_every_n_epochs']} epochs)")
+            if config['profile_steps']:
+                print(f"Throughput (rank 0): {StepProfiler.format_summary(profiler.summary())}")
             print(f"Time This Epoch: {format_time(time.time() - epoch_start_time)}")
             print(f"Total Time Elapsed: {format_time(time.time() - start_time)}\n")
-            if logger:
+            if logger and avg_val_loss is not None:
                 logger.log_metric('val_tokenizer_loss_epoch', avg_val_loss, epoch=epoch_idx)
 
-            if avg_val_loss < best_val_loss:
+            is_best = avg_val_loss is not None and avg_val_loss < best_val_loss
+            if is_best:
                 best_val_loss = avg_val_loss
-                save_path = f"{save_dir}/checkpoints/best_model"
-                # 根据是否为 DDP 模式选择正确的模型引用
-                model_to_save = model.module if world_size > 1 else model
-                model_to_save.save_pretrained(save_path)
-                print(f"Best model saved to {save_path} (Val Loss: {best_val_loss:.4f})")
-                if logger:
-                    logger.log_model("best_model", save_path)
+            # Only the copy to host memory blocks here; the write happens in the background.
+            checkpoint_manager.save({
+                'model': model_ref.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict(),
+                'epoch': epoch_idx,
+                'batch_idx_global': batch_idx_global_train,
+                'best_val_loss': best_val_loss,
+                'rng': get_rng_state(),
+            }, epoch=epoch_idx, is_best=is_best)
+            if is_best:
+                print(f"Best model will be saved to {checkpoint_manager.best_model_dir} (Val Loss: {best_val_loss:.4f})")
 
         # 只有多进程模式才需要同步
         if world_size > 1:
             dist.barrier()  # Ensure all processes finish the epoch before starting the next one.
 
+    profiler.close()
+    checkpoint_manager.close()
+    if rank == 0 and logger and os.path.isdir(checkpoint_manager.best_model_dir):
+        logger.log_model("best_model", checkpoint_manager.best_model_dir)
+
     dt_result['best_val_loss'] = best_val_loss
     return model, dt_result
 
@@ -235,14 +288,18 @@ def main(config: dict):
     """
     Main function to orchestrate the DDP training process.
     """
-    rank, world_size, local_rank = setup_ddp()
-    device = torch.device(f"cuda:{local_rank}")
+    device_type = resolve_device_type(config['train_device'])
+    rank, world_size, local_rank = setup_ddp(device_type)
+    device = get_device(device_type, local_rank)
+    if device_type == 'cpu':
+        num_threads = set_cpu_threads(config['cpu_threads_per_rank'])
+        print(f"[Rank {rank}] Using {num_threads} CPU threads")
     set_seed(config['seed'], rank)
 
     save_dir = os.path.join(config['save_path'], config['tokenizer_save_folder_name'])
 
     # Logger and summary setup (master process only)
-    comet_logger, master_summary = None, {}
+    logger, master_summary = None, {}
     if rank == 0:
         os.makedirs(os.path.join(save_dir, 'checkpoints'), exist_ok=True)
         master_summary = {
@@ -250,16 +307,9 @@ def main(config: dict):
             'save_directory': save_dir,
             'world_size': world_size,
         }
-        if config['use_comet']:
-            comet_logger = comet_ml.Experiment(
-                api_key=config['comet_config']['api_key'],
-                project_name=config['comet_config']['project_name'],
-                workspace=config['comet_config']['workspace'],
-            )
-            comet_logger.add_tag(config['comet_tag'])
-            comet_logger.set_name(config['comet_name'])
-            comet_logger.log_parameters(config)
-            print("Comet Logger Initialized.")
+        logger = create_logger(config, os.path.join(save_dir, 'logs'))
+        if logger:
+            logger.log_parameters(config)
 
     # 只有多进程模式才需要同步
     if world_size > 1:
@@ -268,21 +318,29 @@ def main(config: dict):
     # Model Initialization
     model = KronosTokenizer.from_pretrained(config['pretrained_tokenizer_path'])
     model.to(device)
+    if config['gradient_checkpointing']:
+        model.set_gradient_checkpointing(True)
+    if config['tokenizer_fused_decoder']:
+        model.set_fused_decoder(True)
 
     # 只有多进程模式才包装为 DDP
     if world_size > 1:
-        model = DDP(model, device_ids=[local_rank], find_unused_parameters=False)
+        device_ids = [local_rank] if device_type == 'cuda' else None
+        model = DDP(model, device_ids=device_ids, find_unused_parameters=False)
     else:
-        print("[单GPU模式] 跳过 DDP 包装")
+        print("[单进程模式] 跳过 DDP 包装")
 
+    # CPU copy used by rank 0's checkpoint manager to export the best model in the background.
+    export_model = None
     if rank == 0:
         # 根据是否为 DDP 模式选择正确的模型引用
         model_ref = model.module if world_size > 1 else model
         print(f"Model Size: {get_model_size(model_ref)}")
+        export_model = KronosTokenizer.from_pretrained(config['pretrained_tokenizer_path'])
 
     # Start Training
     _, dt_result = train_model(
-        model, device, config, save_dir, comet_logger, rank, world_size
+        model, device, config, save_dir, logger, rank, world_size, export_model=export_model
     )
 
     # Finalize and save summary (master process only)
@@ -291,24 +349,29 @@ def main(config: dict):
         with open(os.path.join(save_dir, 'summary.json'), 'w') as f:
             json.dump(master_summary, f, indent=4)
         print('Training finished. Summary file saved.')
-        if comet_logger:
-            comet_logger.end()
+        if logger:
+            logger.end()
 
     cleanup_ddp()
 
 
 if __name__ == '__main__':
     # Usage: torchrun --standalone --nproc_per_node=NUM_GPUS train_tokenizer.py
-    # 或者直接用 python train_tokenizer.py (单GPU模式)
+    # CPU DDP: set `train_device = 'cpu'` and launch with torchrun (gloo backend)
+    # 或者直接用 python train_tokenizer.py (单进程模式)
+    parser = argparse.ArgumentParser(description="Fine-tune the Kronos tokenizer")
+    parser.add_argument("--resume", nargs="?", const="latest", default=None,
+                        help="Resume from the latest checkpoint, or from the given checkpoint file")
+    parser.add_argument("--overrides", default=None,
+                        help="JSON file of Config attribute overrides (used by sweep.py)")
+    args = parser.parse_args()
 
     if "WORLD_SIZE" not in os.environ:
-        print("警告：未检测到分布式环境，将以单GPU模式运行")
-        # 设置单进程环境变量
-        os.environ["RANK"] = "0"
-        os.environ["WORLD_SIZE"] = "1"
-        os.environ["LOCAL_RANK"] = "0"
-        os.environ["MASTER_ADDR"] = "localhost"
-        os.environ["MASTER_PORT"] = "12355"
+        print("警告：未检测到分布式环境，将以单进程模式运行")
 
     config_instance = Config()
+    if args.overrides:
+        with open(args.overrides, 'r') as f:
+            config_instance.update(json.load(f))
+    config_instance.resume = args.resume
     main(config_instance.__dict__)
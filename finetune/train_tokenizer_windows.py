@@ -17,7 +17,7 @@ from torch.utils.data import DataLoader
 # Ensure project root is in path
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from finetune.config import Config
-from finetune.dataset import QlibDataset
+from finetune.dataset import QlibDataset, WindowSampler
 
 # Import shared utilities
 from finetune.utils.training_utils import (
@@ -47,7 +47,7 @@ def create_dataloaders(config: dict):
     train_loader = DataLoader(
         train_dataset,
         batch_size=config.batch_size,
-        shuffle=True,
+        sampler=WindowSampler(train_dataset, shuffle=True, seed=config.seed),
         num_workers=0,  # Windows 上设置为 0 避免多进程问题
         pin_memory=True if torch.cuda.is_available() else False
     )
@@ -55,7 +55,7 @@ def create_dataloaders(config: dict):
     val_loader = DataLoader(
         valid_dataset,
         batch_size=config.batch_size,
-        shuffle=False,
+        sampler=WindowSampler(valid_dataset, shuffle=False, seed=config.seed),
         num_workers=0,  # Windows 上设置为 0 避免多进程问题
         pin_memory=True if torch.cuda.is_available() else False
     )
@@ -299,6 +299,7 @@ def main():
         print("-" * 50)
         
         # 训练
+        train_loader.sampler.set_epoch(epoch)
         train_loss = train_epoch(model, train_loader, optimizer, device, epoch, config)
         train_losses.append(train_loss)
         
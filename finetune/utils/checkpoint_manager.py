@@ -0,0 +1,184 @@
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import os
+import random
+import re
+import shutil
+
+import numpy as np
+import torch
+
+
+def snapshot_to_cpu(obj):
+    """
+    Recursively copies every tensor in a (nested) state object to CPU memory.
+
+    The copy decouples the snapshot from the live model and optimizer, so it can
+    be written from a background thread while training continues.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot_to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(value) for value in obj)
+    return obj
+
+
+def checkpoint_fingerprint(path: str) -> list:
+    """
+    Identifies the current contents of a checkpoint file or directory.
+
+    Returns the relative name, size and modification time of every file under
+    `path` (empty if it does not exist). Caches keyed on this notice when a
+    checkpoint is retrained in place, which the path string alone does not.
+    """
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [[os.path.basename(path), stat.st_size, stat.st_mtime_ns]]
+    fingerprint = []
+    for root, _, files in sorted(os.walk(path)):
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            stat = os.stat(file_path)
+            fingerprint.append([os.path.relpath(file_path, path), stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+
+def get_rng_state() -> dict:
+    """Captures the Python, NumPy and torch (CPU and CUDA) RNG states."""
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: dict):
+    """Restores RNG states captured by `get_rng_state`."""
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointManager:
+    """
+    Saves full training checkpoints from a background thread.
+
+    `save` copies the given state to CPU memory on the calling thread, which is
+    the only part that blocks training, and hands the write to a single
+    background worker. Files are written under a temporary name and renamed
+    into place, so a crash never leaves a truncated checkpoint. The manager
+    keeps the last `keep_last` epoch checkpoints plus `best.pt`, and optionally
+    exports the best model weights in Hugging Face format via `export_model`.
+
+    Args:
+        checkpoint_dir (str): Directory for `epoch_XXXX.pt`, `best.pt` and `best_model/`.
+        keep_last (int): Number of most recent epoch checkpoints to keep.
+        async_save (bool): If False, `save` writes synchronously.
+        export_model (torch.nn.Module, optional): A CPU model of the same class as
+            the trained one. When a checkpoint is the best so far, its weights are
+            loaded into this model and written with `save_pretrained`.
+    """
+
+    def __init__(self, checkpoint_dir: str, keep_last: int = 3, async_save: bool = True, export_model=None):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = max(1, keep_last)
+        self.async_save = async_save
+        self.export_model = export_model
+        self._executor = ThreadPoolExecutor(max_workers=1) if async_save else None
+        self._pending = None
+
+    @property
+    def best_model_dir(self) -> str:
+        return os.path.join(self.checkpoint_dir, 'best_model')
+
+    def save(self, state: dict, epoch: int, is_best: bool = False):
+        """
+        Snapshots `state` and writes it as the checkpoint for `epoch`.
+
+        Args:
+            state (dict): Checkpoint contents (model/optimizer/scheduler state dicts,
+                counters, RNG state, ...). Must contain the model weights under 'model'.
+            epoch (int): The epoch the checkpoint belongs to.
+            is_best (bool): Also write it as `best.pt` and export the best model.
+        """
+        # At most one snapshot is in flight, which bounds the extra host memory.
+        self.wait()
+        snapshot = snapshot_to_cpu(state)
+        if self._executor is None:
+            self._write(snapshot, epoch, is_best)
+        else:
+            self._pending = self._executor.submit(self._write, snapshot, epoch, is_best)
+
+    def wait(self):
+        """Blocks until the pending write (if any) finishes, re-raising its errors."""
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+
+    def close(self):
+        """Waits for pending writes and stops the background worker."""
+        self.wait()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def latest_checkpoint(self):
+        """Returns the path of the most recent epoch checkpoint, or None."""
+        checkpoints = self._epoch_checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def load(self, path: str = None, map_location='cpu') -> dict:
+        """
+        Loads a checkpoint written by `save`.
+
+        Args:
+            path (str, optional): Checkpoint file. Defaults to the latest epoch checkpoint.
+            map_location: Passed to `torch.load`.
+
+        Raises:
+            FileNotFoundError: If no checkpoint exists.
+        """
+        path = path or self.latest_checkpoint()
+        if path is None or not os.path.exists(path):
+            raise FileNotFoundError(f"No checkpoint found to resume from in {self.checkpoint_dir}")
+        print(f"Resuming from checkpoint {path}")
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+    def _write(self, snapshot: dict, epoch: int, is_best: bool):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        path = os.path.join(self.checkpoint_dir, f"epoch_{epoch:04d}.pt")
+        self._atomic_save(snapshot, path)
+
+        if is_best:
+            best_path = os.path.join(self.checkpoint_dir, 'best.pt')
+            shutil.copyfile(path, f"{best_path}.tmp")
+            os.replace(f"{best_path}.tmp", best_path)
+            if self.export_model is not None:
+                self._export_best(snapshot['model'])
+
+        for old_path in self._epoch_checkpoints()[:-self.keep_last]:
+            os.remove(old_path)
+
+    def _export_best(self, model_state: dict):
+        self.export_model.load_state_dict(model_state)
+        tmp_dir = f"{self.best_model_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.export_model.save_pretrained(tmp_dir)
+        shutil.rmtree(self.best_model_dir, ignore_errors=True)
+        os.rename(tmp_dir, self.best_model_dir)
+
+    def _epoch_checkpoints(self) -> list:
+        paths = glob.glob(os.path.join(self.checkpoint_dir, 'epoch_*.pt'))
+        return sorted(p for p in paths if re.fullmatch(r'epoch_\d+\.pt', os.path.basename(p)))
+
+    @staticmethod
+    def _atomic_save(obj, path: str):
+        tmp_path = f"{path}.tmp"
+        torch.save(obj, tmp_path)
+        os.replace(tmp_path, path)
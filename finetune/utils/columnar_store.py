@@ -0,0 +1,218 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class SymbolStore:
+    """
+    A directory of per-symbol columnar files plus a JSON manifest.
+
+    Each symbol is stored as an uncompressed `.npz` archive with one array per
+    column (`datetime` as int64 nanoseconds, then one array per feature), so a
+    single symbol can be read or extended without touching the rest of the
+    universe. The manifest records every symbol's date range, row count and a
+    SHA-256 checksum of its column data, plus the symbols that were left out
+    for too short a history (see `mark_skipped`).
+
+    Args:
+        root (str): Directory holding the symbol files and `manifest.json`.
+        feature_list (list): Feature columns stored for every symbol.
+    """
+
+    MANIFEST_NAME = 'manifest.json'
+
+    def __init__(self, root: str, feature_list: list):
+        self.root = root
+        self.feature_list = list(feature_list)
+        self.manifest_path = os.path.join(self.root, self.MANIFEST_NAME)
+        self.manifest = {'feature_list': self.feature_list, 'symbols': {}, 'skipped': {}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+            self.manifest.setdefault('skipped', {})
+            if self.manifest['feature_list'] != self.feature_list:
+                raise ValueError(
+                    f"Store at {self.root} holds features {self.manifest['feature_list']}, "
+                    f"expected {self.feature_list}. Rebuild it without --incremental."
+                )
+
+    def exists(self) -> bool:
+        """Returns True if the store has a manifest on disk."""
+        return os.path.exists(self.manifest_path)
+
+    @property
+    def symbols(self) -> list:
+        """Returns the symbols recorded in the manifest."""
+        return list(self.manifest['symbols'].keys())
+
+    def last_dates(self) -> dict:
+        """Returns a mapping from symbol to the timestamp of its last stored bar."""
+        return {symbol: pd.Timestamp(entry['end']) for symbol, entry in self.manifest['symbols'].items()}
+
+    def skipped_symbols(self) -> dict:
+        """Returns a mapping from skipped symbol to its `{'checked', 'rows'}` entry."""
+        return self.manifest['skipped']
+
+    def mark_skipped(self, symbol: str, checked, rows: int):
+        """
+        Records a symbol whose history was too short to be stored.
+
+        Any stored data of the symbol is dropped. The manifest itself is only
+        persisted by `save_manifest`.
+
+        Args:
+            symbol (str): The skipped symbol.
+            checked: Last calendar day the symbol was loaded up to.
+            rows (int): Number of valid bars it had by then.
+        """
+        if self.manifest['symbols'].pop(symbol, None) is not None and os.path.exists(self._symbol_path(symbol)):
+            os.remove(self._symbol_path(symbol))
+        self.manifest['skipped'][symbol] = {'checked': str(pd.Timestamp(checked).date()), 'rows': int(rows)}
+
+    def read(self, symbol: str, verify: bool = True) -> pd.DataFrame:
+        """
+        Reads one symbol back into a DataFrame indexed by datetime.
+
+        Args:
+            symbol (str): The symbol to read.
+            verify (bool): If True, check the data against the manifest checksum.
+
+        Raises:
+            ValueError: If `verify` is set and the checksum does not match.
+        """
+        with np.load(self._symbol_path(symbol)) as archive:
+            datetimes = archive['datetime']
+            columns = {feature: archive[feature] for feature in self.feature_list}
+
+        if verify and self._checksum(datetimes, columns) != self.manifest['symbols'][symbol]['checksum']:
+            raise ValueError(f"Checksum mismatch for symbol {symbol} in {self.root}")
+
+        index = pd.DatetimeIndex(datetimes.astype('datetime64[ns]'), name='datetime')
+        return pd.DataFrame(columns, index=index)
+
+    def read_all(self, verify: bool = True) -> dict:
+        """Reads every symbol in the store, see `read`."""
+        return {symbol: self.read(symbol, verify=verify) for symbol in self.symbols}
+
+    def write(self, symbol: str, df: pd.DataFrame):
+        """
+        Writes (or overwrites) one symbol and updates its manifest entry.
+
+        The manifest itself is only persisted by `save_manifest`.
+
+        Args:
+            symbol (str): The symbol to write.
+            df (pd.DataFrame): Data indexed by datetime, containing `feature_list`.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        datetimes = df.index.values.astype('datetime64[ns]').astype(np.int64)
+        columns = {feature: np.ascontiguousarray(df[feature].values) for feature in self.feature_list}
+
+        # Write to a temporary file first so a crash never leaves a truncated archive.
+        path = self._symbol_path(symbol)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, datetime=datetimes, **columns)
+        os.replace(tmp_path, path)
+
+        self.manifest['skipped'].pop(symbol, None)
+        self.manifest['symbols'][symbol] = {
+            'start': str(df.index[0].date()),
+            'end': str(df.index[-1].date()),
+            'rows': len(df),
+            'checksum': self._checksum(datetimes, columns),
+        }
+
+    def append(self, symbol: str, new_df: pd.DataFrame) -> int:
+        """
+        Appends bars that are newer than the symbol's last stored bar.
+
+        The stored bars are only read, and checked against the manifest
+        checksum, when there is something to append.
+
+        Args:
+            symbol (str): The symbol to extend. It must already be in the store.
+            new_df (pd.DataFrame): Candidate bars indexed by datetime.
+
+        Returns:
+            int: The number of bars actually appended.
+
+        Raises:
+            OSError: If the symbol file cannot be read.
+            ValueError: If the stored data does not match its checksum.
+        """
+        new_df = new_df[new_df.index > pd.Timestamp(self.manifest['symbols'][symbol]['end'])]
+        if len(new_df) > 0:
+            self.write(symbol, pd.concat([self.read(symbol), new_df[self.feature_list]]))
+        return len(new_df)
+
+    def save_manifest(self):
+        """Atomically writes the manifest to disk."""
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=4)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _symbol_path(self, symbol: str) -> str:
+        return os.path.join(self.root, f"{symbol}.npz")
+
+    @staticmethod
+    def _checksum(datetimes: np.ndarray, columns: dict) -> str:
+        digest = hashlib.sha256(np.ascontiguousarray(datetimes).tobytes())
+        for name in sorted(columns):
+            digest.update(name.encode())
+            digest.update(np.ascontiguousarray(columns[name]).tobytes())
+        return digest.hexdigest()
+
+
+def signals_to_frames(dates: np.ndarray, symbols: list, signals: dict[str, np.ndarray],
+                      drop_empty: bool = True) -> dict[str, pd.DataFrame]:
+    """
+    Wraps signal matrices into wide DataFrames (datetime index, symbol columns).
+
+    Args:
+        dates (np.ndarray): Row labels of the matrices.
+        symbols (list): Column labels of the matrices.
+        signals (dict[str, np.ndarray]): Signal matrices keyed by signal type.
+        drop_empty (bool): Drop the symbols that have no prediction in any signal.
+    """
+    index = pd.DatetimeIndex(dates, name='datetime')
+    columns = pd.Index(symbols, name='instrument')
+    keep = slice(None)
+    if drop_empty and signals:
+        keep = np.any([~np.isnan(values).all(axis=0) for values in signals.values()], axis=0)
+    return {
+        sig_type: pd.DataFrame(values[:, keep], index=index, columns=columns[keep])
+        for sig_type, values in signals.items()
+    }
+
+
+def save_signals(path: str, signals: dict[str, pd.DataFrame]):
+    """
+    Saves wide signal DataFrames as one compressed `.npz` file.
+
+    The file holds the shared `dates` and `symbols` axes plus one float32
+    matrix per signal type, and is written atomically.
+    """
+    first = next(iter(signals.values()))
+    arrays = {
+        sig_type: df.reindex(index=first.index, columns=first.columns).to_numpy(dtype=np.float32)
+        for sig_type, df in signals.items()
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(
+            f, dates=first.index.values.astype('datetime64[ns]'), symbols=np.asarray(first.columns, dtype=str), **arrays
+        )
+    os.replace(tmp_path, path)
+
+
+def load_signals(path: str, drop_empty: bool = True) -> dict[str, pd.DataFrame]:
+    """Loads the signal DataFrames written by `save_signals`."""
+    with np.load(path, allow_pickle=False) as data:
+        signals = {key: data[key] for key in data.files if key not in ('dates', 'symbols')}
+        return signals_to_frames(data['dates'], data['symbols'].tolist(), signals, drop_empty=drop_empty)
@@ -0,0 +1,268 @@
+import abc
+import csv
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+
+
+# Parameters never written to a sink, and name parts that mark a credential
+# (matched per '_'-separated word, so e.g. `tokenizer_learning_rate` is kept).
+EXCLUDED_PARAMETERS = {'comet_config'}
+SECRET_NAME_PARTS = {'key', 'apikey', 'token', 'secret', 'password'}
+
+
+def redact_parameters(params: dict) -> dict:
+    """Returns a copy of `params` without credentials, also inside nested dicts."""
+    redacted = {}
+    for name, value in params.items():
+        if name in EXCLUDED_PARAMETERS or SECRET_NAME_PARTS & set(str(name).lower().split('_')):
+            continue
+        redacted[name] = redact_parameters(value) if isinstance(value, dict) else value
+    return redacted
+
+
+class MetricSink(abc.ABC):
+    """
+    A destination for logged events. `ExperimentLogger` calls these methods
+    from its background thread only, so sinks need not be thread-safe.
+    """
+
+    @abc.abstractmethod
+    def write_metrics(self, records: list):
+        """Writes a batch of metric records (dicts with name, value, step, epoch, time)."""
+
+    def log_parameters(self, params: dict):
+        pass
+
+    def log_model(self, name: str, path: str):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonlSink(MetricSink):
+    """Appends metrics to `<log_dir>/metrics.jsonl` and writes parameters to `params.json`."""
+
+    def __init__(self, log_dir: str):
+        os.makedirs(log_dir, exist_ok=True)
+        self.log_dir = log_dir
+        self._file = open(os.path.join(log_dir, 'metrics.jsonl'), 'a')
+
+    def write_metrics(self, records: list):
+        for record in records:
+            self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def log_parameters(self, params: dict):
+        with open(os.path.join(self.log_dir, 'params.json'), 'w') as f:
+            json.dump(params, f, indent=4, default=str)
+
+    def log_model(self, name: str, path: str):
+        self._file.write(json.dumps({'model': name, 'path': os.path.abspath(path), 'time': time.time()}) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class CsvSink(MetricSink):
+    """Appends metrics to `<log_dir>/metrics.csv` in long format (one row per value)."""
+
+    FIELDS = ['name', 'value', 'step', 'epoch', 'time']
+
+    def __init__(self, log_dir: str):
+        os.makedirs(log_dir, exist_ok=True)
+        path = os.path.join(log_dir, 'metrics.csv')
+        write_header = not os.path.exists(path)
+        self._file = open(path, 'a', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames=self.FIELDS)
+        if write_header:
+            self._writer.writeheader()
+
+    def write_metrics(self, records: list):
+        self._writer.writerows(records)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class TensorBoardSink(MetricSink):
+    """Writes metrics as TensorBoard event files under `log_dir` (needs the `tensorboard` package)."""
+
+    def __init__(self, log_dir: str):
+        from torch.utils.tensorboard import SummaryWriter
+        self._writer = SummaryWriter(log_dir=log_dir)
+
+    def write_metrics(self, records: list):
+        for record in records:
+            step = record['step'] if record['step'] is not None else record['epoch']
+            self._writer.add_scalar(record['name'], record['value'], global_step=step, walltime=record['time'])
+        self._writer.flush()
+
+    def log_parameters(self, params: dict):
+        self._writer.add_text('parameters', json.dumps(params, indent=4, default=str))
+
+    def close(self):
+        self._writer.close()
+
+
+class CometSink(MetricSink):
+    """Forwards everything to a Comet ML experiment (needs `comet_ml` and network access)."""
+
+    def __init__(self, comet_config: dict, tag: str = None, name: str = None):
+        import comet_ml
+        self.experiment = comet_ml.Experiment(
+            api_key=comet_config['api_key'],
+            project_name=comet_config['project_name'],
+            workspace=comet_config['workspace'],
+        )
+        if tag:
+            self.experiment.add_tag(tag)
+        if name:
+            self.experiment.set_name(name)
+
+    def write_metrics(self, records: list):
+        for record in records:
+            kwargs = {key: record[key] for key in ('step', 'epoch') if record[key] is not None}
+            self.experiment.log_metric(record['name'], record['value'], **kwargs)
+
+    def log_parameters(self, params: dict):
+        self.experiment.log_parameters(params)
+
+    def log_model(self, name: str, path: str):
+        self.experiment.log_model(name, path)
+
+    def close(self):
+        self.experiment.end()
+
+
+class ExperimentLogger:
+    """
+    Buffered experiment logger that writes to one or more sinks in the background.
+
+    `log_metric`, `log_parameters` and `log_model` only enqueue an event, so the
+    training loop never blocks on disk or network I/O. A background thread
+    drains the queue every `flush_interval` seconds and hands the metrics to
+    every sink in one batch. Metric values may be Python numbers or detached
+    0-d tensors; tensors are converted on the background thread, which keeps
+    the device synchronization out of the training step.
+
+    A sink that raises (full disk, TensorBoard or Comet errors) is reported
+    and skipped for that batch; the other sinks still get it and the
+    background thread keeps draining the queue.
+
+    Args:
+        sinks (list[MetricSink]): Destinations of the logged events.
+        flush_interval (float): Seconds between background flushes.
+    """
+
+    def __init__(self, sinks: list, flush_interval: float = 10.0):
+        self.sinks = sinks
+        self.flush_interval = flush_interval
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='experiment-logger', daemon=True)
+        self._thread.start()
+
+    def log_metric(self, name: str, value, step: int = None, epoch: int = None):
+        self._queue.put(('metric', {'name': name, 'value': value, 'step': step, 'epoch': epoch, 'time': time.time()}))
+
+    def log_parameters(self, params: dict):
+        """Logs run parameters; credentials (see `redact_parameters`) are dropped first."""
+        self._queue.put(('parameters', redact_parameters(params)))
+
+    def log_model(self, name: str, path: str):
+        self._queue.put(('model', (name, path)))
+
+    def flush(self):
+        """Writes every queued event to the sinks."""
+        with self._lock:
+            metrics = []
+            while True:
+                try:
+                    kind, payload = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if kind == 'metric':
+                    payload['value'] = float(payload['value'])
+                    metrics.append(payload)
+                    continue
+                # Keep the event order: write the metrics logged before this event first.
+                self._write_metrics(metrics)
+                metrics = []
+                for sink in self.sinks:
+                    if kind == 'parameters':
+                        self._call_sink(sink.log_parameters, payload)
+                    else:
+                        self._call_sink(sink.log_model, *payload)
+            self._write_metrics(metrics)
+
+    def _write_metrics(self, metrics: list):
+        if metrics:
+            for sink in self.sinks:
+                self._call_sink(sink.write_metrics, metrics)
+
+    @staticmethod
+    def _call_sink(method, *args):
+        try:
+            method(*args)
+        except Exception as e:
+            print(f"Experiment logger: {type(method.__self__).__name__}.{method.__name__} failed: {e!r}")
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                # Never let the flush thread die, or the queue would grow for the rest of the run.
+                print("Experiment logger: flush failed")
+                traceback.print_exc()
+
+    def end(self):
+        """Stops the background thread, flushes the remaining events and closes the sinks."""
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+        for sink in self.sinks:
+            sink.close()
+
+
+def create_logger(config: dict, log_dir: str):
+    """
+    Builds the experiment logger selected by `config['logger_backends']`.
+
+    Args:
+        config (dict): Configuration dictionary. Backends are any of 'jsonl', 'csv',
+            'tensorboard' (written to `log_dir`) and 'comet'. `use_comet` adds 'comet'.
+        log_dir (str): Directory for the local backends.
+
+    Returns:
+        ExperimentLogger or None: None if no backend is configured.
+    """
+    backends = list(config['logger_backends'])
+    if config['use_comet'] and 'comet' not in backends:
+        backends.append('comet')
+
+    sinks = []
+    for backend in backends:
+        if backend == 'jsonl':
+            sinks.append(JsonlSink(log_dir))
+        elif backend == 'csv':
+            sinks.append(CsvSink(log_dir))
+        elif backend == 'tensorboard':
+            sinks.append(TensorBoardSink(log_dir))
+        elif backend == 'comet':
+            sinks.append(CometSink(config['comet_config'], tag=config['comet_tag'], name=config['comet_name']))
+        else:
+            raise ValueError(f"Unknown logger backend: {backend}")
+
+    if not sinks:
+        return None
+    print(f"Experiment logger initialized: {', '.join(backends)} (local logs in {log_dir})")
+    return ExperimentLogger(sinks, flush_interval=config['logger_flush_interval'])
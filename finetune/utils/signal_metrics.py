@@ -0,0 +1,186 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+
+def forward_returns(close: np.ndarray, horizon: int = 1) -> np.ndarray:
+    """
+    Realized return of a signal issued on each bar of one symbol's series.
+
+    The signal of bar t is traded on bar t+1, so the label is the close-to-close
+    return from t+1 to t+1+horizon, counted in the symbol's own bars (qlib's
+    `Ref($close, -2) / Ref($close, -1) - 1` for horizon 1). It is NaN where the
+    series ends before that. This is the label of both the streaming
+    signal-quality readout and the walk-forward IC.
+    """
+    close = np.asarray(close, dtype=np.float64)
+    labels = np.full(len(close), np.nan)
+    n_valid = len(close) - 1 - horizon
+    if n_valid > 0:
+        labels[:n_valid] = close[1 + horizon:] / close[1:1 + n_valid] - 1
+    return labels
+
+
+class PoorSignalError(RuntimeError):
+    """Raised when the running RankIC falls below the configured minimum."""
+
+
+class _RunningStat:
+    """Welford accumulator of a scalar series (mean and sample standard deviation)."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value: float):
+        if not math.isfinite(value):
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self._m2 / (self.count - 1)) if self.count > 1 else float('nan')
+
+
+def _rank(values: np.ndarray) -> np.ndarray:
+    """
+    Average ranks (ties share their mean rank), as `DataFrame.rank` computes them
+    for `walk_forward.daily_ic`, so the RankIC does not depend on the input order.
+    """
+    return pd.Series(values).rank(method='average').to_numpy()
+
+
+def _corr(a: np.ndarray, b: np.ndarray) -> float:
+    a, b = a - a.mean(), b - b.mean()
+    denom = math.sqrt(float(a @ a) * float(b @ b))
+    return float(a @ b) / denom if denom > 0 else float('nan')
+
+
+class StreamingSignalEvaluator:
+    """
+    Signal-quality statistics computed while predictions are still being generated.
+
+    Predictions are fed batch by batch in date order (see `predict_signals`).
+    Only the cross-section of the most recent date is buffered; once a later
+    date arrives, the finished day's IC, RankIC, hit rate and top-minus-bottom
+    quantile spread are folded into running accumulators and the buffer is
+    dropped, so memory does not grow with the length of the test period.
+
+    Args:
+        signal_types (tuple): Names of the evaluated signals.
+        quantile (float): Share of the cross-section in the top and bottom buckets of the spread.
+        min_count (int): Days with fewer valid symbols are skipped.
+        abort_after_days (int): Check `min_rank_ic` once this many days are scored (0 = never).
+        min_rank_ic (float): Raise `PoorSignalError` if the running RankIC of `abort_signal`
+            is below this after `abort_after_days` days.
+        abort_signal (str): Signal type the abort rule looks at.
+    """
+
+    def __init__(self, signal_types: tuple, quantile: float = 0.2, min_count: int = 10,
+                 abort_after_days: int = 0, min_rank_ic: float = 0.0, abort_signal: str = 'mean'):
+        self.signal_types = tuple(signal_types)
+        self.quantile = quantile
+        self.min_count = min_count
+        self.abort_after_days = abort_after_days
+        self.min_rank_ic = min_rank_ic
+        self.abort_signal = abort_signal
+        self.stats = {
+            sig_type: {name: _RunningStat() for name in ('ic', 'rank_ic', 'hit_rate', 'spread')}
+            for sig_type in self.signal_types
+        }
+        self.days = 0
+        self._checked = False
+        self._pending_date = None
+        self._pending = None
+
+    def update(self, date_ids: np.ndarray, signals: dict[str, np.ndarray], labels: np.ndarray):
+        """
+        Adds one batch of predictions.
+
+        Args:
+            date_ids (np.ndarray): Date index of every window, non-decreasing across calls.
+            signals (dict[str, np.ndarray]): Predicted value of every window per signal type.
+            labels (np.ndarray): Realized forward return of every window (NaN if unknown).
+        """
+        date_ids = np.asarray(date_ids)
+        # Batches arrive in date order, so a batch splits into runs of equal dates.
+        boundaries = np.flatnonzero(np.diff(date_ids)) + 1
+        for run in np.split(np.arange(len(date_ids)), boundaries):
+            if len(run) == 0:
+                continue
+            date_id = date_ids[run[0]]
+            if self._pending_date is not None and date_id != self._pending_date:
+                self._finish_day()
+            if self._pending is None:
+                self._pending_date = date_id
+                self._pending = {'label': [], **{sig_type: [] for sig_type in self.signal_types}}
+            self._pending['label'].append(labels[run])
+            for sig_type in self.signal_types:
+                self._pending[sig_type].append(np.asarray(signals[sig_type])[run])
+
+    def finish(self):
+        """Scores the last buffered day. Call once all predictions were added."""
+        if self._pending is not None:
+            self._finish_day()
+
+    def _finish_day(self):
+        label = np.concatenate(self._pending['label']).astype(np.float64)
+        day_signals = {sig_type: np.concatenate(self._pending[sig_type]).astype(np.float64)
+                       for sig_type in self.signal_types}
+        self._pending_date, self._pending = None, None
+
+        scored = False
+        for sig_type, signal in day_signals.items():
+            valid = np.isfinite(signal) & np.isfinite(label)
+            if valid.sum() < self.min_count:
+                continue
+            s, y = signal[valid], label[valid]
+            stats = self.stats[sig_type]
+            stats['ic'].add(_corr(s, y))
+            stats['rank_ic'].add(_corr(_rank(s), _rank(y)))
+            stats['hit_rate'].add(float(np.mean(np.sign(s) == np.sign(y))))
+            n_bucket = max(1, int(len(s) * self.quantile))
+            order = np.argsort(s, kind='stable')
+            stats['spread'].add(float(y[order[-n_bucket:]].mean() - y[order[:n_bucket]].mean()))
+            scored = True
+        self.days += scored
+
+        if self.abort_after_days and not self._checked and self.days >= self.abort_after_days:
+            self._checked = True
+            rank_ic = self.stats[self.abort_signal]['rank_ic'].mean
+            if rank_ic < self.min_rank_ic:
+                raise PoorSignalError(
+                    f"Running RankIC of '{self.abort_signal}' is {rank_ic:.4f} after {self.days} days, "
+                    f"below the minimum of {self.min_rank_ic}"
+                )
+
+    def summary(self) -> dict:
+        """
+        Returns the running statistics per signal type: mean IC and RankIC, ICIR and
+        RankICIR (mean / std of the daily values), mean hit rate, mean quantile spread
+        and the number of scored days.
+        """
+        summary = {}
+        for sig_type, stats in self.stats.items():
+            ic, rank_ic = stats['ic'], stats['rank_ic']
+            summary[sig_type] = {
+                'days': ic.count,
+                'ic': ic.mean,
+                'icir': ic.mean / ic.std if ic.count > 1 and ic.std > 0 else float('nan'),
+                'rank_ic': rank_ic.mean,
+                'rank_icir': rank_ic.mean / rank_ic.std if rank_ic.count > 1 and rank_ic.std > 0 else float('nan'),
+                'hit_rate': stats['hit_rate'].mean,
+                'spread': stats['spread'].mean,
+            }
+        return summary
+
+    def format_summary(self, sig_type: str = 'mean') -> str:
+        """Formats the running statistics of one signal as a short progress readout."""
+        stats = self.summary()[sig_type]
+        return (f"{stats['days']}d IC {stats['ic']:.4f} RankIC {stats['rank_ic']:.4f} "
+                f"ICIR {stats['icir']:.2f} hit {stats['hit_rate']:.1%}")
@@ -0,0 +1,234 @@
+from collections import defaultdict
+import contextlib
+import json
+import os
+import sys
+import time
+
+import torch
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB, or None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux.
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+class StepProfiler:
+    """
+    Lightweight per-step timing and memory recorder for the training loops.
+
+    Each step records the time spent waiting for the dataloader and in the
+    forward, backward and optimizer phases, the time of the DDP gradient
+    all-reduce (via a comm hook, see `attach_comm_timer`), samples/sec,
+    tokens/sec, and peak host RSS and GPU memory. Records are buffered and
+    appended to a JSONL file every `flush_every` steps.
+
+    Phase timings synchronize CUDA at their boundaries so they reflect GPU
+    work; when `enabled` is False every hook is a no-op and nothing is
+    synchronized.
+
+    Optionally, `trace_steps` steps (after `trace_wait` warm-up steps) are
+    traced with `torch.profiler` and written to `trace_dir` in TensorBoard format.
+
+    Args:
+        path (str): JSONL file the step records are appended to.
+        device (torch.device): The training device.
+        enabled (bool): Whether to record anything at all.
+        trace_steps (int): Number of steps to trace with `torch.profiler` (0 = off).
+        trace_dir (str, optional): Output directory for the profiler traces.
+        trace_wait (int): Steps to skip before the traced steps start.
+        flush_every (int): Number of buffered records that triggers a write.
+    """
+
+    def __init__(self, path: str, device, enabled: bool = True, trace_steps: int = 0, trace_dir: str = None,
+                 trace_wait: int = 5, flush_every: int = 100):
+        self.path = path
+        self.device = device
+        self.enabled = enabled
+        self.flush_every = flush_every
+        self._records = []
+        self._totals = defaultdict(float)
+        self._total_steps = 0
+        self._peaks = {}
+        self._phases = defaultdict(float)
+        self._comm_time = 0.0
+        self._data_wait = 0.0
+        self._step_start = None
+        self.step = 0
+
+        self._torch_profiler = None
+        if enabled and trace_steps > 0:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._torch_profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=trace_wait, warmup=1, active=trace_steps, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+                record_shapes=True,
+                profile_memory=True,
+            )
+            self._torch_profiler.start()
+
+    def _sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def attach_comm_timer(self, ddp_model):
+        """
+        Registers a DDP comm hook that times the gradient all-reduce.
+
+        The hook runs the default all-reduce and records the host-side time from
+        launching each bucket until its future completes. Since the all-reduce
+        overlaps with backward, this time is also contained in `backward`.
+        """
+        if not self.enabled:
+            return
+        from torch.distributed.algorithms.ddp_comm_hooks.default_hooks import allreduce_hook
+
+        def timed_allreduce(process_group, bucket):
+            start = time.perf_counter()
+
+            def record(fut):
+                self._comm_time += time.perf_counter() - start
+                return fut.value()
+
+            return allreduce_hook(process_group, bucket).then(record)
+
+        ddp_model.register_comm_hook(None, timed_allreduce)
+
+    def iter_loader(self, loader):
+        """Iterates `loader`, recording how long each batch took to arrive."""
+        iterator = iter(loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self._data_wait = time.perf_counter() - start
+            self._step_start = start
+            yield batch
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Times a phase of the current step. Repeated phases (micro-batches) add up."""
+        if not self.enabled:
+            yield
+            return
+        self._sync()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sync()
+            self._phases[name] += time.perf_counter() - start
+
+    def end_step(self, samples: int, tokens: int):
+        """
+        Closes the current step and records it.
+
+        Args:
+            samples (int): Number of samples processed by this rank in the step.
+            tokens (int): Number of time steps (tokens) in those samples.
+        """
+        if self._torch_profiler is not None:
+            self._torch_profiler.step()
+        if not self.enabled:
+            return
+
+        self._sync()
+        step_time = time.perf_counter() - (self._step_start or time.perf_counter())
+        record = {
+            'step': self.step,
+            'step_time': step_time,
+            'data_wait': self._data_wait,
+            **{name: duration for name, duration in self._phases.items()},
+            'comm': self._comm_time,
+            'samples_per_sec': samples / step_time if step_time > 0 else None,
+            'tokens_per_sec': tokens / step_time if step_time > 0 else None,
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        if self.device.type == 'cuda':
+            record['peak_gpu_mem_mb'] = torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self._records.append(record)
+        for key, value in record.items():
+            if key.startswith('peak_') and value is not None:
+                self._peaks[key] = max(self._peaks.get(key, 0.0), value)
+            elif key != 'step' and value is not None:
+                self._totals[key] += value
+        self._total_steps += 1
+
+        self.step += 1
+        self._phases.clear()
+        self._comm_time = 0.0
+        if len(self._records) >= self.flush_every:
+            self.flush()
+
+    def summary(self, reset: bool = True) -> dict:
+        """
+        Averages all steps recorded since the last reset (e.g. one epoch).
+
+        Args:
+            reset (bool): Start a new averaging window afterwards.
+
+        Returns:
+            dict: Mean of every timing and throughput field, the maximum of the
+                peak memory fields, and `data_wait_frac`, the share of step time
+                spent waiting for data. Empty if no step was recorded.
+        """
+        if self._total_steps == 0:
+            return {}
+        mean = {key: total / self._total_steps for key, total in self._totals.items()}
+        mean['data_wait_frac'] = mean['data_wait'] / mean['step_time'] if mean['step_time'] > 0 else 0.0
+        mean.update(self._peaks)
+        if reset:
+            self._totals.clear()
+            self._total_steps = 0
+            self._peaks = {}
+        return mean
+
+    @staticmethod
+    def format_summary(summary: dict) -> str:
+        """Formats a `summary` as a one-line report."""
+        if not summary:
+            return "no steps recorded"
+        line = (f"{summary['samples_per_sec']:.1f} samples/s, {summary['tokens_per_sec']:.0f} tokens/s, "
+                f"step {summary['step_time'] * 1000:.1f} ms "
+                f"(data wait {summary['data_wait_frac']:.1%}")
+        for name in ('forward', 'backward', 'optimizer', 'comm'):
+            if name in summary:
+                line += f", {name} {summary[name] * 1000:.1f} ms"
+        line += ")"
+        if summary.get('peak_rss_mb') is not None:
+            line += f", peak RSS {summary['peak_rss_mb']:.0f} MB"
+        if 'peak_gpu_mem_mb' in summary:
+            line += f", peak GPU {summary['peak_gpu_mem_mb']:.0f} MB"
+        return line
+
+    def flush(self):
+        """Appends the buffered records to the JSONL file."""
+        if not self._records:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, 'a') as f:
+            for record in self._records:
+                f.write(json.dumps(record) + '\n')
+        self._records = []
+
+    def close(self):
+        """Flushes the remaining records and stops the torch profiler."""
+        if self._torch_profiler is not None:
+            self._torch_profiler.stop()
+            self._torch_profiler = None
+        self.flush()
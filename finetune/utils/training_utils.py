@@ -7,54 +7,113 @@ import torch
 import torch.distributed as dist
 
 
-def setup_ddp():
+def resolve_device_type(requested: str = 'auto') -> str:
+    """
+    Resolves the device type used for training.
+
+    Args:
+        requested (str): 'cuda', 'cpu' or 'auto'. 'auto' picks CUDA when it is
+                         available and falls back to CPU otherwise.
+
+    Returns:
+        str: Either 'cuda' or 'cpu'.
+    """
+    if requested == 'auto':
+        return 'cuda' if torch.cuda.is_available() else 'cpu'
+    if requested not in ('cuda', 'cpu'):
+        raise ValueError(f"Unsupported device type: {requested}")
+    return requested
+
+
+def setup_ddp(device_type: str = 'cuda'):
     """
     Initializes the distributed data parallel environment.
 
     This function relies on environment variables set by `torchrun` or a similar
-    launcher. It initializes the process group and sets the CUDA device for the
-    current process.
+    launcher. Without a launcher (or with WORLD_SIZE=1) it runs as a plain single
+    process and no process group is created. Otherwise it initializes the process
+    group with NCCL for CUDA, or gloo for CPU (and on Windows), and sets the CUDA
+    device for the current process.
+
+    Args:
+        device_type (str): 'cuda' or 'cpu', see `resolve_device_type`.
 
     Returns:
         tuple: A tuple containing (rank, world_size, local_rank).
     """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1:
+        print(f"[DDP Setup] 单进程模式，不初始化分布式环境 - Device: {device_type}")
+        if device_type == 'cuda':
+            torch.cuda.set_device(0)
+        return 0, 1, 0
+
     if not dist.is_available():
         raise RuntimeError("torch.distributed is not available.")
 
     # Ensure libuv is disabled on builds without libuv support (e.g., Windows wheels)
     os.environ.setdefault("USE_LIBUV", "0")
 
-    # Select backend: Windows 不支持 NCCL，使用 gloo；其他平台默认 nccl
-    backend = "gloo" if os.name == "nt" else "nccl"
+    # Select backend: CPU 和 Windows 使用 gloo；CUDA 默认 nccl
+    backend = "nccl" if device_type == 'cuda' and os.name != "nt" else "gloo"
 
-    # 检查是否为单进程模式
-    world_size = int(os.environ["WORLD_SIZE"])
-    if world_size == 1:
-        print("[DDP Setup] 单进程模式，初始化单进程分布式环境")
-        # 单进程模式下也需要初始化分布式环境，但使用单进程配置
-        rank = 0
-        local_rank = 0
-        
-        # 初始化单进程分布式组
-        os.environ.setdefault("MASTER_ADDR", "localhost")
-        os.environ.setdefault("MASTER_PORT", "12355")
-        dist.init_process_group(backend=backend, rank=0, world_size=1)
-        
-        if torch.cuda.is_available():
-            torch.cuda.set_device(0)
-        print(f"[DDP Setup] 单GPU模式 - Local Rank: 0, Device: {torch.cuda.current_device() if torch.cuda.is_available() else 'CPU'}")
-        return rank, world_size, local_rank
-    else:
-        # 多进程分布式模式
-        dist.init_process_group(backend=backend)
-        rank = int(os.environ["RANK"])
-        local_rank = int(os.environ["LOCAL_RANK"])
+    # 多进程分布式模式
+    dist.init_process_group(backend=backend)
+    rank = int(os.environ["RANK"])
+    local_rank = int(os.environ["LOCAL_RANK"])
+    if device_type == 'cuda':
         torch.cuda.set_device(local_rank)
-        print(
-            f"[DDP Setup] Global Rank: {rank}/{world_size}, "
-            f"Local Rank (GPU): {local_rank} on device {torch.cuda.current_device()}"
-        )
-        return rank, world_size, local_rank
+        device_desc = f"GPU {torch.cuda.current_device()}"
+    else:
+        device_desc = "CPU"
+    print(
+        f"[DDP Setup] Global Rank: {rank}/{world_size}, "
+        f"Local Rank: {local_rank} on {device_desc}, Backend: {backend}"
+    )
+    return rank, world_size, local_rank
+
+
+def resolve_amp_dtype(device_type: str, amp_dtype: str = 'bf16') -> torch.dtype:
+    """
+    Returns the autocast dtype for mixed-precision training.
+
+    Args:
+        device_type (str): 'cuda' or 'cpu'.
+        amp_dtype (str): 'bf16' or 'fp16'. CPU autocast only supports bfloat16,
+                         so 'fp16' falls back to bfloat16 there.
+
+    Returns:
+        torch.dtype: torch.bfloat16 or torch.float16.
+    """
+    if amp_dtype not in ('bf16', 'fp16'):
+        raise ValueError(f"Unsupported AMP dtype: {amp_dtype}")
+    if amp_dtype == 'fp16' and device_type == 'cuda':
+        return torch.float16
+    return torch.bfloat16
+
+
+def get_device(device_type: str, local_rank: int) -> torch.device:
+    """Returns the torch device for the current process."""
+    return torch.device(f"cuda:{local_rank}") if device_type == 'cuda' else torch.device("cpu")
+
+
+def set_cpu_threads(num_threads: int = None) -> int:
+    """
+    Sets the intra-op thread budget of the current CPU rank.
+
+    Args:
+        num_threads (int, optional): Threads for this rank. Defaults to the
+            machine's cores split evenly across the local ranks (LOCAL_WORLD_SIZE
+            as set by `torchrun`), so ranks on one node do not oversubscribe it.
+
+    Returns:
+        int: The number of threads that was set.
+    """
+    if num_threads is None:
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+        num_threads = max(1, (os.cpu_count() or 1) // local_world_size)
+    torch.set_num_threads(num_threads)
+    return num_threads
 
 
 def cleanup_ddp():
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+
+import torch
+import torch.distributed as dist
+
+from .checkpoint_manager import checkpoint_fingerprint
+
+
+def _move(batch: tuple, device) -> tuple:
+    return tuple(t.to(device, non_blocking=True) if t is not None else None for t in batch)
+
+
+def shared_cache_path(config: dict, kind: str, rank: int, world_size: int):
+    """
+    Returns the on-disk validation cache file for this run, or None if disabled.
+
+    The file name is derived from every config value that changes the cached
+    batches, so runs that differ only in other settings (e.g. sweep trials over
+    learning rates) share one cache. For the predictor, the tokenizer
+    checkpoint's file sizes and modification times are included, so a
+    tokenizer retrained in place does not reuse tokens from the old one.
+
+    Args:
+        config (dict): Configuration dictionary; `val_cache_dir` enables the disk cache.
+        kind (str): 'tokenizer' or 'predictor'.
+        rank (int): Global rank of the process; each rank caches its own shard.
+        world_size (int): Total number of processes.
+    """
+    if not config.get('val_cache_dir'):
+        return None
+    keys = ['dataset_path', 'lookback_window', 'predict_window', 'max_context', 'use_packing',
+            'packing_min_length', 'n_val_iter', 'val_subsample', 'batch_size', 'seed', 'clip']
+    if kind == 'predictor':
+        keys.append('finetuned_tokenizer_path')
+    key = {k: config.get(k) for k in keys}
+    if kind == 'predictor':
+        key['finetuned_tokenizer_files'] = checkpoint_fingerprint(config['finetuned_tokenizer_path'])
+    key = json.dumps(key, sort_keys=True, default=str)
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return os.path.join(config['val_cache_dir'], f"{kind}_val_{digest}_rank{rank}of{world_size}.pt")
+
+
+class ValidationEngine:
+    """
+    Runs validation on a fixed set of batches that are prepared once and cached.
+
+    The first call to `run` iterates the validation loader, passes every batch
+    through `prepare_fn` (e.g. moving it to the device and tokenizing it) and
+    keeps the result. Later calls evaluate the cached batches directly, so the
+    data loading, normalization and frozen-tokenizer work is only paid once.
+    This relies on the validation sampler yielding the same windows every
+    epoch, as `WindowSampler(shuffle=False)` does.
+
+    Args:
+        loader (DataLoader): Validation loader over this rank's shard.
+        prepare_fn (callable): Maps a loader batch to the tuple of tensors to cache.
+            Entries may be None.
+        evaluate_fn (callable): Maps a prepared batch to `(loss_sum, count)`. The
+            reported loss is the total `loss_sum` over the total `count` of all ranks.
+        device (torch.device): Device the batches are evaluated on.
+        world_size (int): Number of distributed ranks.
+        every_n_epochs (int): Validate only every N epochs. The last epoch always validates.
+        cache (bool): If False, batches are prepared again on every run.
+        cache_on_device (bool): Keep cached batches on `device` instead of host memory.
+        cache_path (str, optional): File to share the cache between runs. If it exists it
+            is loaded instead of preparing the batches; otherwise it is written once the
+            batches have been prepared.
+    """
+
+    def __init__(self, loader, prepare_fn, evaluate_fn, device, world_size: int = 1,
+                 every_n_epochs: int = 1, cache: bool = True, cache_on_device: bool = True, cache_path: str = None):
+        self.loader = loader
+        self.prepare_fn = prepare_fn
+        self.evaluate_fn = evaluate_fn
+        self.device = device
+        self.world_size = world_size
+        self.every_n_epochs = max(1, every_n_epochs)
+        self.cache = cache
+        self.cache_on_device = cache_on_device
+        self.cache_path = cache_path if cache else None
+        self._cached_batches = None
+        if self.cache_path and os.path.exists(self.cache_path):
+            print(f"Loading cached validation batches from {self.cache_path}")
+            cached = torch.load(self.cache_path, map_location='cpu')
+            self._cached_batches = [_move(batch, self.device) for batch in cached] if cache_on_device else cached
+
+    @torch.no_grad()
+    def prepare(self):
+        """Prepares (and, with `cache_path`, saves) the cached batches without evaluating them."""
+        if self._cached_batches is None:
+            for _ in self._batches():
+                pass
+
+    def should_run(self, epoch_idx: int, num_epochs: int) -> bool:
+        """Returns True if validation is due after epoch `epoch_idx` (0-based)."""
+        return (epoch_idx + 1) % self.every_n_epochs == 0 or epoch_idx == num_epochs - 1
+
+    def _batches(self):
+        if self._cached_batches is not None:
+            for batch in self._cached_batches:
+                yield batch if self.cache_on_device else _move(batch, self.device)
+            return
+
+        cached = [] if self.cache else None
+        for batch in self.loader:
+            prepared = self.prepare_fn(batch)
+            if cached is not None:
+                cached.append(prepared if self.cache_on_device else _move(prepared, 'cpu'))
+            yield prepared
+        self._cached_batches = cached
+        if self.cache_path and cached is not None:
+            self._save_cache(cached)
+
+    def _save_cache(self, cached: list):
+        # Written under a temporary name and renamed, so concurrent runs never read a partial file.
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        torch.save([_move(batch, 'cpu') for batch in cached], tmp_path)
+        os.replace(tmp_path, self.cache_path)
+
+    @torch.no_grad()
+    def run(self) -> float:
+        """
+        Evaluates every validation batch of this rank and reduces across ranks.
+
+        The caller is responsible for putting the model in eval mode.
+
+        Returns:
+            float: The average validation loss over all ranks.
+        """
+        # Accumulate on the device so there is no host sync per batch.
+        loss_sum = torch.zeros((), dtype=torch.float64, device=self.device)
+        count = torch.zeros((), dtype=torch.float64, device=self.device)
+        for batch in self._batches():
+            batch_loss_sum, batch_count = self.evaluate_fn(batch)
+            loss_sum += batch_loss_sum.detach().double()
+            count += batch_count
+
+        if self.world_size > 1:
+            totals = torch.stack([loss_sum, count])
+            dist.all_reduce(totals, op=dist.ReduceOp.SUM)
+            loss_sum, count = totals[0], totals[1]
+        return (loss_sum / count).item() if count.item() > 0 else 0.0
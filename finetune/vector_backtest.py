@@ -0,0 +1,345 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, current_dir)
+
+from config import Config
+from utils.columnar_store import load_signals
+
+# =================================================================================
+# Standalone TopkDropout backtester
+#
+# Reproduces qlib's `TopkDropoutStrategy` (method_sell='bottom', method_buy='top',
+# risk_degree=0.95, forbid_all_trade_at_limit=True) executed day by day on the
+# open price, as configured in `QlibBacktest.run_single_backtest`, without a qlib
+# runtime. The state is a few arrays over the symbol axis, so a full backtest
+# only costs one cheap NumPy pass per trading day.
+# =================================================================================
+
+
+def _sort_desc(symbol_ids: np.ndarray, scores: np.ndarray) -> np.ndarray:
+    """Sorts `symbol_ids` by descending score with NaN scores last, like `Series.sort_values(ascending=False)`."""
+    key = scores[symbol_ids]
+    key = np.where(np.isnan(key), -np.inf, key)
+    return symbol_ids[np.argsort(-key, kind='stable')]
+
+
+def risk_metrics(returns: pd.Series, n_periods: int = 252) -> pd.Series:
+    """
+    Summarizes a daily return series like `qlib.contrib.evaluate.risk_analysis` (mode 'sum').
+
+    Returns:
+        pd.Series: mean, std, annualized_return, information_ratio and max_drawdown.
+    """
+    mean, std = returns.mean(), returns.std(ddof=1)
+    cumulative = returns.cumsum()
+    return pd.Series({
+        'mean': mean,
+        'std': std,
+        'annualized_return': mean * n_periods,
+        'information_ratio': mean / std * np.sqrt(n_periods),
+        'max_drawdown': (cumulative - cumulative.cummax()).min(),
+    })
+
+
+def price_matrices(data: dict) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Builds wide open and close price matrices (datetime index, symbol columns).
+
+    Args:
+        data (dict): Per-symbol DataFrames with 'open' and 'close' columns, indexed by
+            datetime or with a 'datetime' column (e.g. the contents of `test_data.pkl`).
+    """
+    opens, closes = {}, {}
+    for symbol, df in data.items():
+        if 'datetime' in df.columns:
+            df = df.set_index('datetime')
+        opens[symbol], closes[symbol] = df['open'], df['close']
+    return pd.DataFrame(opens).sort_index(), pd.DataFrame(closes).sort_index()
+
+
+class VectorizedTopkDropout:
+    """
+    NumPy re-implementation of qlib's TopkDropout backtest.
+
+    Every trading day the strategy ranks the previous day's scores, marks the
+    `n_drop` worst names of (holdings + best new candidates) for sale, sells them
+    (if held for at least `hold_thresh` days) and spreads `risk_degree` of the
+    cash equally over as many of the best new candidates as are needed to get
+    back to `topk` holdings. Orders are filled at the day's open. Names that are
+    suspended or closed at the price limit on that day are not traded. Positions
+    are marked to the close.
+
+    The report follows qlib's portfolio metrics: `return` is the daily return
+    before costs, `cost` the daily transaction cost rate and `bench` the
+    benchmark return, all relative to the previous day's account value.
+
+    Args:
+        topk (int): Number of symbols to hold.
+        n_drop (int): Number of symbols to replace each day.
+        hold_thresh (int): Minimum holding period in days before a symbol can be sold.
+        account (float): Initial cash.
+        risk_degree (float): Share of the cash invested on each buy.
+        open_cost (float): Cost rate of buy orders.
+        close_cost (float): Cost rate of sell orders.
+        min_cost (float): Minimum cost of any order.
+        limit_threshold (float): Absolute close-to-close change at which a symbol counts as limit up/down.
+        trade_unit (int, optional): Lot size. Only applied together with a `factor` matrix,
+            as qlib does (the lot is defined on unadjusted shares).
+    """
+
+    def __init__(self, topk: int, n_drop: int, hold_thresh: int = 1, account: float = 100_000_000,
+                 risk_degree: float = 0.95, open_cost: float = 0.001, close_cost: float = 0.0015,
+                 min_cost: float = 5, limit_threshold: float = 0.095, trade_unit: int = 100):
+        self.topk = topk
+        self.n_drop = n_drop
+        self.hold_thresh = hold_thresh
+        self.account = account
+        self.risk_degree = risk_degree
+        self.open_cost = open_cost
+        self.close_cost = close_cost
+        self.min_cost = min_cost
+        self.limit_threshold = limit_threshold
+        self.trade_unit = trade_unit
+
+    @classmethod
+    def from_config(cls, config: Config) -> 'VectorizedTopkDropout':
+        """Uses the same strategy settings as `QlibBacktest`."""
+        return cls(topk=config.backtest_n_symbol_hold, n_drop=config.backtest_n_symbol_drop,
+                   hold_thresh=config.backtest_hold_thresh)
+
+    def _round_amount(self, amount: float, factor: float) -> float:
+        if self.trade_unit is None or np.isnan(factor):
+            return amount
+        return (amount * factor + 0.1) // self.trade_unit * self.trade_unit / factor
+
+    def run(self, signal: pd.DataFrame, open_price: pd.DataFrame, close_price: pd.DataFrame,
+            factor: pd.DataFrame = None, bench: pd.Series = None, start_time=None, end_time=None) -> pd.DataFrame:
+        """
+        Runs the backtest.
+
+        Args:
+            signal (pd.DataFrame): Scores (datetime index, symbol columns). The scores of
+                a day are traded on the next trading day of the price calendar.
+            open_price (pd.DataFrame): Deal prices on the same layout. NaN means suspended.
+            close_price (pd.DataFrame): Close prices, used for valuation and the price limits.
+            factor (pd.DataFrame, optional): Adjustment factors for the lot-size rounding.
+            bench (pd.Series, optional): Daily benchmark returns. Defaults to 0.
+            start_time, end_time (optional): Backtest range; defaults to the whole price calendar.
+
+        Returns:
+            pd.DataFrame: Daily report with 'return', 'cost', 'bench', 'turnover' and 'account_value'.
+        """
+        calendar = close_price.index.union(open_price.index).sort_values()
+        symbols = close_price.columns.union(open_price.columns).union(signal.columns)
+        opens = open_price.reindex(index=calendar, columns=symbols).to_numpy(dtype=np.float64)
+        closes = close_price.reindex(index=calendar, columns=symbols).to_numpy(dtype=np.float64)
+        scores = signal.reindex(index=calendar, columns=symbols).to_numpy(dtype=np.float64)
+        factors = (factor.reindex(index=calendar, columns=symbols).to_numpy(dtype=np.float64)
+                   if factor is not None else np.full_like(closes, np.nan))
+
+        # Held symbols are valued at their last known close while suspended.
+        marks = pd.DataFrame(closes).ffill().to_numpy()
+        # A symbol is tradable if it has prices and did not close at the limit (in either direction).
+        # The change is measured against the last close it traded at, also after a suspension.
+        with np.errstate(invalid='ignore', divide='ignore'):
+            change = np.full_like(closes, np.nan)
+            change[1:] = closes[1:] / marks[:-1] - 1
+            at_limit = (change >= self.limit_threshold) | (change <= -self.limit_threshold)
+        tradable = ~np.isnan(opens) & ~np.isnan(closes) & ~at_limit
+
+        mask = np.ones(len(calendar), dtype=bool)
+        if start_time is not None:
+            mask &= calendar >= pd.Timestamp(start_time)
+        if end_time is not None:
+            mask &= calendar <= pd.Timestamp(end_time)
+        steps = np.flatnonzero(mask)
+
+        amount = np.zeros(len(symbols))
+        hold_days = np.zeros(len(symbols), dtype=np.int64)
+        cash = float(self.account)
+        last_value = float(self.account)
+        rows = []
+        for t in steps:
+            cost = turnover = 0.0
+            score = scores[t - 1] if t > 0 else np.full(len(symbols), np.nan)
+            if not np.isnan(score).all():
+                last = _sort_desc(np.flatnonzero(amount > 0), score)
+                candidates = np.flatnonzero((amount == 0) & ~np.isnan(score))
+                today = _sort_desc(candidates, score)[:self.n_drop + self.topk - len(last)]
+                comb = _sort_desc(np.union1d(last, today), score)
+                sell = last[np.isin(last, comb[-self.n_drop:])]
+                buy = today[:len(sell) + self.topk - len(last)]
+
+                for code in sell:
+                    if not tradable[t, code] or hold_days[code] < self.hold_thresh:
+                        continue
+                    trade_val = amount[code] * opens[t, code]
+                    trade_cost = max(trade_val * self.close_cost, self.min_cost)
+                    cash += trade_val - trade_cost
+                    cost += trade_cost
+                    turnover += trade_val
+                    amount[code] = 0.0
+                    hold_days[code] = 0
+
+                value = cash * self.risk_degree / len(buy) if len(buy) > 0 else 0.0
+                for code in buy:
+                    if not tradable[t, code]:
+                        continue
+                    price = opens[t, code]
+                    buy_amount = self._round_amount(value / price, factors[t, code])
+                    trade_val = buy_amount * price
+                    trade_cost = max(trade_val * self.open_cost, self.min_cost)
+                    if cash < trade_cost:
+                        continue
+                    if cash < trade_val + trade_cost:
+                        # Not enough cash for the order plus costs: buy what the cash allows.
+                        buy_amount = self._round_amount(cash / (1 + self.open_cost) / price, factors[t, code])
+                        trade_val = buy_amount * price
+                        trade_cost = max(trade_val * self.open_cost, self.min_cost)
+                    if buy_amount <= 0:
+                        continue
+                    cash -= trade_val + trade_cost
+                    cost += trade_cost
+                    turnover += trade_val
+                    amount[code] += buy_amount
+                    hold_days[code] = 0
+
+            held = amount > 0
+            hold_days[held] += 1
+            account_value = cash + float(np.nansum(amount[held] * marks[t, held]))
+            rows.append({
+                'return': (account_value - last_value + cost) / last_value,
+                'cost': cost / last_value,
+                'turnover': turnover / last_value,
+                'account_value': account_value,
+            })
+            last_value = account_value
+
+        report = pd.DataFrame(rows, index=calendar[steps])
+        report.index.name = 'datetime'
+        report.insert(2, 'bench', bench.reindex(report.index).fillna(0.0) if bench is not None else 0.0)
+        return report
+
+    def run_many(self, signals: dict[str, pd.DataFrame], open_price: pd.DataFrame, close_price: pd.DataFrame,
+                 **kwargs) -> dict[str, pd.DataFrame]:
+        """Runs `run` for every signal variant and returns the reports keyed like `signals`."""
+        return {name: self.run(signal, open_price, close_price, **kwargs) for name, signal in signals.items()}
+
+
+def analyze_report(report: pd.DataFrame, excess: bool = True) -> dict[str, pd.Series]:
+    """
+    Computes the same excess-return analysis as `QlibBacktest.run_single_backtest`.
+
+    Args:
+        report (pd.DataFrame): Daily report from `VectorizedTopkDropout.run`.
+        excess (bool): Set to False if the report was run without a benchmark; the
+            absolute returns are then analyzed and labeled as such.
+    """
+    if not excess:
+        return {
+            "return_without_cost": risk_metrics(report["return"]),
+            "return_with_cost": risk_metrics(report["return"] - report["cost"]),
+        }
+    return {
+        "excess_return_without_cost": risk_metrics(report["return"] - report["bench"]),
+        "excess_return_with_cost": risk_metrics(report["return"] - report["bench"] - report["cost"]),
+    }
+
+
+def load_qlib_prices(config: Config, instruments: list) -> tuple:
+    """
+    Loads open, close and factor matrices plus the benchmark returns from the qlib provider.
+
+    Only needed to check this engine against qlib; qlib is imported lazily.
+    """
+    import qlib
+    from qlib.config import REG_CN
+    from qlib.data import D
+
+    qlib.init(provider_uri=config.qlib_data_path, region=REG_CN)
+    start, end = config.backtest_time_range
+    # One extra month before the start provides the previous close and the first day's scores.
+    fetch_start = pd.Timestamp(start) - pd.Timedelta(days=31)
+    fields = D.features(instruments, ['$open', '$close', '$factor'], fetch_start, end, freq='day')
+    wide = fields.unstack(level='instrument')
+    bench_close = D.features([config.backtest_benchmark], ['$close'], fetch_start, end, freq='day')['$close']
+    bench = bench_close.droplevel('instrument').pct_change(fill_method=None)
+    return wide['$open'], wide['$close'], wide['$factor'], bench
+
+
+def compare_with_qlib(config: Config, signal: pd.DataFrame) -> pd.DataFrame:
+    """
+    Runs one signal through both qlib and this engine and prints the difference.
+
+    Returns:
+        pd.DataFrame: Side-by-side cumulative excess returns with cost.
+    """
+    from qlib_test import QlibBacktest
+
+    signal_series = signal.stack()
+    signal_series.index.names = ['datetime', 'instrument']
+    qlib_report = QlibBacktest(config).run_single_backtest(signal_series.swaplevel().sort_index())['report']
+
+    open_price, close_price, factor, bench = load_qlib_prices(config, list(signal.columns))
+    report = VectorizedTopkDropout.from_config(config).run(
+        signal, open_price, close_price, factor=factor, bench=bench,
+        start_time=config.backtest_time_range[0], end_time=config.backtest_time_range[1],
+    )
+    ours = (report['return'] - report['bench'] - report['cost']).cumsum()
+    comparison = pd.DataFrame({'qlib': qlib_report['cum_ex_return_w_cost'], 'vectorized': ours}).dropna()
+    diff = (comparison['qlib'] - comparison['vectorized']).abs()
+    print(f"Compared {len(comparison)} days: max |diff| of cumulative excess return {diff.max():.6f}, "
+          f"final qlib {comparison['qlib'].iloc[-1]:.4f} vs vectorized {comparison['vectorized'].iloc[-1]:.4f}")
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vectorized TopkDropout backtest of saved prediction signals")
+    parser.add_argument("--predictions", type=str, default=None,
+                        help="Signal file written by qlib_test.py. Defaults to the configured backtest folder")
+    parser.add_argument("--prices", type=str, default=None,
+                        help="Per-symbol price pickle (e.g. test_data.pkl). Defaults to the dataset path")
+    parser.add_argument("--qlib-data", action="store_true",
+                        help="Read prices, adjustment factors and the benchmark from the qlib provider "
+                             "(needs qlib) instead of --prices, so the results reproduce QlibBacktest")
+    parser.add_argument("--validate", action="store_true",
+                        help="Also run every signal through qlib (needs the qlib provider data) and compare")
+    args = parser.parse_args()
+
+    config = Config()
+    predictions = args.predictions or os.path.join(
+        config.backtest_result_path, config.backtest_save_folder_name, "predictions.npz")
+    signals = load_signals(predictions)
+
+    if args.validate:
+        for name, signal in signals.items():
+            print(f"\nValidating signal: {name}...")
+            compare_with_qlib(config, signal)
+        return
+
+    factor = bench = None
+    if args.qlib_data:
+        instruments = sorted(set().union(*(signal.columns for signal in signals.values())))
+        open_price, close_price, factor, bench = load_qlib_prices(config, instruments)
+    else:
+        # The price pickle has neither the benchmark nor the adjustment factors, so the
+        # results are absolute returns without lot-size rounding.
+        prices_path = args.prices or os.path.join(config.dataset_path, "test_data.pkl")
+        open_price, close_price = price_matrices(pd.read_pickle(prices_path))
+        print("No benchmark or adjustment factors without --qlib-data: reporting absolute returns.")
+    engine = VectorizedTopkDropout.from_config(config)
+    reports = engine.run_many(signals, open_price, close_price, factor=factor, bench=bench,
+                              start_time=config.backtest_time_range[0], end_time=config.backtest_time_range[1])
+    for name, report in reports.items():
+        print(f"\n--- Signal: {name} ---")
+        print(pd.DataFrame(analyze_report(report, excess=bench is not None)))
+
+
+if __name__ == '__main__':
+    main()
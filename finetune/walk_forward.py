@@ -0,0 +1,319 @@
+"""
+Walk-forward evaluation of the Kronos signals.
+
+A train/val/test window is stepped through `Config.walk_forward_range`. For
+every fold the test months are predicted, scored with daily IC/RankIC against
+realized forward returns and backtested with the vectorized TopkDropout engine
+(excess returns over the equal-weighted universe). With `--finetune`, the
+tokenizer and predictor are fine-tuned on each fold's train/val months first.
+Without it, every fold uses the configured fine-tuned models, and folds whose
+test months overlap the models' `train_time_range`..`val_time_range` are
+skipped with a warning, since those days were used to train and select them.
+
+Predictions are cached per model under `<save_path>/walk_forward/<name>/cache`,
+so folds sharing a model only predict the days no earlier fold (or earlier
+run) has scored; rerunning the evaluation predicts nothing new.
+
+Usage (from the finetune directory, after `qlib_data_preprocess.py` has
+written the symbol store):
+    python walk_forward.py --device cuda:0
+    python walk_forward.py --device cuda:0 --finetune --name yearly_refit
+"""
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+
+from config import Config
+from qlib_test import QlibTestDataset, build_run_config, load_models, predict_signals
+from sweep import FINETUNE_DIR, SCRIPTS
+from utils.checkpoint_manager import checkpoint_fingerprint
+from utils.columnar_store import SymbolStore, load_signals, save_signals, signals_to_frames
+from utils.signal_metrics import forward_returns
+from vector_backtest import VectorizedTopkDropout, analyze_report, price_matrices
+
+
+def generate_folds(start, end, train_months: int, val_months: int, test_months: int, step_months: int,
+                   expanding: bool = False) -> list[dict]:
+    """
+    Steps a train/val/test window through [start, end].
+
+    Folds whose test window would start after `end` are not generated; the test
+    window of the last fold is cut at `end`.
+
+    Returns:
+        list[dict]: One dict per fold with 'train', 'val' and 'test' [start, end] date strings.
+    """
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    one_day = pd.Timedelta(days=1)
+    folds = []
+    offset = 0
+    while True:
+        train_start = start if expanding else start + pd.DateOffset(months=offset)
+        val_start = start + pd.DateOffset(months=offset + train_months)
+        test_start = val_start + pd.DateOffset(months=val_months)
+        test_end = min(test_start + pd.DateOffset(months=test_months) - one_day, end)
+        if test_start > end:
+            break
+        folds.append({
+            'train': [train_start, val_start - one_day],
+            'val': [val_start, test_start - one_day],
+            'test': [test_start, test_end],
+        })
+        offset += step_months
+    return [{split: [d.strftime('%Y-%m-%d') for d in dates] for split, dates in fold.items()} for fold in folds]
+
+
+def slice_with_context(data: dict, start, end, context: int, tail: int = 0) -> dict:
+    """
+    Cuts every symbol to [start, end], plus `context` bars before and `tail` bars after.
+
+    Symbols without any bar in [start, end] are dropped.
+    """
+    sliced = {}
+    for symbol, df in data.items():
+        first = df.index.searchsorted(pd.Timestamp(start))
+        last = df.index.searchsorted(pd.Timestamp(end), side='right')
+        if last > first:
+            sliced[symbol] = df.iloc[max(0, first - context):last + tail]
+    return sliced
+
+
+def label_matrix(data: dict, horizon: int = 1) -> pd.DataFrame:
+    """Wide (datetime x symbol) matrix of every symbol's `forward_returns`."""
+    return pd.DataFrame({
+        symbol: pd.Series(forward_returns(df['close'].to_numpy(), horizon), index=df.index)
+        for symbol, df in data.items()
+    }).sort_index()
+
+
+def ranges_overlap(a: list, b: list) -> bool:
+    """Returns True if the [start, end] date ranges `a` and `b` share a day."""
+    return pd.Timestamp(a[0]) <= pd.Timestamp(b[1]) and pd.Timestamp(b[0]) <= pd.Timestamp(a[1])
+
+
+def daily_ic(signal: pd.DataFrame, label: pd.DataFrame) -> pd.DataFrame:
+    """Cross-sectional Pearson (IC) and Spearman (RankIC) correlation of each day's signal and label."""
+    signal, label = signal.align(label, join='inner')
+    valid = signal.notna() & label.notna()
+    signal, label = signal.where(valid), label.where(valid)
+    return pd.DataFrame({
+        'ic': signal.corrwith(label, axis=1),
+        'rank_ic': signal.rank(axis=1).corrwith(label.rank(axis=1), axis=1),
+    }).dropna()
+
+
+def ic_summary(ic_df: pd.DataFrame) -> dict:
+    """Means and information ratios (mean / std) of a `daily_ic` frame."""
+    return {
+        'ic': ic_df['ic'].mean(),
+        'icir': ic_df['ic'].mean() / ic_df['ic'].std(),
+        'rank_ic': ic_df['rank_ic'].mean(),
+        'rank_icir': ic_df['rank_ic'].mean() / ic_df['rank_ic'].std(),
+    }
+
+
+class PredictionCache:
+    """
+    Signal predictions of one model, persisted with `save_signals`.
+
+    Args:
+        path (str): The cache file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.signals = load_signals(path) if os.path.exists(path) else {}
+
+    @staticmethod
+    def key(run_config: dict) -> str:
+        """
+        Identifies the predictions of a model and its sampling settings.
+
+        The checkpoints' file sizes and modification times are part of the key, so
+        retraining into the same paths (e.g. rerunning with `--finetune`) starts a new cache.
+        """
+        keys = ['tokenizer_path', 'model_path', 'max_context', 'pred_len', 'clip', 'T', 'top_k', 'top_p',
+                'sample_count']
+        identity = {k: run_config[k] for k in keys}
+        identity['tokenizer_files'] = checkpoint_fingerprint(run_config['tokenizer_path'])
+        identity['model_files'] = checkpoint_fingerprint(run_config['model_path'])
+        identity = json.dumps(identity, sort_keys=True, default=str)
+        return hashlib.sha256(identity.encode()).hexdigest()[:16]
+
+    def cached_mask(self, dataset: QlibTestDataset) -> np.ndarray:
+        """Returns, for every window of `dataset`, whether its prediction is cached."""
+        if not self.signals:
+            return np.zeros(len(dataset), dtype=bool)
+        cached = next(iter(self.signals.values())).reindex(
+            index=pd.DatetimeIndex(dataset.dates), columns=dataset.symbols).to_numpy()
+        return ~np.isnan(cached[dataset.date_ids, dataset.symbol_ids])
+
+    def update(self, frames: dict[str, pd.DataFrame]):
+        """Adds new predictions and writes the cache."""
+        self.signals = {
+            sig_type: df.combine_first(self.signals[sig_type]) if sig_type in self.signals else df
+            for sig_type, df in frames.items()
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        save_signals(self.path, self.signals)
+
+
+class WalkForwardEvaluator:
+    """
+    Runs the walk-forward folds and collects their IC and backtest statistics.
+
+    Args:
+        config (Config): Base configuration; fold ranges and paths are derived from it.
+        device (str): Inference device.
+        name (str): Name of the evaluation; results go to `<save_path>/walk_forward/<name>`.
+        finetune (bool): Fine-tune the tokenizer and predictor on every fold.
+    """
+
+    def __init__(self, config: Config, device: str, name: str = 'default', finetune: bool = False):
+        self.config = config
+        self.device = device
+        self.finetune = finetune
+        self.out_dir = os.path.join(config.save_path, 'walk_forward', name)
+        self.folds = generate_folds(
+            *config.walk_forward_range, config.walk_forward_train_months, config.walk_forward_val_months,
+            config.walk_forward_test_months, config.walk_forward_step_months, config.walk_forward_expanding,
+        )
+
+        store = SymbolStore(config.dataset_store_path, config.feature_list)
+        if not store.exists():
+            raise FileNotFoundError(f"No symbol store at {config.dataset_store_path}; run qlib_data_preprocess.py first")
+        print(f"Loading {len(store.symbols)} symbols from {config.dataset_store_path}...")
+        self.data = store.read_all()
+        self.open_price, self.close_price = price_matrices(self.data)
+        self.label = label_matrix(self.data, config.signal_eval_horizon)
+        # Equal-weighted universe return as the benchmark of the excess returns.
+        self.bench = self.close_price.pct_change(fill_method=None).mean(axis=1)
+        self.engine = VectorizedTopkDropout.from_config(config)
+
+    def _finetune_fold(self, fold_id: int, fold: dict) -> dict:
+        """Writes the fold's datasets, fine-tunes both models on them and returns their overrides."""
+        fold_dir = os.path.join(self.out_dir, f"fold_{fold_id:03d}")
+        dataset_path = os.path.join(fold_dir, 'data')
+        save_path = os.path.join(fold_dir, 'models')
+        os.makedirs(dataset_path, exist_ok=True)
+
+        # Validation and test windows need `lookback_window` bars of context before their range.
+        context = {'train': 0, 'val': self.config.lookback_window, 'test': self.config.lookback_window}
+        for split, (start, end) in fold.items():
+            with open(os.path.join(dataset_path, f"{split}_data.pkl"), 'wb') as f:
+                pickle.dump(slice_with_context(self.data, start, end, context[split]), f)
+
+        overrides = {
+            'dataset_path': dataset_path,
+            'save_path': save_path,
+            'train_time_range': fold['train'],
+            'val_time_range': fold['val'],
+            'test_time_range': fold['test'],
+            'finetuned_tokenizer_path': f"{save_path}/{self.config.tokenizer_save_folder_name}/checkpoints/best_model",
+            'finetuned_predictor_path': f"{save_path}/{self.config.predictor_save_folder_name}/checkpoints/best_model",
+        }
+        overrides_path = os.path.join(fold_dir, 'overrides.json')
+        with open(overrides_path, 'w') as f:
+            json.dump(overrides, f, indent=4)
+        for target in ('tokenizer', 'predictor'):
+            print(f"[Fold {fold_id}] Fine-tuning the {target}...")
+            subprocess.run([sys.executable, SCRIPTS[target], '--overrides', overrides_path],
+                           cwd=FINETUNE_DIR, check=True)
+        return overrides
+
+    def predict_fold(self, fold_id: int, fold: dict, run_config: dict) -> dict[str, pd.DataFrame]:
+        """Returns the fold's test signals, predicting only the windows missing from the cache."""
+        cache = PredictionCache(os.path.join(self.out_dir, 'cache', f"{PredictionCache.key(run_config)}.npz"))
+        start, end = fold['test']
+        data = slice_with_context(self.data, start, end, self.config.lookback_window - 1,
+                                  tail=self.config.predict_window)
+        dataset = QlibTestDataset(data=data, config=self.config)
+
+        timestamps = pd.DatetimeIndex(dataset.timestamps)
+        in_range = np.asarray((timestamps >= start) & (timestamps <= end))
+        missing = np.flatnonzero(in_range & ~cache.cached_mask(dataset))
+        print(f"[Fold {fold_id}] {in_range.sum()} test windows, {len(missing)} not cached yet")
+        if len(missing) > 0:
+            tokenizer, model = load_models(run_config)
+            signals = predict_signals(run_config, tokenizer, model, dataset, missing)
+            cache.update(signals_to_frames(dataset.dates, dataset.symbols, signals))
+            del tokenizer, model
+
+        return {sig_type: df.loc[start:end] for sig_type, df in cache.signals.items()}
+
+    def evaluate_fold(self, fold_id: int, fold: dict, signals: dict[str, pd.DataFrame]) -> list[dict]:
+        """Computes the IC and backtest statistics of every signal of a fold."""
+        start, end = fold['test']
+        rows = []
+        for sig_type, signal in signals.items():
+            report = self.engine.run(signal, self.open_price, self.close_price, bench=self.bench,
+                                     start_time=start, end_time=end)
+            excess = analyze_report(report)['excess_return_with_cost']
+            rows.append({
+                'fold': fold_id,
+                'test_start': start,
+                'test_end': end,
+                'signal': sig_type,
+                **ic_summary(daily_ic(signal, self.label.loc[start:end])),
+                'excess_annualized_return': excess['annualized_return'],
+                'excess_information_ratio': excess['information_ratio'],
+                'excess_max_drawdown': excess['max_drawdown'],
+            })
+        return rows
+
+    def run(self) -> pd.DataFrame:
+        """Runs every fold and writes `folds.csv` to the output directory."""
+        os.makedirs(self.out_dir, exist_ok=True)
+        base_run_config = build_run_config(self.config, self.device)
+        # Without --finetune, all folds share the configured models, which saw these days.
+        model_range = [self.config.train_time_range[0], self.config.val_time_range[1]]
+        rows = []
+        for fold_id, fold in enumerate(self.folds):
+            print(f"\n--- Fold {fold_id}: train {fold['train']}, val {fold['val']}, test {fold['test']} ---")
+            if not self.finetune and ranges_overlap(fold['test'], model_range):
+                print(f"[Fold {fold_id}] Skipped: the test range overlaps the models' train/val range "
+                      f"{model_range}, so its results would be leaked. Use --finetune to evaluate it.")
+                continue
+            run_config = dict(base_run_config)
+            if self.finetune:
+                overrides = self._finetune_fold(fold_id, fold)
+                run_config['tokenizer_path'] = overrides['finetuned_tokenizer_path']
+                run_config['model_path'] = overrides['finetuned_predictor_path']
+
+            signals = self.predict_fold(fold_id, fold, run_config)
+            rows.extend(self.evaluate_fold(fold_id, fold, signals))
+
+            results = pd.DataFrame(rows)
+            results.to_csv(os.path.join(self.out_dir, 'folds.csv'), index=False)
+
+        results = pd.DataFrame(rows)
+        if results.empty:
+            print("\nNo fold was evaluated.")
+            return results
+        print("\n--- Walk-forward Results ---")
+        print(results.to_string(index=False))
+        print("\n--- Mean over Folds ---")
+        print(results.drop(columns=['fold', 'test_start', 'test_end']).groupby('signal').mean())
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Walk-forward evaluation of the Kronos signals")
+    parser.add_argument("--device", type=str, default="cuda:0", help="Device for inference (e.g., 'cuda:0', 'cpu')")
+    parser.add_argument("--name", type=str, default='default', help="Name of the evaluation (output folder)")
+    parser.add_argument("--finetune", action="store_true",
+                        help="Fine-tune the tokenizer and predictor on every fold's train/val months")
+    args = parser.parse_args()
+
+    WalkForwardEvaluator(Config(), args.device, name=args.name, finetune=args.finetune).run()
+
+
+if __name__ == '__main__':
+    main()
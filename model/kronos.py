@@ -4,10 +4,25 @@ from huggingface_hub import PyTorchModelHubMixin
 import numpy as np
 import pandas as pd
 import torch
+from torch.utils.checkpoint import checkpoint
 from tqdm import trange
 
 sys.path.append("../")
 from model.module import *
+from model.window_stats import denormalize_window, normalize_window
+
+
+def run_block(layer, x, key_padding_mask=None, use_checkpoint=False, segment_ids=None):
+    """
+    Runs one TransformerBlock, optionally with activation checkpointing.
+
+    With `use_checkpoint`, the block's activations are not kept for backward and
+    are recomputed instead, trading compute for memory. Checkpointing is skipped
+    when gradients are disabled (e.g. inference), where it would only add cost.
+    """
+    if use_checkpoint and torch.is_grad_enabled():
+        return checkpoint(layer, x, key_padding_mask, segment_ids, use_reentrant=False)
+    return layer(x, key_padding_mask=key_padding_mask, segment_ids=segment_ids)
 
 
 class KronosTokenizer(nn.Module, PyTorchModelHubMixin):
@@ -70,6 +85,31 @@ class KronosTokenizer(nn.Module, PyTorchModelHubMixin):
         self.post_quant_embed_pre = nn.Linear(in_features=self.s1_bits, out_features=self.d_model) # Linear layer after quantization (pre part - s1 bits)
         self.post_quant_embed = nn.Linear(in_features=self.codebook_dim, out_features=self.d_model) # Linear layer after quantization (full codebook)
         self.tokenizer = BSQuantizer(self.s1_bits, self.s2_bits, beta, gamma0, gamma, zeta, group_size) # BSQuantizer module
+        self.gradient_checkpointing = False # Per-block activation checkpointing, see `set_gradient_checkpointing`
+        self.fused_decoder = False # Single decoder pass for both reconstructions, see `set_fused_decoder`
+
+    def set_gradient_checkpointing(self, enabled=True):
+        """
+        Enables or disables activation checkpointing for the encoder and decoder blocks.
+
+        Args:
+            enabled (bool, optional): Whether to recompute block activations in the backward pass. Defaults to True.
+        """
+        self.gradient_checkpointing = enabled
+
+    def set_fused_decoder(self, enabled=True):
+        """
+        Enables or disables the fused decoder pass in `forward`.
+
+        When enabled, the s1-only and full-codebook decoder inputs are stacked along the batch
+        dimension and decoded in one pass instead of two. Decoder blocks process every sample
+        independently, so the reconstructions are the same as with two passes (up to dropout
+        masks and floating-point reduction order); the larger batch uses the device better.
+
+        Args:
+            enabled (bool, optional): Whether to fuse the two decoder passes. Defaults to True.
+        """
+        self.fused_decoder = enabled
 
     def forward(self, x):
         """
@@ -89,7 +129,7 @@ class KronosTokenizer(nn.Module, PyTorchModelHubMixin):
         z = self.embed(x)
 
         for layer in self.encoder:
-            z = layer(z)
+            z = run_block(layer, z, use_checkpoint=self.gradient_checkpointing)
 
         z = self.quant_embed(z) # (B, T, codebook)
 
@@ -100,15 +140,24 @@ class KronosTokenizer(nn.Module, PyTorchModelHubMixin):
 
         z = self.post_quant_embed(quantized)
 
-        # Decoder layers (for pre part - s1 bits)
-        for layer in self.decoder:
-            z_pre = layer(z_pre)
-        z_pre = self.head(z_pre)
+        if self.fused_decoder:
+            # Decoder layers for both parts in one pass, stacked along the batch dimension
+            batch_size = z.shape[0]
+            z_both = torch.cat([z_pre, z], dim=0)
+            for layer in self.decoder:
+                z_both = run_block(layer, z_both, use_checkpoint=self.gradient_checkpointing)
+            z_both = self.head(z_both)
+            z_pre, z = z_both[:batch_size], z_both[batch_size:]
+        else:
+            # Decoder layers (for pre part - s1 bits)
+            for layer in self.decoder:
+                z_pre = run_block(layer, z_pre, use_checkpoint=self.gradient_checkpointing)
+            z_pre = self.head(z_pre)
 
-        # Decoder layers (for full codebook)
-        for layer in self.decoder:
-            z = layer(z)
-        z = self.head(z)
+            # Decoder layers (for full codebook)
+            for layer in self.decoder:
+                z = run_block(layer, z, use_checkpoint=self.gradient_checkpointing)
+            z = self.head(z)
 
         return (z_pre, z), bsq_loss, quantized, z_indices
 
@@ -139,20 +188,23 @@ class KronosTokenizer(nn.Module, PyTorchModelHubMixin):
         x = x * q_scale
         return x
 
-    def encode(self, x, half=False):
+    def encode(self, x, half=False, segment_ids=None):
         """
         Encodes the input data into quantized indices.
 
         Args:
             x (torch.Tensor): Input tensor of shape (batch_size, seq_len, d_in).
             half (bool, optional): Whether to use half quantization in BSQuantizer. Defaults to False.
+            segment_ids (torch.Tensor, optional): Segment id of every position for packed rows.
+                Shape: [batch_size, seq_len]. Positions only attend within their own segment,
+                so each packed sequence is encoded as if it were alone. Defaults to None.
 
         Returns:
             torch.Tensor: Quantized indices from BSQuantizer.
         """
         z = self.embed(x)
         for layer in self.encoder:
-            z = layer(z)
+            z = run_block(layer, z, use_checkpoint=self.gradient_checkpointing, segment_ids=segment_ids)
         z = self.quant_embed(z)
 
         bsq_loss, quantized, z_indices = self.tokenizer(z, half)
@@ -172,7 +224,7 @@ class KronosTokenizer(nn.Module, PyTorchModelHubMixin):
         quantized = self.indices_to_bits(x, half)
         z = self.post_quant_embed(quantized)
         for layer in self.decoder:
-            z = layer(z)
+            z = run_block(layer, z, use_checkpoint=self.gradient_checkpointing)
         z = self.head(z)
         return z
 
@@ -220,8 +272,18 @@ class Kronos(nn.Module, PyTorchModelHubMixin):
         self.norm = RMSNorm(self.d_model)
         self.dep_layer = DependencyAwareLayer(self.d_model)
         self.head = DualHead(self.s1_bits, self.s2_bits, self.d_model)
+        self.gradient_checkpointing = False  # Per-block activation checkpointing, see `set_gradient_checkpointing`
         self.apply(self._init_weights)
 
+    def set_gradient_checkpointing(self, enabled=True):
+        """
+        Enables or disables activation checkpointing for the transformer blocks.
+
+        Args:
+            enabled (bool, optional): Whether to recompute block activations in the backward pass. Defaults to True.
+        """
+        self.gradient_checkpointing = enabled
+
     def _init_weights(self, module):
 
         if isinstance(module, nn.Linear):
@@ -236,7 +298,7 @@ class Kronos(nn.Module, PyTorchModelHubMixin):
         elif isinstance(module, RMSNorm):
             nn.init.ones_(module.weight)
 
-    def forward(self, s1_ids, s2_ids, stamp=None, padding_mask=None, use_teacher_forcing=False, s1_targets=None):
+    def forward(self, s1_ids, s2_ids, stamp=None, padding_mask=None, use_teacher_forcing=False, s1_targets=None, segment_ids=None):
         """
         Args:
             s1_ids (torch.Tensor): Input tensor of s1 token IDs. Shape: [batch_size, seq_len]
@@ -245,6 +307,9 @@ class Kronos(nn.Module, PyTorchModelHubMixin):
             padding_mask (torch.Tensor, optional): Mask for padding tokens. Shape: [batch_size, seq_len]. Defaults to None.
             use_teacher_forcing (bool, optional): Whether to use teacher forcing for s1 decoding. Defaults to False.
             s1_targets (torch.Tensor, optional): Target s1 token IDs for teacher forcing. Shape: [batch_size, seq_len]. Defaults to None.
+            segment_ids (torch.Tensor, optional): Segment id of every position for packed rows. Shape: [batch_size, seq_len].
+                Attention is causal within each segment and blocked across segments. Give padding its own
+                id (e.g. 0) rather than masking it via `padding_mask`, so no query row is fully masked. Defaults to None.
 
         Returns:
             Tuple[torch.Tensor, torch.Tensor]:
@@ -258,7 +323,8 @@ class Kronos(nn.Module, PyTorchModelHubMixin):
         x = self.token_drop(x)
 
         for layer in self.transformer:
-            x = layer(x, key_padding_mask=padding_mask)
+            x = run_block(layer, x, key_padding_mask=padding_mask, use_checkpoint=self.gradient_checkpointing,
+                          segment_ids=segment_ids)
 
         x = self.norm(x)
 
@@ -271,7 +337,7 @@ class Kronos(nn.Module, PyTorchModelHubMixin):
             sample_s1_ids = torch.multinomial(s1_probs.view(-1, self.s1_vocab_size), 1).view(s1_ids.shape)
             sibling_embed = self.embedding.emb_s1(sample_s1_ids)
 
-        x2 = self.dep_layer(x, sibling_embed, key_padding_mask=padding_mask) # Dependency Aware Layer: Condition on s1 embeddings
+        x2 = self.dep_layer(x, sibling_embed, key_padding_mask=padding_mask, segment_ids=segment_ids) # Dependency Aware Layer: Condition on s1 embeddings
         s2_logits = self.head.cond_forward(x2)
         return s1_logits, s2_logits
 
@@ -300,7 +366,7 @@ class Kronos(nn.Module, PyTorchModelHubMixin):
         x = self.token_drop(x)
 
         for layer in self.transformer:
-            x = layer(x, key_padding_mask=padding_mask)
+            x = run_block(layer, x, key_padding_mask=padding_mask, use_checkpoint=self.gradient_checkpointing)
 
         x = self.norm(x)
 
@@ -522,9 +588,7 @@ class KronosPredictor:
         y_stamp = y_time_df.values.astype(np.float32)
 
         x_mean, x_std = np.mean(x, axis=0), np.std(x, axis=0)
-
-        x = (x - x_mean) / (x_std + 1e-5)
-        x = np.clip(x, -self.clip, self.clip)
+        x = normalize_window(x, x_mean, x_std, self.clip)
 
         x = x[np.newaxis, :]
         x_stamp = x_stamp[np.newaxis, :]
@@ -533,7 +597,7 @@ class KronosPredictor:
         preds = self.generate(x, x_stamp, y_stamp, pred_len, T, top_k, top_p, sample_count, verbose)
 
         preds = preds.squeeze(0)
-        preds = preds * (x_std + 1e-5) + x_mean
+        preds = denormalize_window(preds, x_mean, x_std)
 
         pred_df = pd.DataFrame(preds, columns=self.price_cols + [self.vol_col, self.amt_vol], index=y_timestamp)
         return pred_df
@@ -315,7 +315,6 @@ def scaled_dot_product_attention(query, key, value, attn_mask=None, dropout_p=0.
     attn_bias = torch.zeros(L, S, dtype=query.dtype).to(query.device)
 
     if is_causal:
-        assert attn_mask is None
         temp_mask = torch.ones(L, S, dtype=torch.bool).tril(diagonal=0).to(query.device)
         attn_bias.masked_fill_(temp_mask.logical_not(), float("-inf"))
         attn_bias.to(query.dtype)
@@ -336,6 +335,20 @@ def scaled_dot_product_attention(query, key, value, attn_mask=None, dropout_p=0.
     return attn_weight @ value
 
 
+def segment_attention_mask(segment_ids):
+    """
+    Builds a block-diagonal attention mask for packed sequences.
+
+    Args:
+        segment_ids (torch.Tensor): Integer segment id of every position. Shape: [batch, seq_len]
+
+    Returns:
+        torch.Tensor: Boolean mask of shape [batch, 1, seq_len, seq_len], True where the
+            query and key positions belong to different segments (attention blocked).
+    """
+    return (segment_ids.unsqueeze(-1) != segment_ids.unsqueeze(-2)).unsqueeze(1)
+
+
 class MultiHeadAttentionWithRoPE(nn.Module):
     def __init__(self, d_model, n_heads, attn_dropout_p=0.0, resid_dropout_p=0.0):
         super().__init__()
@@ -351,7 +364,7 @@ class MultiHeadAttentionWithRoPE(nn.Module):
         self.attn_dropout_p = attn_dropout_p
         self.resid_dropout = nn.Dropout(resid_dropout_p)
 
-    def forward(self, x, key_padding_mask=None):
+    def forward(self, x, key_padding_mask=None, segment_ids=None):
         batch_size, seq_len, _ = x.shape
 
         q = self.q_proj(x).view(batch_size, seq_len, self.n_heads, self.head_dim).transpose(1, 2)
@@ -366,6 +379,11 @@ class MultiHeadAttentionWithRoPE(nn.Module):
         else:
             attn_mask = None
 
+        if segment_ids is not None:
+            # Packed rows: each position only attends within its own segment.
+            segment_mask = segment_attention_mask(segment_ids)
+            attn_mask = segment_mask if attn_mask is None else attn_mask | segment_mask
+
         attn_output = scaled_dot_product_attention(
             q, k, v,
             attn_mask=attn_mask,
@@ -392,7 +410,7 @@ class MultiHeadCrossAttentionWithRoPE(nn.Module):
         self.attn_dropout_p = attn_dropout_p
         self.resid_dropout = nn.Dropout(resid_dropout)
 
-    def forward(self, query, key, value, key_padding_mask=None):
+    def forward(self, query, key, value, key_padding_mask=None, segment_ids=None):
         batch_size, q_len, _ = query.shape
         _, seq_len, _ = key.shape
 
@@ -408,6 +426,10 @@ class MultiHeadCrossAttentionWithRoPE(nn.Module):
         else:
             attn_mask = None
 
+        if segment_ids is not None:
+            segment_mask = segment_attention_mask(segment_ids)
+            attn_mask = segment_mask if attn_mask is None else attn_mask | segment_mask
+
         is_causal_flag = self.training
 
         attn_output = scaled_dot_product_attention(
@@ -458,15 +480,17 @@ class DependencyAwareLayer(nn.Module):
         self.cross_attn = MultiHeadCrossAttentionWithRoPE(d_model, n_heads, attn_dropout_p, resid_dropout)
         self.norm = RMSNorm(d_model)
 
-    def forward(self, hidden_states, sibling_embed, key_padding_mask=None):
+    def forward(self, hidden_states, sibling_embed, key_padding_mask=None, segment_ids=None):
         """hidden_states: [batch, seq_len, d_model]
         sibling_embed: Embedding from another subtoken
+        segment_ids: Optional [batch, seq_len] segment ids of packed rows
         """
         attn_out = self.cross_attn(
             query=sibling_embed,
             key=hidden_states,
             value=hidden_states,
-            key_padding_mask=key_padding_mask
+            key_padding_mask=key_padding_mask,
+            segment_ids=segment_ids
         )
         return self.norm(hidden_states + attn_out)
 
@@ -479,10 +503,10 @@ class TransformerBlock(nn.Module):
         self.norm2 = RMSNorm(d_model)
         self.ffn = FeedForward(d_model, ff_dim, ffn_dropout_p)
 
-    def forward(self, x, key_padding_mask=None):
+    def forward(self, x, key_padding_mask=None, segment_ids=None):
         residual = x
         x = self.norm1(x)
-        attn_out = self.self_attn(x, key_padding_mask=key_padding_mask)
+        attn_out = self.self_attn(x, key_padding_mask=key_padding_mask, segment_ids=segment_ids)
         x = residual + attn_out
 
         residual = x
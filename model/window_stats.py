@@ -0,0 +1,116 @@
+import numpy as np
+
+NORM_EPS = 1e-5
+
+
+class RollingWindowStats:
+    """
+    Per-feature mean and standard deviation of any window of a set of series in O(1).
+
+    The series are given concatenated, as the datasets store them. Every series
+    is cut into blocks of `block_size` rows, and within each block prefix sums
+    of the values and of their squares are precomputed in float64, after
+    subtracting the block's own mean. The sums therefore only grow with the
+    block, not with the series, and stay close to zero. A window of at most
+    `block_size` rows covers the tail of one block and the head of the next;
+    the statistics of the two parts come from differences of the block prefix
+    sums and are combined with the parallel (Chan et al.) form of Welford's
+    update, so the variance never subtracts two large, nearly equal numbers.
+
+    The two prefix arrays take four times the memory of float32 values, so
+    this suits backtests, whose consecutive windows overlap by all but one
+    bar, and not training datasets shared with DataLoader workers.
+
+    Args:
+        values (np.ndarray): Concatenated series of shape [N, F].
+        lengths (np.ndarray): Length of every series; they sum to N.
+        block_size (int): Block length, the longest window that can be looked up.
+    """
+
+    def __init__(self, values: np.ndarray, lengths, block_size: int):
+        lengths = np.asarray(lengths, dtype=np.int64)
+        self.block_size = block_size
+        self._offsets = np.cumsum(lengths) - lengths
+        # Index of each series' first block in `_shift`.
+        n_blocks = -(-lengths // block_size)
+        self._block_base = np.cumsum(n_blocks) - n_blocks
+
+        n_features = values.shape[-1]
+        self._sum = np.zeros((len(values), n_features), dtype=np.float64)
+        self._sq = np.zeros_like(self._sum)
+        self._shift = np.zeros((int(n_blocks.sum()), n_features), dtype=np.float64)
+
+        block = 0
+        for offset, length in zip(self._offsets, lengths):
+            for start in range(offset, offset + length, block_size):
+                end = min(start + block_size, offset + length)
+                chunk = values[start:end].astype(np.float64)
+                self._shift[block] = chunk.mean(axis=0)
+                chunk -= self._shift[block]
+                # Inclusive prefix sums, restarting at every block.
+                np.cumsum(chunk, axis=0, out=self._sum[start:end])
+                np.cumsum(chunk * chunk, axis=0, out=self._sq[start:end])
+                block += 1
+
+    def _part(self, block_start, first, last):
+        """Count, mean and sum of squared deviations of rows [first, last) of the blocks at `block_start`."""
+        count = (last - first)[..., None].astype(np.float64)
+        before = (first > block_start)[..., None]
+        s = self._sum[np.maximum(last - 1, 0)] - np.where(before, self._sum[np.maximum(first - 1, 0)], 0.0)
+        q = self._sq[np.maximum(last - 1, 0)] - np.where(before, self._sq[np.maximum(first - 1, 0)], 0.0)
+        # An empty part (the window does not cross into the next block) contributes nothing.
+        s = np.where(count > 0, s, 0.0)
+        q = np.where(count > 0, q, 0.0)
+        mean = s / np.maximum(count, 1.0)
+        return count, mean, q - s * mean
+
+    def mean_std(self, symbol_ids, rows, length: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Looks up the statistics of the windows `values[rows:rows + length]`.
+
+        Args:
+            symbol_ids (int or np.ndarray): Series of every window.
+            rows (int or np.ndarray): First row of every window in the concatenated values.
+                A window must not cross the end of its series.
+            length (int): Window length, at most `block_size`.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: float32 mean and population standard deviation,
+                of shape [F] for scalar arguments and [B, F] for arrays.
+
+        Raises:
+            ValueError: If `length` exceeds `block_size`.
+        """
+        if length > self.block_size:
+            raise ValueError(f"Window length {length} exceeds the block size {self.block_size}")
+        symbol_ids = np.asarray(symbol_ids, dtype=np.int64)
+        rows = np.asarray(rows, dtype=np.int64)
+        offsets = self._offsets[symbol_ids]
+        block = (rows - offsets) // self.block_size
+        head_start = offsets + block * self.block_size
+        split = np.minimum(head_start + self.block_size, rows + length)
+
+        # The window is the tail of its first block plus, if it crosses, the head of the next one.
+        n1, mean1, m2_1 = self._part(head_start, rows, split)
+        n2, mean2, m2_2 = self._part(split, split, rows + length)
+        first_block = self._block_base[symbol_ids] + block
+        mean1 = mean1 + self._shift[first_block]
+        mean2 = mean2 + self._shift[np.minimum(first_block + 1, len(self._shift) - 1)]
+
+        delta = mean2 - mean1
+        mean = mean1 + delta * (n2 / length)
+        m2 = m2_1 + m2_2 + delta * delta * (n1 * n2 / length)
+        # Only rounding can make the sum of squared deviations negative, and only by a few ulps.
+        std = np.sqrt(np.maximum(m2 / length, 0.0))
+        return mean.astype(np.float32), std.astype(np.float32)
+
+
+def normalize_window(x: np.ndarray, mean: np.ndarray, std: np.ndarray, clip: float) -> np.ndarray:
+    """Instance-level normalization with precomputed statistics, then clipping."""
+    x = (x - mean) / (std + NORM_EPS)
+    return np.clip(x, -clip, clip)
+
+
+def denormalize_window(x: np.ndarray, mean: np.ndarray, std: np.ndarray) -> np.ndarray:
+    """Inverse of `normalize_window` (up to the clipping)."""
+    return x * (std + NORM_EPS) + mean
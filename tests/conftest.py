@@ -0,0 +1,11 @@
+import os
+import sys
+
+# The fine-tuning scripts import their siblings as top-level modules (`from config import Config`)
+# and the model package from the repository root.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, 'finetune')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
@@ -0,0 +1,131 @@
+"""
+Regenerates the `topk_dropout` fixture used by `tests/test_vector_backtest.py`.
+
+A small synthetic market (a few symbols, limit moves, a suspension and
+non-trivial adjustment factors) is written as a qlib provider, and one random
+signal is backtested with qlib's `TopkDropoutStrategy` using the exchange
+settings of `QlibBacktest.run_single_backtest`. The market data, the signal
+and qlib's daily report are saved as CSV files next to this script.
+
+Needs `pyqlib`. Usage (from the repository root):
+    python tests/fixtures/make_topk_dropout_fixture.py
+"""
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'topk_dropout')
+BENCHMARK = 'SH000300'
+# Strategy settings shared with the test.
+STRATEGY = {'topk': 3, 'n_drop': 1, 'hold_thresh': 2}
+ACCOUNT = 1_000_000
+# qlib needs one calendar day after the end of the backtest.
+BACKTEST_RANGE = ('2021-01-11', '2021-03-04')
+
+
+def make_market(seed: int = 7) -> tuple[pd.DataFrame, pd.Series, pd.DataFrame]:
+    """Returns the long market frame, the benchmark close and the long signal frame."""
+    rng = np.random.default_rng(seed)
+    calendar = pd.bdate_range('2021-01-04', '2021-03-05')
+    symbols = [f"SH6000{i:02d}" for i in range(8)]
+
+    returns = rng.normal(0.0, 0.025, size=(len(calendar), len(symbols)))
+    returns[10, 1] = 0.10  # Limit up.
+    returns[15, 2] = -0.10  # Limit down.
+    returns[25, 4] = 0.099
+    returns[23, 3] = 0.12  # Limit up on the day symbol 3 resumes trading (see below).
+    close = 10.0 * np.cumprod(1 + returns, axis=0)
+    open_ = np.vstack([close[:1], close[:-1]]) * (1 + rng.normal(0.0, 0.005, size=close.shape))
+    factor = np.tile(rng.uniform(0.4, 3.0, size=len(symbols)), (len(calendar), 1))
+    factor[30:, 5] *= 1.2  # An adjustment event.
+
+    close_df = pd.DataFrame(close, index=calendar, columns=symbols)
+    open_df = pd.DataFrame(open_, index=calendar, columns=symbols)
+    # Suspensions: the symbol has no bars on these days.
+    close_df.iloc[20:23, 3] = np.nan
+    open_df.iloc[20:23, 3] = np.nan
+
+    market = pd.concat({
+        'open': open_df.stack(),
+        'close': close_df.stack(),
+        'factor': pd.DataFrame(factor, index=calendar, columns=symbols).stack(),
+    }, axis=1)
+    market.index.names = ['datetime', 'instrument']
+    # Rounded to the float32 values the qlib provider stores.
+    market = market.dropna().astype(np.float32).astype(np.float64)
+
+    bench = pd.Series(3000.0 * np.cumprod(1 + rng.normal(0.0, 0.01, size=len(calendar))), index=calendar)
+    bench = bench.astype(np.float32).astype(np.float64)
+
+    signal = pd.DataFrame(rng.normal(size=close.shape), index=calendar, columns=symbols)
+    signal.iloc[:, 7] = np.where(rng.uniform(size=len(calendar)) < 0.3, np.nan, signal.iloc[:, 7])
+    signal = signal.stack().rename('score').to_frame()
+    signal.index.names = ['datetime', 'instrument']
+    return market, bench, signal
+
+
+def write_provider(root: str, market: pd.DataFrame, bench: pd.Series):
+    """Writes the market as a qlib day-frequency binary provider."""
+    calendar = bench.index
+    os.makedirs(os.path.join(root, 'calendars'))
+    os.makedirs(os.path.join(root, 'instruments'))
+    with open(os.path.join(root, 'calendars', 'day.txt'), 'w') as f:
+        f.write('\n'.join(d.strftime('%Y-%m-%d') for d in calendar))
+
+    frames = {symbol: df.droplevel('instrument') for symbol, df in market.groupby(level='instrument')}
+    frames[BENCHMARK] = pd.DataFrame({'open': bench, 'close': bench, 'factor': 1.0})
+    with open(os.path.join(root, 'instruments', 'all.txt'), 'w') as f:
+        for symbol in frames:
+            f.write(f"{symbol}\t{calendar[0]:%Y-%m-%d}\t{calendar[-1]:%Y-%m-%d}\n")
+
+    for symbol, df in frames.items():
+        df = df.reindex(calendar)
+        # Like vendor data, the change is measured against the last close the symbol traded at.
+        df['change'] = df['close'] / df['close'].ffill().shift(1) - 1
+        df['volume'] = np.where(df['close'].notna(), 1e8, np.nan)
+        symbol_dir = os.path.join(root, 'features', symbol.lower())
+        os.makedirs(symbol_dir)
+        for field in ['open', 'close', 'factor', 'change', 'volume']:
+            values = np.hstack([[0], df[field].to_numpy(dtype=np.float64)]).astype('<f')
+            values.tofile(os.path.join(symbol_dir, f"{field}.day.bin"))
+
+
+def run_qlib(provider: str, signal: pd.DataFrame) -> pd.DataFrame:
+    import qlib
+    from qlib.backtest import backtest, executor
+    from qlib.config import REG_CN
+    from qlib.contrib.strategy import TopkDropoutStrategy
+
+    qlib.init(provider_uri=provider, region=REG_CN)
+    strategy = TopkDropoutStrategy(signal=signal['score'].swaplevel().sort_index(), **STRATEGY)
+    portfolio_metrics, _ = backtest(
+        start_time=BACKTEST_RANGE[0], end_time=BACKTEST_RANGE[1], strategy=strategy,
+        executor=executor.SimulatorExecutor(time_per_step='day', generate_portfolio_metrics=True,
+                                            delay_execution=True),
+        account=ACCOUNT, benchmark=BENCHMARK,
+        exchange_kwargs={'freq': 'day', 'limit_threshold': 0.095, 'deal_price': 'open',
+                         'open_cost': 0.001, 'close_cost': 0.0015, 'min_cost': 5},
+    )
+    report, _ = portfolio_metrics['1day']
+    return report
+
+
+def main():
+    market, bench, signal = make_market()
+    with tempfile.TemporaryDirectory() as provider:
+        write_provider(provider, market, bench)
+        report = run_qlib(provider, signal)
+
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    market.to_csv(os.path.join(FIXTURE_DIR, 'market.csv'))
+    bench.rename_axis('datetime').rename('close').to_csv(os.path.join(FIXTURE_DIR, 'bench.csv'))
+    signal.to_csv(os.path.join(FIXTURE_DIR, 'signal.csv'))
+    report.rename_axis('datetime')[['return', 'cost', 'bench', 'turnover', 'account']].to_csv(
+        os.path.join(FIXTURE_DIR, 'expected_report.csv'))
+    print(f"Fixture with {len(report)} days written to {FIXTURE_DIR}")
+
+
+if __name__ == '__main__':
+    main()
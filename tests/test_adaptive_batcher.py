@@ -0,0 +1,86 @@
+from qlib_test import AdaptiveBatcher, is_out_of_memory
+
+
+def _run(batcher, limit, steps):
+    """Runs `steps` batches against a device fitting at most `limit` windows; returns the sizes and OOM count."""
+    sizes, ooms = [], 0
+    for _ in range(steps):
+        if batcher.size > limit:
+            ooms += 1
+            batcher.on_oom()
+        else:
+            batcher.on_success()
+        sizes.append(batcher.size)
+    return sizes, ooms
+
+
+def test_starts_at_max_size_and_never_exceeds_it():
+    batcher = AdaptiveBatcher(64, grow_after=2)
+    assert batcher.size == 64
+    sizes, ooms = _run(batcher, limit=1000, steps=50)
+    assert ooms == 0 and set(sizes) == {64}
+
+
+def test_oom_halves_down_to_one():
+    batcher = AdaptiveBatcher(64, grow_after=2)
+    for expected in [32, 16, 8, 4, 2, 1, 1]:
+        batcher.on_oom()
+        assert batcher.size == expected
+
+
+def test_converges_below_the_memory_limit():
+    batcher = AdaptiveBatcher(100, grow_after=3)
+    sizes, ooms = _run(batcher, limit=70, steps=300)
+    # Binary search between the last fitting size and the failing ceiling.
+    assert sizes[:13] == [50, 50, 50, 75, 50, 50, 50, 62, 62, 62, 68, 68, 68]
+    assert sizes[-1] == 70
+    # An OOM falls back to the last size that fitted, not below it.
+    assert min(sizes[10:]) == 68
+    # Retrying the ceiling backs off: 3 OOMs to find the limit, then one per retry after 3, 6, 12, ... batches.
+    assert ooms == 9
+
+
+def test_failed_retries_back_off():
+    batcher = AdaptiveBatcher(16, grow_after=2)
+    batcher.on_oom()
+    waits = []
+    for _ in range(4):
+        successes = 0
+        while batcher.size < 16:
+            batcher.on_success()
+            successes += 1
+        waits.append(successes)
+        # The retried ceiling still does not fit.
+        batcher.on_oom()
+        assert batcher.size == 15
+    # 8, 12, 14, 15 to find the limit, then retries after 2, 4 and 8 successes at 15.
+    assert waits == [8, 4, 8, 16]
+
+
+def test_grows_back_after_a_transient_oom():
+    batcher = AdaptiveBatcher(64, grow_after=2)
+    batcher.on_oom()
+    assert batcher.size == 32
+    # Memory is available again: the search stops at 63 below the ceiling of 64, then retries it.
+    sizes, ooms = _run(batcher, limit=64, steps=40)
+    assert ooms == 0
+    assert 63 in sizes and sizes[-1] == 64
+
+
+def test_successes_are_counted_consecutively():
+    batcher = AdaptiveBatcher(64, grow_after=3)
+    batcher.on_oom()
+    batcher.on_success()
+    batcher.on_success()
+    batcher.on_oom()
+    batcher.on_success()
+    batcher.on_success()
+    assert batcher.size == 16
+    batcher.on_success()
+    assert batcher.size == 24
+
+
+def test_is_out_of_memory():
+    assert is_out_of_memory(RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB"))
+    assert is_out_of_memory(RuntimeError("[enforce fail at alloc_cpu.cpp] DefaultCPUAllocator: can't allocate memory"))
+    assert not is_out_of_memory(RuntimeError("shape mismatch"))
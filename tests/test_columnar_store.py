@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.columnar_store import SymbolStore, load_signals, save_signals
+
+FEATURES = ['open', 'close', 'vol']
+
+
+def _bars(start: str, periods: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    # The store keeps nanosecond timestamps.
+    index = pd.date_range(start, periods=periods, freq='B', name='datetime').astype('datetime64[ns]')
+    return pd.DataFrame(rng.normal(10.0, 1.0, size=(periods, len(FEATURES))), index=index, columns=FEATURES)
+
+
+def test_write_read_round_trip(tmp_path):
+    store = SymbolStore(str(tmp_path), FEATURES)
+    df = _bars('2021-01-04', 20)
+    store.write('SH600000', df)
+    store.save_manifest()
+
+    reopened = SymbolStore(str(tmp_path), FEATURES)
+    assert reopened.exists() and reopened.symbols == ['SH600000']
+    pd.testing.assert_frame_equal(reopened.read('SH600000'), df, check_freq=False)
+    entry = reopened.manifest['symbols']['SH600000']
+    assert (entry['start'], entry['end'], entry['rows']) == ('2021-01-04', '2021-01-29', 20)
+    assert reopened.last_dates() == {'SH600000': pd.Timestamp('2021-01-29')}
+
+
+def test_append_only_adds_newer_bars(tmp_path):
+    store = SymbolStore(str(tmp_path), FEATURES)
+    full = _bars('2021-01-04', 30)
+    store.write('SH600000', full.iloc[:20])
+
+    # The candidate bars overlap the stored ones by five days.
+    assert store.append('SH600000', full.iloc[15:]) == 10
+    assert store.append('SH600000', full.iloc[15:]) == 0
+    pd.testing.assert_frame_equal(store.read('SH600000'), full, check_freq=False)
+    assert store.manifest['symbols']['SH600000']['rows'] == 30
+
+
+def test_corrupted_symbol_fails_the_checksum(tmp_path):
+    store = SymbolStore(str(tmp_path), FEATURES)
+    store.write('SH600000', _bars('2021-01-04', 20))
+    store.write('SH600001', _bars('2021-01-04', 20, seed=1))
+    # Swap the files: both archives are valid, but hold the other symbol's data.
+    a, b = tmp_path / 'SH600000.npz', tmp_path / 'SH600001.npz'
+    a_bytes = a.read_bytes()
+    a.write_bytes(b.read_bytes())
+    b.write_bytes(a_bytes)
+
+    with pytest.raises(ValueError, match='Checksum'):
+        store.read('SH600000')
+    with pytest.raises(ValueError, match='Checksum'):
+        store.append('SH600001', _bars('2021-02-01', 3))
+    assert len(store.read('SH600000', verify=False)) == 20
+
+
+def test_skipped_symbols(tmp_path):
+    store = SymbolStore(str(tmp_path), FEATURES)
+    store.write('SH600000', _bars('2021-01-04', 20))
+    store.mark_skipped('SH600000', '2021-03-01', rows=20)
+    store.mark_skipped('SH600001', pd.Timestamp('2021-03-01'), rows=5)
+    store.save_manifest()
+
+    reopened = SymbolStore(str(tmp_path), FEATURES)
+    assert reopened.symbols == []
+    assert not (tmp_path / 'SH600000.npz').exists()
+    assert reopened.skipped_symbols() == {
+        'SH600000': {'checked': '2021-03-01', 'rows': 20},
+        'SH600001': {'checked': '2021-03-01', 'rows': 5},
+    }
+    # Writing a symbol once it has enough history takes it off the skipped list.
+    reopened.write('SH600001', _bars('2021-01-04', 40))
+    assert list(reopened.skipped_symbols()) == ['SH600000']
+
+
+def test_feature_list_mismatch_is_rejected(tmp_path):
+    store = SymbolStore(str(tmp_path), FEATURES)
+    store.write('SH600000', _bars('2021-01-04', 5))
+    store.save_manifest()
+    with pytest.raises(ValueError, match='--incremental'):
+        SymbolStore(str(tmp_path), FEATURES + ['amt'])
+
+
+def test_signals_round_trip(tmp_path):
+    dates = pd.date_range('2021-01-04', periods=3, name='datetime').astype('datetime64[ns]')
+    # Symbols are saved as a plain string array, whatever the string dtype of the columns.
+    symbols = pd.Index(['A', 'B'], name='instrument')
+    mean = pd.DataFrame([[0.1, np.nan], [0.2, 0.3], [np.nan, 0.4]], index=dates, columns=symbols)
+    last = pd.DataFrame([[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]], index=dates, columns=symbols)
+    path = str(tmp_path / 'signals.npz')
+    save_signals(path, {'mean': mean, 'last': last})
+
+    loaded = load_signals(path)
+    pd.testing.assert_frame_equal(loaded['mean'], mean.astype(np.float32), check_freq=False)
+    pd.testing.assert_frame_equal(loaded['last'], last.astype(np.float32), check_freq=False)
@@ -0,0 +1,49 @@
+import pytest
+
+from config import Config
+
+
+def test_update_sets_attributes():
+    config = Config()
+    config.update({'epochs': 3, 'predictor_learning_rate': 1e-4})
+    assert config.epochs == 3 and config.predictor_learning_rate == 1e-4
+
+
+def test_update_rejects_unknown_keys_without_applying_any():
+    config = Config()
+    with pytest.raises(KeyError, match='predictor_lr'):
+        config.update({'epochs': 3, 'predictor_lr': 1e-4})
+    assert config.epochs == Config().epochs
+
+
+def test_batch_size_rescales_the_iteration_counts():
+    config = Config()
+    config.update({'batch_size': 32})
+    assert (config.n_train_iter, config.n_val_iter) == (2000 * 32, 400 * 32)
+
+
+def test_explicit_overrides_of_derived_attributes_win():
+    config = Config()
+    config.update({'batch_size': 32, 'n_train_iter': 1000})
+    assert config.n_train_iter == 1000
+    assert config.n_val_iter == 400 * 32
+
+
+def test_unrelated_updates_keep_customized_derived_attributes():
+    config = Config()
+    config.n_train_iter = 1000
+    config.update({'epochs': 3})
+    assert config.n_train_iter == 1000
+
+
+def test_paths_and_benchmark_follow_their_sources():
+    config = Config()
+    config.update({'save_path': '/tmp/runs', 'predictor_save_folder_name': 'trial_3', 'instrument': 'csi800'})
+    assert config.finetuned_predictor_path == '/tmp/runs/trial_3/checkpoints/best_model'
+    assert config.finetuned_tokenizer_path.startswith('/tmp/runs/')
+    assert config.backtest_benchmark == 'SH000906'
+
+
+def test_unknown_instrument_has_no_benchmark():
+    with pytest.raises(ValueError, match='Benchmark'):
+        Config().update({'instrument': 'sp500'})
@@ -0,0 +1,175 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+import dataset
+from config import Config
+from dataset import PackedQlibDataset, WindowSampler, build_window_index, packed_loss_mask
+
+
+def _loop_window_index(lengths, window):
+    """The per-symbol loop the vectorized index replaced."""
+    pairs = [(i, start) for i, n in enumerate(lengths) for start in range(n - window + 1)]
+    return np.array([p[0] for p in pairs]), np.array([p[1] for p in pairs])
+
+
+def test_window_index_matches_loop():
+    lengths = [12, 3, 0, 5, 7, 101]
+    symbol_ids, starts = build_window_index(lengths, 5)
+    expected_ids, expected_starts = _loop_window_index(lengths, 5)
+
+    assert symbol_ids.dtype == np.int32 and starts.dtype == np.int32
+    np.testing.assert_array_equal(symbol_ids, expected_ids)
+    np.testing.assert_array_equal(starts, expected_starts)
+
+
+def test_window_index_last_window_ends_at_series_end():
+    lengths = np.array([8, 5, 20])
+    symbol_ids, starts = build_window_index(lengths, 5)
+    assert np.all(starts + 5 <= lengths[symbol_ids])
+    # Exactly one window per symbol ends on its last row.
+    np.testing.assert_array_equal(np.bincount(symbol_ids[starts + 5 == lengths[symbol_ids]]), [1, 1, 1])
+
+
+def test_window_index_without_windows():
+    symbol_ids, starts = build_window_index([2, 4], 5)
+    assert len(symbol_ids) == len(starts) == 0
+    symbol_ids, starts = build_window_index([], 5)
+    assert len(symbol_ids) == len(starts) == 0
+
+
+class _Windows:
+    """Stands in for a dataset: `n_windows` windows of which `n_samples` are used per epoch."""
+
+    def __init__(self, n_windows: int, n_samples: int):
+        self.num_windows = n_windows
+        self.n_samples = n_samples
+
+    def __len__(self):
+        return self.n_samples
+
+
+def _shards(dataset, num_replicas, **kwargs):
+    samplers = [WindowSampler(dataset, num_replicas, rank, **kwargs) for rank in range(num_replicas)]
+    return samplers, [list(sampler) for sampler in samplers]
+
+
+@pytest.mark.parametrize('num_replicas', [1, 3, 4])
+def test_sampler_shards_are_disjoint_and_cover_the_epoch(num_replicas):
+    samplers, shards = _shards(_Windows(1000, 600), num_replicas, drop_last=True)
+    indices = [i for shard in shards for i in shard]
+
+    assert all(len(shard) == len(sampler) == 600 // num_replicas for sampler, shard in zip(samplers, shards))
+    assert len(set(indices)) == len(indices)
+    assert all(0 <= i < 1000 for i in indices)
+
+
+def test_sampler_ranks_agree_on_the_permutation():
+    _, shards = _shards(_Windows(100, 100), 2, seed=3)
+    single = list(WindowSampler(_Windows(100, 100), seed=3))
+    # Rank r takes every num_replicas-th index of the shared permutation, starting at r.
+    assert shards[0] == single[0::2] and shards[1] == single[1::2]
+
+
+def test_sampler_pads_uneven_tail_by_wrapping():
+    samplers, shards = _shards(_Windows(10, 10), 3, shuffle=False)
+    assert [len(shard) for shard in shards] == [4, 4, 4]
+    indices = [i for shard in shards for i in shard]
+    assert sorted(set(indices)) == list(range(10))
+    assert len(indices) - len(set(indices)) == 2
+
+
+def test_sampler_reshuffles_per_epoch_only_when_shuffling():
+    sampler = WindowSampler(_Windows(500, 200), seed=1)
+    first = list(sampler)
+    assert list(sampler) == first
+    sampler.set_epoch(1)
+    assert list(sampler) != first
+
+    fixed = WindowSampler(_Windows(500, 200), shuffle=False, seed=1)
+    first = list(fixed)
+    fixed.set_epoch(1)
+    assert list(fixed) == first == sorted(first)
+
+
+def test_sampler_rejects_invalid_rank():
+    with pytest.raises(ValueError):
+        WindowSampler(_Windows(10, 10), num_replicas=2, rank=2)
+
+
+def _packed_dataset(tmp_path, monkeypatch, lengths: dict) -> PackedQlibDataset:
+    """A packed training set over random series of the given lengths, with rows of 16 steps."""
+    rng = np.random.default_rng(0)
+    raw = {}
+    for symbol, length in lengths.items():
+        index = pd.date_range('2020-01-01', periods=length, freq='D', name='timestamps')
+        raw[symbol] = pd.DataFrame(rng.normal(10.0, 1.0, size=(length, 6)), index=index,
+                                   columns=['open', 'high', 'low', 'close', 'vol', 'amt'])
+    with open(tmp_path / 'train_data.pkl', 'wb') as f:
+        pickle.dump(raw, f)
+
+    def config():
+        c = Config()
+        c.update({'dataset_path': str(tmp_path), 'lookback_window': 10, 'predict_window': 2,
+                  'max_context': 15, 'packing_min_length': 4})
+        return c
+
+    monkeypatch.setattr(dataset, 'Config', config)
+    ds = PackedQlibDataset('train')
+    return ds
+
+
+def test_pack_first_fit_decreasing():
+    rows = PackedQlibDataset._pack(np.array([16, 5, 9, 16, 7, 3, 4]), capacity=16)
+    assert rows == [[0], [3], [2, 4], [1, 6, 5]]
+
+
+def test_packed_rows_hold_every_segment_once(tmp_path, monkeypatch):
+    # 'a' is cut into 16 + 16 + 8 steps, 'b' is shorter than one window, 'c' is too short to keep.
+    ds = _packed_dataset(tmp_path, monkeypatch, {'a': 40, 'b': 7, 'c': 3, 'd': 16})
+    assert ds.row_length == 16
+    assert ds.symbols == ['a', 'b', 'd']
+    assert sorted(ds.segment_lengths.tolist()) == [7, 8, 16, 16, 16]
+    assert sorted(ds.row_segments.tolist()) == list(range(len(ds.segment_lengths)))
+    # The two partial segments share one row.
+    assert len(ds) == ds.num_windows == 4
+
+    seen = []
+    for idx in range(ds.num_windows):
+        x, x_stamp, segment_ids = ds[idx]
+        assert x.shape == (16, 6) and x_stamp.shape == (16, 5) and segment_ids.shape == (16,)
+        segments = ds.row_segments[ds.row_ptr[idx]:ds.row_ptr[idx + 1]]
+        # Segments are laid out back to back with 1-based ids; the rest is zero padding.
+        expected_ids = np.concatenate([np.full(ds.segment_lengths[s], k) for k, s in enumerate(segments, start=1)])
+        np.testing.assert_array_equal(segment_ids[:len(expected_ids)], expected_ids)
+        assert torch.all(segment_ids[len(expected_ids):] == 0)
+        assert torch.all(x[len(expected_ids):] == 0)
+
+        pos = 0
+        for s in segments:
+            row, length = ds.segment_rows[s], ds.segment_lengths[s]
+            window = ds.features[row:row + length]
+            expected = (window - window.mean(axis=0)) / (window.std(axis=0) + 1e-5)
+            np.testing.assert_allclose(x[pos:pos + length].numpy(), expected, rtol=1e-5, atol=1e-5)
+            seen.append(tuple(window[0]))
+            pos += length
+    assert len(set(seen)) == len(ds.segment_lengths)
+
+
+def test_packed_rows_are_sampled_by_window_sampler(tmp_path, monkeypatch):
+    ds = _packed_dataset(tmp_path, monkeypatch, {'a': 40, 'b': 7, 'd': 16})
+    assert sorted(WindowSampler(ds, shuffle=False)) == list(range(ds.num_windows))
+
+
+def test_packed_loss_mask():
+    segment_ids = torch.tensor([[1, 1, 1, 2, 2, 0, 0],
+                                [1, 1, 1, 1, 1, 1, 1]])
+    mask = packed_loss_mask(segment_ids)
+    # Targets are masked where they cross into the next segment or involve padding.
+    expected = torch.tensor([[False, False, True, False, True, True],
+                             [False, False, False, False, False, False]])
+    assert mask.shape == (2, 6)
+    assert torch.equal(mask, expected)
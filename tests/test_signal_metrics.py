@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.signal_metrics import PoorSignalError, StreamingSignalEvaluator, forward_returns
+from walk_forward import daily_ic, ic_summary
+
+N_DAYS, N_SYMBOLS = 30, 40
+
+
+def _panel(seed: int = 0):
+    """Long arrays of (date_id, signal, label) in date order, with missing labels and tied signals."""
+    rng = np.random.default_rng(seed)
+    date_ids = np.repeat(np.arange(N_DAYS), N_SYMBOLS)
+    label = rng.normal(0.0, 0.02, size=len(date_ids))
+    signal = 0.3 * label + rng.normal(0.0, 0.02, size=len(date_ids))
+    signal[rng.uniform(size=len(signal)) < 0.2] = 0.0  # Ties.
+    label[rng.uniform(size=len(label)) < 0.1] = np.nan
+    return date_ids, signal, label
+
+
+def _feed(evaluator, date_ids, signal, label, seed: int = 1):
+    """Feeds the panel in batches of random size, which split days across batches."""
+    rng = np.random.default_rng(seed)
+    cuts = np.sort(rng.choice(np.arange(1, len(date_ids)), size=50, replace=False))
+    for batch in np.split(np.arange(len(date_ids)), cuts):
+        evaluator.update(date_ids[batch], {'mean': signal[batch]}, label[batch])
+    evaluator.finish()
+
+
+def test_streaming_matches_daily_ic():
+    date_ids, signal, label = _panel()
+    evaluator = StreamingSignalEvaluator(('mean',), min_count=10)
+    _feed(evaluator, date_ids, signal, label)
+    summary = evaluator.summary()['mean']
+
+    wide = lambda values: pd.DataFrame(values.reshape(N_DAYS, N_SYMBOLS))
+    expected = ic_summary(daily_ic(wide(signal), wide(label)))
+    assert summary['days'] == evaluator.days == N_DAYS
+    for key in ['ic', 'icir', 'rank_ic', 'rank_icir']:
+        assert summary[key] == pytest.approx(expected[key], rel=1e-10), key
+
+
+def test_streaming_hit_rate_and_spread():
+    date_ids, signal, label = _panel()
+    evaluator = StreamingSignalEvaluator(('mean',), quantile=0.25)
+    _feed(evaluator, date_ids, signal, label)
+
+    hit_rates, spreads = [], []
+    for day in range(N_DAYS):
+        s, y = signal[date_ids == day], label[date_ids == day]
+        s, y = s[np.isfinite(y)], y[np.isfinite(y)]
+        hit_rates.append(np.mean(np.sign(s) == np.sign(y)))
+        order = np.argsort(s, kind='stable')
+        n = int(len(s) * 0.25)
+        spreads.append(y[order[-n:]].mean() - y[order[:n]].mean())
+    summary = evaluator.summary()['mean']
+    assert summary['hit_rate'] == pytest.approx(np.mean(hit_rates))
+    assert summary['spread'] == pytest.approx(np.mean(spreads))
+
+
+def test_rank_ic_does_not_depend_on_the_order_within_a_day():
+    date_ids, signal, label = _panel()
+    shuffled = np.lexsort((np.random.default_rng(2).permutation(len(date_ids)), date_ids))
+    a, b = StreamingSignalEvaluator(('mean',)), StreamingSignalEvaluator(('mean',))
+    _feed(a, date_ids, signal, label)
+    _feed(b, date_ids[shuffled], signal[shuffled], label[shuffled])
+    assert a.summary()['mean']['rank_ic'] == pytest.approx(b.summary()['mean']['rank_ic'], rel=1e-12)
+
+
+def test_days_with_too_few_symbols_are_skipped():
+    evaluator = StreamingSignalEvaluator(('mean',), min_count=5)
+    evaluator.update(np.zeros(4), {'mean': np.arange(4.0)}, np.arange(4.0))
+    evaluator.update(np.ones(6), {'mean': np.arange(6.0)}, np.arange(6.0))
+    evaluator.finish()
+    assert evaluator.days == 1
+    assert evaluator.summary()['mean']['ic'] == pytest.approx(1.0)
+
+
+def test_poor_signal_aborts_after_the_configured_days():
+    date_ids, signal, label = _panel()
+    evaluator = StreamingSignalEvaluator(('mean',), abort_after_days=5, min_rank_ic=0.0)
+    with pytest.raises(PoorSignalError):
+        _feed(evaluator, date_ids, -signal, label)
+    assert evaluator.days == 5
+
+    evaluator = StreamingSignalEvaluator(('mean',), abort_after_days=5, min_rank_ic=0.0)
+    _feed(evaluator, date_ids, signal, label)
+    assert evaluator.days == N_DAYS
+
+
+def test_forward_returns_start_on_the_next_bar():
+    close = np.array([10.0, 11.0, 12.1, 13.31, 12.0])
+    np.testing.assert_allclose(forward_returns(close), [0.1, 0.1, 12.0 / 13.31 - 1, np.nan, np.nan])
+    np.testing.assert_allclose(forward_returns(close, horizon=2), [0.21, 12.0 / 12.1 - 1, np.nan, np.nan, np.nan])
+    assert np.isnan(forward_returns(close[:2])).all()
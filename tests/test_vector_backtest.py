@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import FIXTURE_DIR
+from vector_backtest import VectorizedTopkDropout, analyze_report, risk_metrics
+
+TOPK_DROPOUT_DIR = os.path.join(FIXTURE_DIR, 'topk_dropout')
+
+
+def _read_fixture(name: str, **kwargs) -> pd.DataFrame:
+    return pd.read_csv(os.path.join(TOPK_DROPOUT_DIR, name), parse_dates=['datetime'], **kwargs)
+
+
+@pytest.fixture(scope='module')
+def qlib_fixture():
+    """Synthetic market, signal and qlib's report, see `fixtures/make_topk_dropout_fixture.py`."""
+    market = _read_fixture('market.csv', index_col=['datetime', 'instrument']).unstack('instrument')
+    bench = _read_fixture('bench.csv', index_col='datetime')['close'].pct_change(fill_method=None)
+    signal = _read_fixture('signal.csv', index_col=['datetime', 'instrument'])['score'].unstack('instrument')
+    expected = _read_fixture('expected_report.csv', index_col='datetime')
+    return market, bench, signal, expected
+
+
+def test_matches_qlib_report(qlib_fixture):
+    market, bench, signal, expected = qlib_fixture
+    engine = VectorizedTopkDropout(topk=3, n_drop=1, hold_thresh=2, account=1_000_000)
+    report = engine.run(signal, market['open'], market['close'], factor=market['factor'], bench=bench,
+                        start_time=expected.index[0], end_time=expected.index[-1])
+
+    pd.testing.assert_index_equal(report.index, expected.index, check_names=False)
+    for column in ['return', 'cost', 'turnover']:
+        np.testing.assert_allclose(report[column], expected[column], rtol=0, atol=1e-10, err_msg=column)
+    # qlib computes the benchmark return from float32 closes.
+    np.testing.assert_allclose(report['bench'], expected['bench'], rtol=0, atol=1e-6)
+    np.testing.assert_allclose(report['account_value'], expected['account'], rtol=1e-10)
+
+
+def test_without_benchmark_reports_absolute_returns(qlib_fixture):
+    market, _, signal, expected = qlib_fixture
+    engine = VectorizedTopkDropout(topk=3, n_drop=1, hold_thresh=2, account=1_000_000)
+    report = engine.run(signal, market['open'], market['close'], start_time=expected.index[0])
+
+    assert (report['bench'] == 0.0).all()
+    analysis = analyze_report(report, excess=False)
+    assert set(analysis) == {'return_without_cost', 'return_with_cost'}
+    assert analysis['return_with_cost']['mean'] == pytest.approx((report['return'] - report['cost']).mean())
+
+
+def test_suspended_symbol_is_not_traded():
+    dates = pd.bdate_range('2021-01-04', periods=4)
+    prices = pd.DataFrame({'A': [10.0, 10.0, np.nan, 10.0], 'B': [10.0] * 4}, index=dates)
+    # A scores best from the first day on, but is suspended on the day the first orders are filled.
+    signal = pd.DataFrame({'A': [2.0, 2.0, 2.0, 2.0], 'B': [1.0] * 4}, index=dates)
+    engine = VectorizedTopkDropout(topk=1, n_drop=1, account=1_000_000, trade_unit=None)
+    report = engine.run(signal, prices, prices, start_time=dates[2])
+
+    assert report['turnover'].iloc[0] == 0.0
+    assert report['turnover'].iloc[1] > 0.0
+
+
+def test_limit_is_measured_against_last_close_before_suspension():
+    dates = pd.bdate_range('2021-01-04', periods=4)
+    # A resumes 15% above its last close, i.e. at the limit, and cannot be bought that day either.
+    prices = pd.DataFrame({'A': [10.0, 10.0, np.nan, 11.5], 'B': [10.0] * 4}, index=dates)
+    signal = pd.DataFrame({'A': [2.0, 2.0, 2.0, 2.0], 'B': [1.0] * 4}, index=dates)
+    engine = VectorizedTopkDropout(topk=1, n_drop=1, account=1_000_000, trade_unit=None)
+    report = engine.run(signal, prices, prices, start_time=dates[2])
+
+    assert (report['turnover'] == 0.0).all()
+
+
+def test_risk_metrics():
+    returns = pd.Series([0.01, -0.02, 0.03, 0.0])
+    metrics = risk_metrics(returns)
+    assert metrics['annualized_return'] == pytest.approx(returns.mean() * 252)
+    assert metrics['information_ratio'] == pytest.approx(returns.mean() / returns.std() * np.sqrt(252))
+    assert metrics['max_drawdown'] == pytest.approx(-0.02)
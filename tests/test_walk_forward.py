@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+
+from walk_forward import generate_folds, label_matrix, ranges_overlap
+
+
+def _days(split):
+    return pd.Timestamp(split[0]), pd.Timestamp(split[1])
+
+
+def test_rolling_folds_tile_the_range():
+    folds = generate_folds('2019-01-01', '2021-12-31', train_months=12, val_months=3, test_months=6, step_months=6)
+    assert [fold['test'] for fold in folds] == [
+        ['2020-04-01', '2020-09-30'],
+        ['2020-10-01', '2021-03-31'],
+        ['2021-04-01', '2021-09-30'],
+        ['2021-10-01', '2021-12-31'],
+    ]
+    assert folds[0] == {
+        'train': ['2019-01-01', '2019-12-31'],
+        'val': ['2020-01-01', '2020-03-31'],
+        'test': ['2020-04-01', '2020-09-30'],
+    }
+    for fold in folds:
+        # Splits are contiguous and never overlap.
+        train, val, test = _days(fold['train']), _days(fold['val']), _days(fold['test'])
+        assert train[1] + pd.Timedelta(days=1) == val[0]
+        assert val[1] + pd.Timedelta(days=1) == test[0]
+        assert test[0] <= test[1] <= pd.Timestamp('2021-12-31')
+        # Rolling: the train window keeps its length.
+        assert train[0] + pd.DateOffset(months=12) == val[0]
+
+
+def test_expanding_folds_keep_the_train_start():
+    folds = generate_folds('2019-01-01', '2021-12-31', 12, 3, 6, 6, expanding=True)
+    assert len(folds) == 4
+    assert {fold['train'][0] for fold in folds} == {'2019-01-01'}
+    assert [fold['train'][1] for fold in folds] == ['2019-12-31', '2020-06-30', '2020-12-31', '2021-06-30']
+
+
+def test_no_fold_when_the_range_is_too_short():
+    assert generate_folds('2019-01-01', '2019-12-31', 12, 3, 6, 6) == []
+
+
+def test_ranges_overlap():
+    assert ranges_overlap(['2020-01-01', '2020-06-30'], ['2020-06-30', '2020-12-31'])
+    assert not ranges_overlap(['2020-01-01', '2020-06-29'], ['2020-06-30', '2020-12-31'])
+    assert ranges_overlap(['2020-01-01', '2020-12-31'], ['2020-03-01', '2020-03-31'])
+
+
+def test_label_matrix_aligns_each_symbols_own_bars():
+    index = pd.date_range('2021-01-04', periods=5, freq='B')
+    data = {
+        'A': pd.DataFrame({'close': [10.0, 11.0, 12.1, 13.31, 12.0]}, index=index),
+        # B is suspended on the third day: its label skips over the gap.
+        'B': pd.DataFrame({'close': [5.0, 5.0, 6.0, 3.0]}, index=index.delete(2)),
+    }
+    labels = label_matrix(data)
+    assert list(labels.index) == list(index)
+    np.testing.assert_allclose(labels['A'], [0.1, 0.1, 12.0 / 13.31 - 1, np.nan, np.nan])
+    np.testing.assert_allclose(labels['B'], [0.2, -0.5, np.nan, np.nan, np.nan])
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from model.window_stats import RollingWindowStats, denormalize_window, normalize_window
+
+
+def _all_windows(lengths, length):
+    offsets = np.cumsum(lengths) - lengths
+    symbol_ids = np.concatenate([np.full(max(n - length + 1, 0), i) for i, n in enumerate(lengths)])
+    rows = np.concatenate([np.arange(o, o + n - length + 1) for o, n in zip(offsets, lengths)])
+    return symbol_ids, rows
+
+
+def _reference(values, rows, length):
+    windows = np.stack([values[r:r + length] for r in rows])
+    return windows.mean(axis=1), windows.std(axis=1)
+
+
+@pytest.mark.parametrize('length', [1, 7, 30])
+def test_matches_numpy_on_every_window(length):
+    rng = np.random.default_rng(0)
+    lengths = np.array([30, 5, 101, 64])
+    scale = np.array([1.0, 50.0, 1e-3])
+    values = rng.normal(size=(lengths.sum(), 3)) * scale + [0.0, 100.0, -2.0]
+    stats = RollingWindowStats(values, lengths, block_size=30)
+    symbol_ids, rows = _all_windows(lengths, length)
+
+    mean, std = stats.mean_std(symbol_ids, rows, length)
+    ref_mean, ref_std = _reference(values, rows, length)
+    assert mean.dtype == np.float32 and mean.shape == (len(rows), 3)
+    np.testing.assert_allclose(mean, ref_mean, rtol=1e-6, atol=1e-6)
+    np.testing.assert_allclose(std / scale, ref_std / scale, rtol=1e-5, atol=1e-6)
+
+
+def test_scalar_lookup():
+    values = np.arange(20, dtype=np.float32).reshape(10, 2)
+    stats = RollingWindowStats(values, [4, 6], block_size=4)
+    mean, std = stats.mean_std(1, 5, 4)
+    assert mean.shape == (2,)
+    np.testing.assert_allclose(mean, values[5:9].mean(axis=0))
+    np.testing.assert_allclose(std, values[5:9].std(axis=0), rtol=1e-6)
+
+
+def test_large_trending_values_keep_their_variance():
+    """Raw volumes and amounts: a level that drifts over orders of magnitude, with small local noise."""
+    rng = np.random.default_rng(1)
+    n, length = 5000, 90
+    trend = np.geomspace(1e3, 1e10, n)[:, None]
+    values = trend * (1 + 1e-6 * rng.normal(size=(n, 2)))
+    stats = RollingWindowStats(values, [n], block_size=length)
+    _, rows = _all_windows([n], length)
+
+    mean, std = stats.mean_std(np.zeros_like(rows), rows, length)
+    ref_mean, ref_std = _reference(values, rows, length)
+    np.testing.assert_allclose(mean, ref_mean, rtol=1e-6)
+    np.testing.assert_allclose(std, ref_std, rtol=1e-4)
+
+
+def test_constant_window_has_zero_std():
+    values = np.full((200, 1), 123456789.0)
+    stats = RollingWindowStats(values, [200], block_size=50)
+    _, std = stats.mean_std(np.zeros(151, dtype=np.int64), np.arange(151), 50)
+    assert np.all(std == 0)
+
+
+def test_window_longer_than_block_is_rejected():
+    stats = RollingWindowStats(np.zeros((10, 1)), [10], block_size=4)
+    with pytest.raises(ValueError):
+        stats.mean_std(0, 0, 5)
+
+
+def test_normalize_round_trip():
+    rng = np.random.default_rng(2)
+    x = rng.normal(size=(16, 3)).astype(np.float32)
+    mean, std = x.mean(axis=0), x.std(axis=0)
+    normalized = normalize_window(x, mean, std, clip=100.0)
+    np.testing.assert_allclose(denormalize_window(normalized, mean, std), x, rtol=1e-5, atol=1e-5)
+    assert np.abs(normalize_window(x, mean, std, clip=0.5)).max() <= 0.5